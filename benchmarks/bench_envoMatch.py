@@ -0,0 +1,319 @@
+
+'''
+Benchmarks for envoMatch hot paths and the full pipeline.
+
+The bundled example mzML files and examples/input.tsv are used as input.
+Results are written as json so runs from different versions can be compared with --compare.
+
+Usage
+-----
+    python benchmarks/bench_envoMatch.py -o results.json
+    python benchmarks/bench_envoMatch.py --scale_rows 100000 --nThread 1 2 4 -o results.json
+    python benchmarks/bench_envoMatch.py --compare old_results.json -o new_results.json
+    python benchmarks/bench_envoMatch.py --skip hot_paths --skip pipeline --startup_budget 0.3
+'''
+
+import sys
+import os
+import argparse
+import json
+import time
+import shutil
+import tempfile
+import platform
+import subprocess
+import statistics
+
+import pandas as pd
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMPLES_DIR = os.path.join(REPO_DIR, 'examples')
+sys.path.insert(0, REPO_DIR)
+
+from envoMatch import modules as src
+from envoMatch.main import _calc_envelopes, _get_mz_range
+from pyteomics.mass import Composition
+
+
+def _time(fxn, repeat=3, number=1):
+    '''
+    Time fxn.
+
+    Returns
+    -------
+        Dict with the min, median and max seconds per call.
+    '''
+    times = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fxn()
+        times.append((time.perf_counter() - start) / number)
+    return {'min': min(times), 'median': statistics.median(times), 'max': max(times),
+            'repeat': repeat, 'number': number}
+
+
+def _example_files():
+    return sorted(os.path.join(EXAMPLES_DIR, x) for x in os.listdir(EXAMPLES_DIR) if x.endswith('.mzML'))
+
+
+def _example_rows(n=None):
+    rows = pd.read_csv(os.path.join(EXAMPLES_DIR, 'input.tsv'), sep='\t').to_dict('records')
+    return rows if n is None else rows[:n]
+
+
+def make_scaled_input(nRow, ofname):
+    '''
+    Write examples/input.tsv replicated to nRow rows.
+    '''
+    dat = pd.read_csv(os.path.join(EXAMPLES_DIR, 'input.tsv'), sep='\t')
+    n_rep = nRow // len(dat.index) + 1
+    dat = pd.concat([dat] * n_rep, ignore_index=True).iloc[:nRow]
+    dat.to_csv(ofname, sep='\t', index=False)
+    return ofname
+
+
+def bench_hot_paths(repeat, n_rows):
+    '''
+    Time each hot path separately on the example data.
+    '''
+    ret = dict()
+    fnames = _example_files()
+    args = argparse.Namespace(formula_source='input', pre_scan_src='ms1', env_engine='isotopologues')
+    atom_table = src.AtomTable(None)
+    atom_table.read()
+    rows = _example_rows(n_rows)
+
+    sys.stdout.write('\tMs1File open/index...\n')
+    ret['Ms1File_open'] = _time(lambda: [src.Ms1File(f, 'mzML') for f in fnames], repeat=repeat)
+    ret['Ms1File_index'] = _time(lambda: [src.Ms1File(f, 'mzML', build_precursor_list=True) for f in fnames],
+                                 repeat=repeat)
+
+    ms1_files = {os.path.basename(f): src.Ms1File(f, 'mzML', build_precursor_list=True) for f in fnames}
+
+    def _build_precursor_lists():
+        for f in ms1_files.values():
+            f._scan_levels = None
+            f._build_precursor_list()
+    sys.stdout.write('\t_build_precursor_list...\n')
+    ret['_build_precursor_list'] = _time(_build_precursor_lists, repeat=repeat)
+
+    sys.stdout.write('\tformula_to_pyteomics_formula...\n')
+    ret['formula_to_pyteomics_formula'] = _time(lambda: [src.utils.formula_to_pyteomics_formula(x['formula'], x['charge'])
+                                                         for x in rows], repeat=repeat)
+    ret['formula_to_pyteomics_formula']['calls'] = len(rows)
+
+    sequences = [x['sequence'].upper() for x in rows]
+    sys.stdout.write('\tgetComposition/getCompositions...\n')
+    ret['getComposition'] = _time(lambda: [atom_table.getComposition(s, 2) for s in sequences], repeat=repeat)
+    ret['getComposition']['calls'] = len(sequences)
+    ret['getCompositions'] = _time(lambda: atom_table.getMasses(compositions=atom_table.getCompositions(sequences, 2)),
+                                   repeat=repeat)
+    ret['getCompositions']['calls'] = len(sequences)
+
+    compositions = [Composition(formula=src.utils.formula_to_pyteomics_formula(x['formula'], charge=x['charge']))
+                    for x in rows]
+    for engine in src.atom_table.ENVELOPE_ENGINES:
+        sys.stdout.write('\tgetEnvelope ({})...\n'.format(engine))
+        ret['getEnvelope_{}'.format(engine)] = _time(lambda: [src.getEnvelope(c, threshold=0.01, engine=engine)
+                                                              for c in compositions], repeat=repeat)
+        ret['getEnvelope_{}'.format(engine)]['calls'] = len(compositions)
+
+    # precompute envelopes and spectra for the annotation benchmarks
+    envelopes = [_calc_envelopes(row, args, atom_table) for row in rows]
+    pre_scans = [ms1_files[row['parent_file']].get_precursor_scan(row['scan']) for row in rows]
+    mz_ranges = [_get_mz_range(x[3]) for x in envelopes]
+
+    sys.stdout.write('\tget_spectra...\n')
+    ret['get_spectra'] = _time(lambda: [ms1_files[row['parent_file']].get_spectra(s, r)
+                                        for row, s, r in zip(rows, pre_scans, mz_ranges)], repeat=repeat)
+    ret['get_spectra']['calls'] = len(rows)
+
+    specs = [ms1_files[row['parent_file']].get_spectra(s, r) for row, s, r in zip(rows, pre_scans, mz_ranges)]
+    cases = [(spec, envs[s], monos[s], s) for spec, (_, seqs, envs, monos) in zip(specs, envelopes)
+             for s in seqs if spec is not None]
+
+    def _annotate_objects():
+        for spec, env, mono_mz, seq in cases:
+            consensus = src.ConsensusEnvelope(src.Spectrum(spec['mz'], spec['int']),
+                                              src.TheoreticalEnvelope.fromPairs(env), sequence=seq)
+            consensus.set_mono(mono_mz=mono_mz)
+            consensus.annotate(remove_unlabeled=False, verbose=False)
+
+    def _annotate_arrays():
+        for spec, env, mono_mz, seq in cases:
+            theoretical_mz, theoretical_int = zip(*env)
+            src.annotateArrays(spec['mz'], spec['int'], theoretical_mz, theoretical_int,
+                               mono_mz=mono_mz, sequence=seq)
+
+    sys.stdout.write('\tConsensusEnvelope.annotate...\n')
+    ret['ConsensusEnvelope_annotate'] = _time(_annotate_objects, repeat=repeat)
+    ret['ConsensusEnvelope_annotate']['calls'] = len(cases)
+    ret['annotateArrays'] = _time(_annotate_arrays, repeat=repeat)
+    ret['annotateArrays']['calls'] = len(cases)
+
+    return ret
+
+
+# Modules which should not be loaded by envoMatch --help or a run_envoMatch dry run.
+HEAVY_MODULES = ['numpy', 'pandas', 'pyteomics', 'matplotlib', 'tqdm', 'lxml']
+
+
+def bench_startup(repeat, budget):
+    '''
+    Time `envoMatch --help` and a `run_envoMatch` dry run in a subprocess.
+
+    Parameters
+    ----------
+    budget: float
+        Maximum median time in seconds for each command.
+    '''
+    ret = dict()
+    wd = tempfile.mkdtemp(prefix='envoMatch_bench_')
+    try:
+        shutil.copy(os.path.join(EXAMPLES_DIR, 'input.tsv'), os.path.join(wd, 'input.tsv'))
+        commands = {'envoMatch_help': ('main', ['--help']),
+                    'run_envoMatch_dry_run': ('qsubmit', ['input.tsv'])}
+        for name, (fxn, argv) in commands.items():
+            sys.stdout.write('\t{}...\n'.format(name))
+            code = ('import sys; sys.path.insert(0, {}); import envoMatch\n'
+                    'try:\n    envoMatch.{}()\nexcept SystemExit:\n    pass\n'
+                    'sys.stderr.write(" ".join(m for m in {} if m in sys.modules))').format(repr(REPO_DIR), fxn,
+                                                                                            repr(HEAVY_MODULES))
+            command = [sys.executable, '-c', code] + argv
+
+            def _run():
+                return subprocess.run(command, cwd=wd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                      check=True).stderr.decode()
+            result = _time(_run, repeat=repeat)
+            result['heavy_modules_loaded'] = _run().split()
+            result['budget'] = budget
+            result['within_budget'] = result['median'] <= budget
+            ret[name] = result
+    finally:
+        shutil.rmtree(wd)
+
+    return ret
+
+
+def bench_pipeline(input_file, nThreads, extra_args, repeat):
+    '''
+    Time the full envoMatch pipeline in a subprocess for each number of threads.
+    '''
+    ret = dict()
+    wd = tempfile.mkdtemp(prefix='envoMatch_bench_')
+    try:
+        for f in _example_files():
+            os.symlink(f, os.path.join(wd, os.path.basename(f)))
+        shutil.copy(input_file, os.path.join(wd, 'input.tsv'))
+        nRow = len(pd.read_csv(input_file, sep='\t', usecols=['parent_file']).index)
+
+        command = [sys.executable, '-c',
+                   'import sys; sys.path.insert(0, {}); import envoMatch; envoMatch.main()'.format(repr(REPO_DIR))]
+        for nThread in nThreads:
+            sys.stdout.write('\tmain() with {} thread(s)...\n'.format(nThread))
+            argv = ['input.tsv', '--nThread', str(nThread), '--index_cache', '0'] + extra_args
+
+            def _run():
+                with open(os.path.join(wd, 'stdout.txt'), 'w') as outF:
+                    subprocess.run(command + argv, cwd=wd, stdout=outF, stderr=subprocess.STDOUT, check=True)
+            result = _time(_run, repeat=repeat)
+            result['rows_per_second'] = nRow / result['median']
+            ret['main_nThread_{}'.format(nThread)] = result
+    finally:
+        shutil.rmtree(wd)
+
+    return ret
+
+
+def _get_version_info():
+    ret = {'python': platform.python_version(), 'platform': platform.platform()}
+    try:
+        ret['git_commit'] = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, check=True,
+                                           stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        ret['git_commit'] = None
+    for module in ['numpy', 'pandas', 'pyteomics']:
+        try:
+            ret[module] = __import__(module).__version__
+        except (ImportError, AttributeError):
+            ret[module] = None
+    return ret
+
+
+def compare(old, new, out=sys.stdout):
+    '''
+    Print median time ratios (new / old) for benchmarks in both results.
+    '''
+    out.write('\n{:<40}{:>12}{:>12}{:>10}\n'.format('benchmark', 'old (s)', 'new (s)', 'ratio'))
+    for section in ['startup', 'hot_paths', 'pipeline']:
+        for k, v in new.get(section, dict()).items():
+            if k not in old.get(section, dict()):
+                continue
+            old_t = old[section][k]['median']
+            out.write('{:<40}{:>12.4f}{:>12.4f}{:>10.2f}\n'.format(k, old_t, v['median'], v['median'] / old_t))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run envoMatch benchmarks on the bundled example data.')
+    parser.add_argument('-o', '--output', default='envoMatch_benchmarks.json',
+                        help='Path to write json results to. Default is envoMatch_benchmarks.json')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of times to repeat each benchmark. Default is 3.')
+    parser.add_argument('--hot_path_rows', type=int, default=20,
+                        help='Number of example rows used for hot path benchmarks. Default is 20.')
+    parser.add_argument('--nThread', type=int, nargs='+', default=[1, 2, 4],
+                        help='Numbers of threads to run the full pipeline with. Default is 1 2 4.')
+    parser.add_argument('--scale_rows', type=int, default=None,
+                        help='Replicate examples/input.tsv to this many rows for the pipeline benchmark.')
+    parser.add_argument('--envoMatch_args', default='--env_engine convolution',
+                        help='Additional arguments passed to envoMatch in the pipeline benchmark. '
+                             'Default is "--env_engine convolution".')
+    parser.add_argument('--startup_budget', type=float, default=0.25,
+                        help='Maximum median time in seconds for envoMatch --help and a run_envoMatch dry run. '
+                             'The exit status is 1 if a startup benchmark is over budget. Default is 0.25.')
+    parser.add_argument('--skip', choices=['startup', 'hot_paths', 'pipeline'], action='append', default=[],
+                        help='Skip a group of benchmarks.')
+    parser.add_argument('--compare', default=None,
+                        help='Path to results from a previous run to compare to.')
+    args = parser.parse_args()
+
+    results = {'version': _get_version_info(), 'args': vars(args)}
+
+    if 'startup' not in args.skip:
+        sys.stdout.write('Running startup benchmarks...\n')
+        results['startup'] = bench_startup(args.repeat, args.startup_budget)
+
+    if 'hot_paths' not in args.skip:
+        sys.stdout.write('Running hot path benchmarks...\n')
+        results['hot_paths'] = bench_hot_paths(args.repeat, args.hot_path_rows)
+
+    if 'pipeline' not in args.skip:
+        sys.stdout.write('Running pipeline benchmarks...\n')
+        tmp_dir = tempfile.mkdtemp(prefix='envoMatch_bench_input_')
+        try:
+            input_file = os.path.join(EXAMPLES_DIR, 'input.tsv')
+            if args.scale_rows is not None:
+                input_file = make_scaled_input(args.scale_rows, os.path.join(tmp_dir, 'input.tsv'))
+            results['pipeline'] = bench_pipeline(input_file, args.nThread, args.envoMatch_args.split(), args.repeat)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    sys.stdout.write('Writing {}\n'.format(args.output))
+    with open(args.output, 'w') as outF:
+        json.dump(results, outF, indent=2, sort_keys=True)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as inF:
+            compare(json.load(inF), results)
+
+    over_budget = [k for k, v in results.get('startup', dict()).items() if not v['within_budget']]
+    for k in over_budget:
+        v = results['startup'][k]
+        sys.stderr.write('{} took {:.3f}s which is over the {:.3f}s startup budget. Loaded modules: {}\n'.format(
+            k, v['median'], v['budget'], ', '.join(v['heavy_modules_loaded']) or 'none'))
+    return 1 if over_budget else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
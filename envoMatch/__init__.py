@@ -1,2 +1,4 @@
 from .main import main
 from .qsubmit import main as qsubmit
+from .shard import main as merge
+from .convert import main as convert
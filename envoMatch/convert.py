@@ -0,0 +1,81 @@
+
+import sys
+import os
+import argparse
+from multiprocessing import Pool, cpu_count
+
+from . import modules as src
+
+FILE_TYPES = ('mzML', 'mzXML', 'ms1')
+
+
+def _get_ofname(fname, out_dir=None):
+    base = os.path.splitext(os.path.basename(fname))[0]
+    return os.path.join(os.path.dirname(os.path.abspath(fname)) if out_dir is None else out_dir,
+                        '{}.{}'.format(base, src.ms1store.STORE_EXT))
+
+
+def _get_file_type(fname, file_type=None):
+    if file_type is not None:
+        return file_type
+    ext = os.path.splitext(fname)[1][1:]
+    for t in FILE_TYPES:
+        if ext.lower() == t.lower():
+            return t
+    raise RuntimeError('Could not determine file type of {}! Use --file_type.'.format(fname))
+
+
+def convert(fname, ofname, file_type, overwrite=False):
+    '''
+    Convert a raw file to an ms1 store.
+
+    Returns
+    -------
+    nScan: int
+        Number of ms1 scans written or None if ofname was already current.
+    '''
+    if not overwrite and src.ms1store.isCurrent(ofname, fname):
+        return None
+    ms1_file = src.Ms1File(fname, file_type=file_type, build_precursor_list=(file_type != 'ms1'))
+    return src.ms1store.writeStore(ms1_file, ofname)
+
+
+def _convert_worker(task):
+    return convert(*task)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='convert_envoMatch',
+                                     description='Convert the ms1 scans in mzML, mzXML or ms1 files to memory-mapped '
+                                                 'ms1store files. Use the stores with envoMatch --file_type ms1store.')
+    parser.add_argument('-t', '--file_type', choices=FILE_TYPES, default=None,
+                        help='Input file type. By default it is determined from the file extension.')
+    parser.add_argument('-o', '--out_dir', default=None,
+                        help='Directory to write stores to. By default each store is written next to its input file.')
+    parser.add_argument('--overwrite', action='store_true', default=False,
+                        help='Convert files even if their store is up to date.')
+    parser.add_argument('--nThread', type=int, default=None,
+                        help='Number of files to convert in parallel. By default all cpus are used.')
+    parser.add_argument('files', nargs='+', help='Files to convert.')
+    args = parser.parse_args()
+
+    if args.out_dir is not None and not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+
+    tasks = [(f, _get_ofname(f, args.out_dir), _get_file_type(f, args.file_type), args.overwrite) for f in args.files]
+    nThread = min(len(tasks), cpu_count() if args.nThread is None else args.nThread)
+    if nThread > 1:
+        with Pool(processes=nThread) as pool:
+            results = pool.map(_convert_worker, tasks)
+    else:
+        results = [_convert_worker(t) for t in tasks]
+
+    for task, nScan in zip(tasks, results):
+        if nScan is None:
+            sys.stdout.write('{} is up to date.\n'.format(task[1]))
+        else:
+            sys.stdout.write('Wrote {} ms1 scans to {}\n'.format(nScan, task[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,16 +2,16 @@
 import sys
 import os
 import argparse
+import time
+import cProfile
 from multiprocessing import Pool
 from multiprocessing import cpu_count
+from multiprocessing.util import Finalize
 import functools
+from math import isnan
 
-from tqdm import tqdm
-import pandas as pd
-import matplotlib.pyplot as plt
-from pyteomics.mass import Composition
-from numpy import isnan
-
+# pandas, tqdm, pyteomics and matplotlib are imported where they are used,
+# so --help and worker processes which do not need them start quickly.
 from . import modules as src
 
 def parseArgs():
@@ -41,20 +41,121 @@ def parseArgs():
     return args
 
 
-def read_pep_stats(fname, formula_source):
-    pep_stats = pd.read_csv(fname, sep='\t')
-    #pep_stats = pep_stats[pep_stats['is_modified'].apply(bool)]
-    pep_stats.reset_index(inplace=True, drop=True)
-
+def _check_pep_stats(pep_stats, formula_source):
     if formula_source == 'input':
         if 'formula' not in pep_stats.columns:
             raise RuntimeError('Missing "formula" column. '
                                'Use "--formula_source calculate" if you want '
                                'to calculate peptide formulas in place.')
 
+
+def read_pep_stats(fname, formula_source, chunksize=None):
+    '''
+    Read input file.
+
+    If chunksize is not None, an iterator over DataFrames with
+    at most chunksize rows is returned instead of a single DataFrame.
+    '''
+
+    if chunksize is not None:
+        return _iter_pep_stats(fname, formula_source, chunksize)
+
+    import pandas as pd
+    pep_stats = pd.read_csv(fname, sep='\t')
+    #pep_stats = pep_stats[pep_stats['is_modified'].apply(bool)]
+    pep_stats.reset_index(inplace=True, drop=True)
+    _check_pep_stats(pep_stats, formula_source)
+
     return pep_stats
 
 
+def _iter_pep_stats(fname, formula_source, chunksize):
+    import pandas as pd
+    for chunk in pd.read_csv(fname, sep='\t', chunksize=chunksize):
+        _check_pep_stats(chunk, formula_source)
+        yield chunk
+
+
+def read_parent_files(fname, chunksize):
+    '''
+    Get the unique parent files and number of rows in fname
+    without reading the whole file into memory.
+
+    Returns
+    -------
+    parent_files: list
+        Unique parent files in the order they first appear.
+    nRow: int
+        Number of rows.
+    '''
+    import pandas as pd
+    parent_files = dict()
+    nRow = 0
+    for chunk in pd.read_csv(fname, sep='\t', usecols=['parent_file'], chunksize=chunksize):
+        for f in chunk['parent_file'].unique():
+            parent_files[f] = None
+        nRow += len(chunk.index)
+    return list(parent_files.keys()), nRow
+
+
+def _unique_scans(chunks):
+    '''
+    Get the sorted unique scans for each parent file in an iterable of DataFrames.
+    '''
+    scans = dict()
+    for chunk in chunks:
+        for parent_file, group in chunk.groupby('parent_file', sort=False)['scan']:
+            scans.setdefault(parent_file, set()).update(int(x) for x in group)
+    return {k: sorted(v) for k, v in scans.items()}
+
+
+def read_scans(fname, chunksize):
+    '''
+    Get the unique scans for each parent file in fname
+    without reading the whole file into memory.
+
+    Returns
+    -------
+    scans: dict
+        Sorted list of scans for each parent file.
+    '''
+    import pandas as pd
+    return _unique_scans(pd.read_csv(fname, sep='\t', usecols=['parent_file', 'scan'], chunksize=chunksize))
+
+
+def get_ms1_file_names(parent_files, input_file, ms1_prefix, file_type, verbose=False):
+    '''
+    Find the ms1 file for each parent file.
+
+    The directory of input_file is searched first, then each directory in ms1_prefix.
+
+    Returns
+    -------
+    ms1_file_names: dict
+        Path to ms1 file for each parent file.
+    '''
+    ms1_file_names = dict()
+    ms1_prefix = [os.path.dirname(os.path.abspath(input_file))] + list(ms1_prefix or [])
+
+    # Get ms1 file paths by checking canidate_paths.
+    for f in parent_files:
+        canidate_paths = ['{}/{}.{}'.format(x, os.path.splitext(f)[0], file_type) for x in ms1_prefix]
+        path_temp = None
+        for c in canidate_paths:
+            if os.path.isfile(c):
+                if verbose:
+                    sys.stdout.write('Found ms1 file for {}!\n\t{}\n'.format(f, c))
+                path_temp = c
+                break
+
+        if path_temp is None:
+            raise RuntimeError('Could not find parent ms1 file for {}!'.format(f))
+        else:
+            ms1_file_names[f] = path_temp
+
+    return ms1_file_names
+
+
 def _mkdir(path):
     if not os.path.isdir(path):
         sys.stdout.write('Creating {} ...'.format(path))
@@ -62,9 +163,13 @@ def _mkdir(path):
         sys.stdout.write('Done!\n')
 
 
-def write_pep_stats(dat, ifname, overwrite = False):
+def get_ofname(ifname, overwrite = False):
     s = os.path.splitext(ifname)
-    base = '{}{}{}'.format(s[0], '_env' if not overwrite else '', s[1])
+    return '{}{}{}'.format(s[0], '_env' if not overwrite else '', s[1])
+
+
+def write_pep_stats(dat, ifname, overwrite = False):
+    base = get_ofname(ifname, overwrite=overwrite)
     sys.stdout.write('\nWriting {}\n'.format(base))
     dat.to_csv(base, sep = '\t', index = False)
 
@@ -81,112 +186,813 @@ def make_of_seq(seq, mod_str = '*'):
     return ret
 
 
-def _annotate_ms1(row, ms1_files=None, args=None, atom_table=None):
+# Per-process state for envelope matching workers.
+# Populated once per worker by _init_worker so tasks only need to carry row data.
+_WORKER_STATE = dict()
 
-    # check that required args are supplied
-    assert sum([0 if x is None else 1 for x in [ms1_files, args, atom_table]]) == 3
-    ret = False
-    _verbose = args.verbose
+
+def _init_profiling(args):
+    '''
+    Enable stage profiling and cProfile in a worker process if requested.
+    '''
+    if args.profile:
+        # Forked workers inherit the timings already collected by the main process.
+        src.PROFILER.reset()
+        src.PROFILER.enable()
+    if args.profile_dump is not None:
+        profile = cProfile.Profile()
+        profile.enable()
+        # Pool workers run finalizers when they exit after pool.close().
+        Finalize(profile, _dump_profile, args=(profile, args.profile_dump), exitpriority=10)
+
+
+def _dump_profile(profile, dirname):
+    profile.disable()
+    profile.dump_stats(os.path.join(dirname, 'worker_{}.prof'.format(os.getpid())))
+
+
+def _worker_report():
+    return {'env_cache': _WORKER_STATE['env_cache'].drain(),
+            'profile': src.PROFILER.drain() if src.PROFILER.enabled else None}
+
+
+def _merge_worker_report(report, env_cache):
+    env_cache.merge(report['env_cache'])
+    if report['profile'] is not None:
+        src.PROFILER.merge(report['profile'])
+
+
+def _open_ms1_file(fname, args, scans=None):
+    '''
+    Read ms1 file.
+
+    With --pre_scan_src reference, the precursors of `scans` are resolved
+    so search workers do not each have to resolve them.
+    '''
+    ms1_file = src.Ms1File(fname=fname, file_type=args.file_type,
+                           build_precursor_list=(args.pre_scan_src == 'ms1'),
+                           precursor_refs=(args.pre_scan_src == 'reference'),
+                           index_cache=bool(args.index_cache),
+                           fast_headers=bool(args.fast_headers))
+    for scan in scans or []:
+        try:
+            ms1_file.get_precursor_scan(scan)
+        except KeyError:
+            # Reported when the row is searched.
+            pass
+    if _neighbour_mode(args):
+        # The ms1 scan list is built once here instead of in each worker.
+        ms1_file.ms1_scans()
+        ms1_file.spectrum_cache_size = _spectrum_cache_size(ms1_file, args)
+    return ms1_file
+
+
+def _neighbour_mode(args):
+    return args.neighbour_scans > 0 or args.neighbour_rt is not None
+
+
+def _spectrum_cache_size(ms1_file, args):
+    '''
+    Get the number of decoded spectra each process should keep for ms1_file.
+
+    Twice the largest neighbour window, so when rows are processed in scan order
+    each scan is decoded once by each process.
+    '''
+    import numpy as np
+
+    if args.neighbour_rt is None:
+        return 2 * (2 * args.neighbour_scans + 1)
+    rts = ms1_file.retention_times()
+    if len(rts) == 0:
+        return 0
+    window = np.searchsorted(rts, rts + args.neighbour_rt, side='right') - \
+             np.searchsorted(rts, rts - args.neighbour_rt, side='left')
+    return 2 * int(window.max())
+
+
+def _get_neighbour_scans(ms1_file, pre_scan, args):
+    '''
+    Get the ms1 scans around pre_scan which are searched with --neighbour_scans or --neighbour_rt.
+
+    Returns
+    -------
+        List of scans, not including pre_scan. Empty if neither option is set.
+    '''
+    if not _neighbour_mode(args):
+        return []
+    return [x for x in ms1_file.get_neighbour_scans(pre_scan, n_scans=args.neighbour_scans,
+                                                    rt_window=args.neighbour_rt) if x != pre_scan]
+
+
+def _read_ms1_file(task, args):
+    '''
+    Read ms1 file in a worker process.
+
+    Parameters
+    ----------
+    task: tuple
+        Tuple of (fname, scans) passed to _open_ms1_file.
+
+    Returns
+    -------
+        Tuple of (Ms1File, profile report)
+    '''
+    ms1_file = _open_ms1_file(task[0], args, task[1])
+    return ms1_file, src.PROFILER.drain() if src.PROFILER.enabled else None
+
+
+def _init_worker(ms1_files, args, atom_table, env_cache, columns, plot_selection=None):
+    '''
+    Pool initializer for envelope matching workers.
+
+    Each worker opens its own indexed readers for the ms1 files the first time it reads them.
+    The scan and precursor maps built by the main process are reused.
+    With --shared_spectra, spectra are read from shared memory so the ms1 files are not opened.
+    '''
+    _init_profiling(args)
+    for f in ms1_files.values():
+        f.detach()
+    _WORKER_STATE['ms1_files'] = ms1_files
+    _WORKER_STATE['args'] = args
+    _WORKER_STATE['atom_table'] = atom_table
+    _WORKER_STATE['env_cache'] = env_cache
+    _WORKER_STATE['columns'] = columns
+    _WORKER_STATE['plot_selection'] = plot_selection
+
+
+def _annotate_ms1_worker(task):
+    row = dict(zip(_WORKER_STATE['columns'], task))
+    result = _annotate_ms1(row,
+                           ms1_files=_WORKER_STATE['ms1_files'],
+                           args=_WORKER_STATE['args'],
+                           atom_table=_WORKER_STATE['atom_table'],
+                           env_cache=_WORKER_STATE['env_cache'],
+                           plot_selection=_WORKER_STATE['plot_selection'])
+    return result, _worker_report()
+
+
+def _attach_spectrum_block(descriptor):
+    '''
+    Attach to the shared spectrum block with descriptor.
+    Workers stay attached to the last block until a task for a new block arrives.
+    '''
+    block = _WORKER_STATE.get('spectrum_block')
+    if block is None or block.name != descriptor[0]:
+        if block is not None:
+            block.close()
+        block = src.SpectrumBlock.attach(descriptor)
+        _WORKER_STATE['spectrum_block'] = block
+    return block
+
+
+def _annotate_ms1_group_worker(task):
+    pre_scan, tasks, slot, neighbour_slots, block_descriptor = task
+    rows = [dict(zip(_WORKER_STATE['columns'], x)) for x in tasks]
+    spectrum = None
+    neighbours = None
+    if block_descriptor is not None:
+        block = _attach_spectrum_block(block_descriptor)
+        spectrum = block.get_arrays(slot)
+        neighbours = [block.get_arrays(x) for x in neighbour_slots]
+    results = _annotate_ms1_group(rows, pre_scan, spectrum=spectrum, neighbours=neighbours,
+                                  ms1_files=_WORKER_STATE['ms1_files'],
+                                  args=_WORKER_STATE['args'],
+                                  atom_table=_WORKER_STATE['atom_table'],
+                                  env_cache=_WORKER_STATE['env_cache'],
+                                  plot_selection=_WORKER_STATE['plot_selection'])
+    return results, _worker_report()
+
+
+def _get_plot_pool(pool, args, nThread, show_bar):
+    '''
+    Get the pool used to render plots. The pool is created on the first call.
+    '''
+    if pool is None and show_bar and nThread > 1:
+        pool = Pool(processes=nThread, initializer=_init_profiling, initargs=(args,))
+    return pool
+
+
+def _render_worker(render, task):
+    return render(task), src.PROFILER.drain() if src.PROFILER.enabled else None
+
+
+def _task_columns(args):
+    '''
+    Get the input columns needed by _annotate_ms1.
+    '''
+    cols = ['parent_file', 'scan', 'sequence', 'charge']
+    if args.formula_source == 'input':
+        cols.append('formula')
+    if args.pre_scan_src == 'input':
+        cols.append('precursor_scan')
+    return cols
+
+
+def _get_chunksize(nTask, nThread, max_chunksize=100):
+    '''
+    Get the number of tasks to send to a worker at once.
+
+    Uses the same heuristic as Pool.map, capped at max_chunksize
+    so the progress bar is still updated regularly.
+    '''
+    chunksize, extra = divmod(nTask, nThread * 4)
+    if extra:
+        chunksize += 1
+    return max(1, min(chunksize, max_chunksize))
+
+
+def _calc_envelopes(row, args, atom_table, env_cache=None):
+    '''
+    Calculate the theoretical envelope and monoisotopic m/z of each
+    unmodified/modified variant of the peptide in `row`.
+
+    Returns
+    -------
+    sequence: str
+        Upper case peptide sequence.
+    sequences: list
+        Variant sequences with 0 to n modifications removed.
+    envs: dict
+        Theoretical envelope for each variant.
+    mono_mzs: dict
+        Monoisotopic m/z for each variant.
+    '''
+
+    from pyteomics.mass import Composition
 
     #get cit and arg envelopes
     mono_mzs = dict()
     envs = dict()
-    charge = row['charge']
     sequence = row['sequence'].upper()
     sequences = [sequence.replace('*', '', x) for x in range(0, sequence.count('*') + 1)]
+    charge = row['charge']
+
+    # the compositions and masses of all variants are calculated at once
+    if args.formula_source == 'calculate':
+        compositions = atom_table.getCompositions(sequences, charge)
+        mono_masses = atom_table.getMasses(compositions=compositions, charges=0)
+    else:
+        mod_diffs = atom_table.getCompositions(['*' * i for i in range(len(sequences))], 0, nTerm=False, cTerm=False)
+
     for sequences_i, s in enumerate(sequences):
         if args.formula_source == 'calculate':
-            comp_temp = atom_table.getComposition(s, row['charge'])
+            comp_temp = atom_table.toComposition(compositions[sequences_i])
+            mono_mass = mono_masses[sequences_i]
         else:
-            mod_diff = atom_table.getComposition(''.join(['*' for _ in range(sequences_i)]), 0, nTerm=False, cTerm=False)
-            comp_temp = Composition(formula=src.utils.formula_to_pyteomics_formula(row['formula'], charge=row['charge']))
-            comp_temp -= mod_diff
+            comp_temp = Composition(formula=src.utils.formula_to_pyteomics_formula(row['formula'], charge=charge))
+            comp_temp -= atom_table.toComposition(mod_diffs[sequences_i])
+            mono_mass = atom_table.getMass(composition=comp_temp, charge=0)
 
-        envs[s] = src.getEnvelope(comp_temp, threshold = 0.01)
-        mono_mass = atom_table.getMass(composition=comp_temp, charge=0)
-        charge = row['charge']
+        envs[s] = src.getEnvelope(comp_temp, threshold = 0.01, cache=env_cache, engine=args.env_engine)
         mono_mzs[s] = (mono_mass + (charge * src.AtomTable._atom_masses['H'])) / charge
 
-    if args.pre_scan_src == 'ms1':
+    return sequence, sequences, envs, mono_mzs
+
+
+def _get_mz_range(mono_mzs):
+    return (min(mono_mzs.values()) - 5, max(mono_mzs.values()) + 5)
+
+
+def _get_precursor_scan(row, ms1_file, args):
+    if args.pre_scan_src != 'input':
         try:
-            pre_scan_tmp = ms1_files[row['parent_file']].get_precursor_scan(row['scan'])
+            return ms1_file.get_precursor_scan(row['scan'])
         except KeyError as e:
             sys.stderr.write('Error in row: {}\n{}'.format(e, row))
-            pre_scan_tmp = 'SCAN_NOT_FOUND_IN_PRECURSOR_LIST'
+            return 'SCAN_NOT_FOUND_IN_PRECURSOR_LIST'
+    return row['precursor_scan']
+
+
+def _score_neighbours(specs, sequences, envs, mono_mzs, args):
+    '''
+    Score the theoretical envelopes of each variant in the precursor scan and its neighbouring scans.
+
+    With --neighbour_score best, the score of each variant is its best score in any scan.
+    With --neighbour_score sum, the intensity matched to each theoretical peak is summed
+    over all scans (like an extracted ion chromatogram of each isotope) and the summed
+    intensities are scored.
+
+    Parameters
+    ----------
+    specs: list
+        Spectrum dicts of the precursor scan followed by the neighbouring scans.
+
+    Returns
+    -------
+    scores: dict
+        Aggregated score of each sequence.
+    links: dict
+        Array returned by matchPeaks for each sequence in specs[spec_index].
+    spec_index: int
+        Index of the spectrum to plot. The scan where the input sequence has its
+        best score with --neighbour_score best, otherwise the precursor scan.
+    '''
+    import numpy as np
+
+    lengths = [len(envs[s]) for s in sequences]
+    offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.intp)
+    theoretical_mz = np.array([x[0] for s in sequences for x in envs[s]])
+    theoretical_int = np.array([x[1] for s in sequences for x in envs[s]])
+    mono_mz = [mono_mzs[s] for s in sequences]
+
+    results = [src.scoreEnvelopes(spec['mz'], spec['int'], theoretical_mz, theoretical_int, offsets=offsets,
+                                  mono_mz=mono_mz, sequences=sequences) for spec in specs]
+
+    spec_index = 0
+    if args.neighbour_score == 'best':
+        scan_scores = np.array([x[0] for x in results])
+        aggregated = np.fmax.reduce(scan_scores, axis=0)
+        # sequences[0] is the input sequence
+        if not np.isnan(scan_scores[:, 0]).all():
+            spec_index = int(np.nanargmax(scan_scores[:, 0]))
     else:
-        pre_scan_tmp = row['precursor_scan']
-    spec = ms1_files[row['parent_file']].get_spectra(pre_scan_tmp,
-                                                     (min(mono_mzs.values()) - 5,
-                                                      max(mono_mzs.values()) + 5))
+        summed = np.zeros(len(theoretical_mz))
+        for spec, (_, links) in zip(specs, results):
+            links = np.concatenate(links)
+            linked = links >= 0
+            summed[linked] += spec['int'][links[linked]]
+        aggregated = src.scoreMatched(theoretical_int, summed, offsets)
 
-    if spec is None:
-        if _verbose:
-            sys.stderr.write('Scan: {} not found in {}\n'.format(row['precursor_scan'], row['parent_file']))
-        return 'ERROR: Spectrum not found!', 0
+    return dict(zip(sequences, aggregated)), dict(zip(sequences, results[spec_index][1])), spec_index
+
+
+def _match_envelopes(row, spec, envelopes, args, plot_selection=None, neighbours=None):
+    '''
+    Score the theoretical envelopes of each variant against `spec`.
+
+    Parameters
+    ----------
+    row: dict
+        Input row.
+    spec: dict
+        Dict with arrays for mz and int returned by Ms1File.get_spectra.
+    envelopes: tuple
+        Tuple returned by _calc_envelopes.
+    args: argparse.Namespace
+        Command line arguments.
+    plot_selection: PlotSelection
+        If not None, records are only made for selected rows.
+    neighbours: list
+        Spectrum dicts of the neighbouring ms1 scans to score with _score_neighbours.
+
+    Returns
+    -------
+    (good_envelope, env_score) or (good_envelope, env_score, record) if args.plotEnv is set
+    and the row is selected. The record is rendered later by _render_plots.
+    '''
+
+    ret = False
+    sequence, sequences, envs, mono_mzs = envelopes
+
+    if neighbours:
+        specs = [spec] + neighbours
+        scores, links, spec_index = _score_neighbours(specs, sequences, envs, mono_mzs, args)
+        spec = specs[spec_index]
+    else:
+        batch_scores, batch_links = src.scoreEnvelopes(spec['mz'], spec['int'],
+                                                       [[x[0] for x in envs[s]] for s in sequences],
+                                                       [[x[1] for x in envs[s]] for s in sequences],
+                                                       mono_mz=[mono_mzs[s] for s in sequences], sequences=sequences)
+        scores = dict(zip(sequences, batch_scores))
+        links = dict(zip(sequences, batch_links))
 
-    consensus = dict()
-    best_score = 0
     best_index = None
-    min_mz = sys.float_info.max
-    max_mz = 0
+    best_score = 0
     for j, s in enumerate(sequences):
-        env = [src.DataPoint(mz, k) for mz, k in envs[s]]
-        spec_temp = [src.DataPoint(mz, k) for mz, k in zip(spec['mz'], spec['int'])]
+        if scores[s] > best_score:
+            best_score = scores[s]
+            best_index = j
+    if best_index is not None:
+        ret = sequences[best_index] == sequence and best_score >= args.env_co
 
-        consensus[s] = src.ConsensusEnvelope(spec_temp, env, sequence=s)
-        consensus[s].set_mono(mono_mz=mono_mzs[s])
-        consensus[s].annotate(remove_unlabeled=False, verbose=_verbose)
+    if not args.plotEnv:
+        return ret, scores[sequence]
+    if plot_selection is not None and not plot_selection.selected(row, ret, scores[sequence]):
+        return ret, scores[sequence]
 
-        if consensus[s].envScore > best_score:
-            best_score = consensus[s].envScore
-            best_index = j
-        min_mz = min(min_mz, envs[s][0][0])
-        max_mz = max(max_mz, envs[s][-1][0])
+    record = src.makeMatchRecord(row, spec['mz'], spec['int'], sequences, envs, mono_mzs, links, scores,
+                                 best_index, ret, scores[sequence],
+                                 mz_step_margin=args.mz_step_margin)
+    return ret, scores[sequence], record
 
-    goodEnvTemp = False
-    if best_index is not None:
-        goodEnvTemp = sequences[best_index] == sequence and best_score >= args.env_co
-    ret = goodEnvTemp
 
-    if args.plotEnv:
-        fig, ax = plt.subplots(len(sequences), 1, sharex=True)
-        fig.set_size_inches(6.4, 2.4 * len(sequences))
-        for k, s in enumerate(sequences):
-            if len(sequences) == 1:
-                ax_temp = ax
-            else:
-                ax_temp = ax[k]
-            consensus[s].plotEnv(ax_temp, isBest=(k == best_index))
+def _plot_ofname(record, args, ext):
+    good_bad_temp = ''
+    if args.splitPlots:
+        good_bad_temp = 'good' if record['good_envelope'] else 'bad'
+    return '{}/envelopes/{}/{}_{}_{}_{}.{}'.format(os.getcwd(), good_bad_temp,
+                                                   os.path.splitext(record['parent_file'])[0],
+                                                   make_of_seq(record['sequence']),
+                                                   record['scan'],
+                                                   record['charge'], ext)
+
 
-        plt.xlabel('m/z')
-        mult = args.mz_step_margin
-        plt.xlim(min_mz - (mult / charge) * mult, max_mz + (mult / charge) * mult)
+def _get_plot_tasks(records, args, suffix=''):
+    '''
+    Get (records, ofname) tasks for plotting.
 
+    Parameters
+    ----------
+    records: list
+        Match records returned by _match_envelopes.
+    suffix: str
+        Suffix added to multi-page pdf names.
+
+    Returns
+    -------
+    render: function
+        Either src.plotting.renderRecord or src.plotting.renderMultipage.
+    tasks: list
+    '''
+
+    if args.plot_format != 'multipdf':
+        return src.plotting.renderRecord, [(r, _plot_ofname(r, args, args.plot_format)) for r in records]
+
+    # one pdf per parent file (and good/bad group if args.splitPlots)
+    groups = dict()
+    for r in records:
         good_bad_temp = ''
         if args.splitPlots:
-            good_bad_temp = 'good' if ret else 'bad'
-        path_temp = '{}/envelopes/{}'.format(os.getcwd(), good_bad_temp)
-        ofname = '{}/{}_{}_{}_{}.pdf'.format(path_temp,
-                                             os.path.splitext(row['parent_file'])[0],
-                                             make_of_seq(row['sequence']),
-                                             row['scan'],
-                                             row['charge'])
+            good_bad_temp = 'good' if r['good_envelope'] else 'bad'
+        groups.setdefault((r['parent_file'], good_bad_temp), list()).append(r)
+    tasks = list()
+    for (parent_file, good_bad_temp), group in groups.items():
+        ofname = '{}/envelopes/{}/{}{}.pdf'.format(os.getcwd(), good_bad_temp,
+                                                   os.path.splitext(parent_file)[0], suffix)
+        tasks.append((group, ofname))
+    return src.plotting.renderMultipage, tasks
+
+
+def _render_plots(records, args, pool=None, nThread=1, suffix='', show_bar=True):
+    '''
+    Render match records.
+
+    Parameters
+    ----------
+    records: list
+        Match records returned by _match_envelopes.
+    pool: multiprocessing.Pool
+        Pool initialized with _init_profiling. If None, plots are rendered in this process.
+    suffix: str
+        Suffix added to multi-page pdf names.
+    show_bar: bool
+        Show progress bar?
+
+    Returns
+    -------
+    n_plot: int
+        Number of records rendered.
+    '''
+
+    render, tasks = _get_plot_tasks(records, args, suffix=suffix)
+    if len(tasks) == 0:
+        return 0
 
+    sys.stdout.write('\nPlotting {} envelope(s) to {} file(s) using {} thread(s)...\n'.format(
+        len(records), len(tasks), 1 if pool is None else min(nThread, len(tasks))))
+    if pool is None:
+        for task in tasks:
+            if args.verbose:
+                sys.stdout.write('Creating {}...'.format(task[1]))
+            render(task)
+            if args.verbose:
+                sys.stdout.write('Done\n')
+    else:
+        results = pool.imap_unordered(functools.partial(_render_worker, render), tasks,
+                                      chunksize=_get_chunksize(len(tasks), nThread))
+        if show_bar:
+            from tqdm import tqdm
+            results = tqdm(results, total=len(tasks), miniters=1, file=sys.stdout)
+        for _, report in results:
+            if report is not None:
+                src.PROFILER.merge(report)
+
+    return len(records)
+
+
+def _annotate_ms1(row, ms1_files=None, args=None, atom_table=None, env_cache=None, plot_selection=None):
+
+    # check that required args are supplied
+    assert sum([0 if x is None else 1 for x in [ms1_files, args, atom_table]]) == 3
+
+    envelopes = _calc_envelopes(row, args, atom_table, env_cache)
+    ms1_file = ms1_files[row['parent_file']]
+    pre_scan_tmp = _get_precursor_scan(row, ms1_file, args)
+    mz_range = _get_mz_range(envelopes[3])
+    spec = ms1_file.get_spectra(pre_scan_tmp, mz_range)
+
+    if spec is None:
         if args.verbose:
-            sys.stdout.write('Creating {}...'.format(ofname))
+            sys.stderr.write('Scan: {} not found in {}\n'.format(pre_scan_tmp, row['parent_file']))
+        return 'ERROR: Spectrum not found!', 0
+
+    neighbours = [ms1_file.get_spectra(x, mz_range) for x in _get_neighbour_scans(ms1_file, pre_scan_tmp, args)]
+    return _match_envelopes(row, spec, envelopes, args, plot_selection,
+                            neighbours=[x for x in neighbours if x is not None])
+
+
+def _annotate_ms1_group(rows, pre_scan, ms1_files=None, args=None, atom_table=None, env_cache=None,
+                        plot_selection=None, spectrum=None, neighbours=None):
+    '''
+    Annotate a group of rows which share the same parent file and precursor scan.
+
+    The precursor spectrum is only read and decoded once for the whole group.
 
-        plt.savefig(ofname)
-        plt.close('all')
+    Parameters
+    ----------
+    rows: list
+        List of input rows (dicts). All rows must have the same parent_file.
+    pre_scan: int
+        Precursor scan shared by all rows.
+    spectrum: tuple
+        Sorted (mz, int) arrays of pre_scan. If None, the spectrum is read from ms1_files.
+    neighbours: list
+        Sorted (mz, int) arrays of the neighbouring scans returned by _get_neighbour_scans.
+        If None, they are read from ms1_files.
 
+    Returns
+    -------
+    results: list
+        Result of _match_envelopes for each row in the same order as `rows`.
+    '''
+
+    assert sum([0 if x is None else 1 for x in [ms1_files, args, atom_table]]) == 3
+
+    parent_file = rows[0]['parent_file']
+    envelopes = [_calc_envelopes(row, args, atom_table, env_cache) for row in rows]
+    mz_ranges = [_get_mz_range(x[3]) for x in envelopes]
+    if spectrum is None:
+        specs = ms1_files[parent_file].get_spectra_windows(pre_scan, mz_ranges)
+    else:
+        specs = src.Ms1File.windows(*spectrum, mz_ranges)
+
+    if specs is None:
         if args.verbose:
-            sys.stdout.write('Done\n')
+            sys.stderr.write('Scan: {} not found in {}\n'.format(pre_scan, parent_file))
+        return [('ERROR: Spectrum not found!', 0) for _ in rows]
+
+    if neighbours is None:
+        neighbours = [ms1_files[parent_file].get_spectra(x, None)
+                      for x in _get_neighbour_scans(ms1_files[parent_file], pre_scan, args)]
+        neighbours = [(x['mz'], x['int']) for x in neighbours if x is not None]
+    # windows of each neighbouring scan for each row
+    neighbour_specs = [src.Ms1File.windows(*x, mz_ranges) for x in neighbours]
+    neighbour_specs = [list(x) for x in zip(*neighbour_specs)] if neighbour_specs else [[] for _ in rows]
+
+    return [_match_envelopes(row, spec, envelope, args, plot_selection, neighbours=row_neighbours)
+            for row, spec, envelope, row_neighbours in zip(rows, specs, envelopes, neighbour_specs)]
+
 
-    return ret, consensus[sequence].envScore
+def _group_by_scan(rows, ms1_files, args):
+    '''
+    Group rows by (parent_file, precursor scan).
+
+    Returns
+    -------
+    groups: list
+        List of (pre_scan, row_indices) tuples in order of first appearance.
+    '''
+    groups = dict()
+    for i, row in enumerate(rows):
+        pre_scan = _get_precursor_scan(row, ms1_files[row['parent_file']], args)
+        groups.setdefault((row['parent_file'], pre_scan), list()).append(i)
+    groups = [(k, v) for k, v in groups.items()]
+    if _neighbour_mode(args):
+        # Groups with overlapping neighbour windows are processed one after the other
+        # so their spectra are still in the spectrum cache.
+        groups.sort(key=lambda x: _scan_sort_key(*x[0]))
+    return [(k[1], v) for k, v in groups]
+
+
+def _scan_sort_key(parent_file, scan):
+    try:
+        return parent_file, 0, int(scan)
+    except (TypeError, ValueError):
+        return parent_file, 1, 0
+
+
+def _share_spectra(groups, parent_files, ms1_files, args):
+    '''
+    Decode the precursor spectrum of each group and the spectra of its neighbouring scans
+    into a shared memory block. Each scan is only decoded and stored once.
+
+    Parameters
+    ----------
+    groups: list
+        List of (pre_scan, row_indices) tuples returned by _group_by_scan.
+    parent_files: list
+        Parent file of each group.
+
+    Returns
+    -------
+    block: SpectrumBlock
+        Block which should be unlinked after the groups are finished.
+    slots: list
+        Index of the spectrum of each group in block or None if the spectrum was not found.
+    neighbour_slots: list
+        List with the index of the spectrum of each neighbouring scan which was found for each group.
+    '''
+    spectra = list()
+    scan_slots = dict()
+
+    def _slot(parent_file, scan):
+        key = (parent_file, scan)
+        if key not in scan_slots:
+            spec = ms1_files[parent_file].get_spectra(scan, None)
+            if spec is None:
+                scan_slots[key] = None
+            else:
+                scan_slots[key] = len(spectra)
+                spectra.append((spec['mz'], spec['int']))
+        return scan_slots[key]
+
+    slots = list()
+    neighbour_slots = list()
+    for (pre_scan, _), parent_file in zip(groups, parent_files):
+        slot = _slot(parent_file, pre_scan)
+        slots.append(slot)
+        neighbour_slots.append(list())
+        if slot is not None:
+            for scan in _get_neighbour_scans(ms1_files[parent_file], pre_scan, args):
+                neighbour_slot = _slot(parent_file, scan)
+                if neighbour_slot is not None:
+                    neighbour_slots[-1].append(neighbour_slot)
+    return src.SpectrumBlock.create(spectra), slots, neighbour_slots
+
+
+def _search_envelopes(pep_stats, ms1_files, args, atom_table, env_cache,
+                      pool=None, nThread=1, bar=None, row_offset=0, nRow_total=None,
+                      checkpoint=None, plot_selection=None):
+    '''
+    Search for envelopes for each row in pep_stats.
+
+    Parameters
+    ----------
+    pool: multiprocessing.Pool
+        Pool initialized with _init_worker. If None, rows are processed in this process.
+    bar: tqdm.tqdm
+        Progress bar to update.
+    row_offset: int
+        Index of the first row in pep_stats in the input file.
+    nRow_total: int
+        Total number of rows. Only used for progress messages.
+    checkpoint: Checkpoint
+        If not None, rows already in checkpoint are skipped and
+        newly completed rows are added to it.
+    plot_selection: PlotSelection
+        Passed to _match_envelopes when rows are processed in this process.
+
+    Returns
+    -------
+    env_data: list
+        Result of _match_envelopes for each row.
+    '''
+
+    nRow = len(pep_stats.index)
+    nRow_total = nRow if nRow_total is None else nRow_total
+    task_cols = _task_columns(args)
+    input_lst = list(pep_stats[task_cols].itertuples(index=False, name=None))
+
+    # The first 3 task columns are parent_file, scan and sequence.
+    env_data = [None for _ in range(nRow)]
+    if checkpoint is not None:
+        for i, task in enumerate(input_lst):
+            env_data[i] = checkpoint.get(row_offset + i, *task[:3])
+    todo = [i for i in range(nRow) if env_data[i] is None]
+    if bar is not None:
+        bar.update(nRow - len(todo))
+
+    def _set_result(i, result):
+        env_data[i] = result
+        if checkpoint is not None:
+            checkpoint.add(row_offset + i, *input_lst[i][:3], result)
+
+    if args.schedule == 'scan':
+        groups = _group_by_scan([dict(zip(task_cols, input_lst[i])) for i in todo], ms1_files, args)
+        groups = [(pre_scan, [todo[i] for i in indices]) for pre_scan, indices in groups]
+        if args.verbose:
+            sys.stdout.write('Found {} unique precursor scans.\n'.format(len(groups)))
+
+    if pool is not None:
+        # Workers get ms1 files, args and atom_table once through the initializer.
+        # Tasks only carry the input columns needed for each row.
+        if args.schedule == 'scan':
+            block = None
+            slots = [None for _ in groups]
+            neighbour_slots = [None for _ in groups]
+            if args.shared_spectra:
+                block, slots, neighbour_slots = _share_spectra(groups, [input_lst[x[1][0]][0] for x in groups],
+                                                               ms1_files, args)
+                # Groups without a spectrum are not sent to workers.
+                for (pre_scan, indices), slot in zip(groups, slots):
+                    if slot is None:
+                        if args.verbose:
+                            sys.stderr.write('Scan: {} not found in {}\n'.format(pre_scan, input_lst[indices[0]][0]))
+                        for i in indices:
+                            _set_result(i, ('ERROR: Spectrum not found!', 0))
+                        if bar is not None:
+                            bar.update(len(indices))
+                groups = [x for x, slot in zip(groups, slots) if slot is not None]
+                neighbour_slots = [x for x, slot in zip(neighbour_slots, slots) if slot is not None]
+                slots = [x for x in slots if x is not None]
+            block_descriptor = None if block is None else block.descriptor
+            group_tasks = [(pre_scan, [input_lst[i] for i in indices], slot, group_neighbour_slots, block_descriptor)
+                           for (pre_scan, indices), slot, group_neighbour_slots in zip(groups, slots, neighbour_slots)]
+            try:
+                for (_, indices), (results, report) in zip(groups, pool.imap(_annotate_ms1_group_worker, group_tasks,
+                                                                             chunksize=_get_chunksize(len(groups), nThread))):
+                    for i, result in zip(indices, results):
+                        _set_result(i, result)
+                    _merge_worker_report(report, env_cache)
+                    if bar is not None:
+                        bar.update(len(indices))
+            finally:
+                if block is not None:
+                    block.close()
+                    block.unlink()
+        else:
+            for i, (result, report) in zip(todo, pool.imap(_annotate_ms1_worker, [input_lst[i] for i in todo],
+                                                           chunksize=_get_chunksize(len(todo), nThread))):
+                _set_result(i, result)
+                _merge_worker_report(report, env_cache)
+                if bar is not None:
+                    bar.update(1)
+    else:
+        rows = [dict(zip(task_cols, x)) for x in input_lst]
+        if args.schedule == 'scan':
+            n_done = nRow - len(todo)
+            for pre_scan, indices in groups:
+                sys.stdout.write('\tWorking on {} of {}\r'.format(row_offset + n_done, nRow_total))
+                sys.stdout.flush()
+                results = _annotate_ms1_group([rows[i] for i in indices], pre_scan, ms1_files, args, atom_table,
+                                              env_cache, plot_selection)
+                for i, result in zip(indices, results):
+                    _set_result(i, result)
+                n_done += len(indices)
+        else:
+            for i in todo:
+                sys.stdout.write('\tWorking on {} of {}\r'.format(row_offset + i, nRow_total))
+                sys.stdout.flush()
+                _set_result(i, _annotate_ms1(rows[i], ms1_files, args, atom_table, env_cache, plot_selection))
+
+    if checkpoint is not None:
+        checkpoint.flush()
+
+    return env_data
+
+
+def _get_records(env_data):
+    '''
+    Get the match records from the results of _search_envelopes.
+    Rows which were read from a checkpoint or where no spectrum was found do not have a record.
+    '''
+    return [x[2] for x in env_data if len(x) > 2]
+
+
+def _add_env_columns(pep_stats, env_data):
+    '''
+    Add good_envelope and env_score columns to pep_stats and arrange columns.
+    '''
+
+    pep_stats['good_envelope'] = [x[0] for x in env_data]
+    pep_stats['env_score'] = ['NA' if isnan(x[1]) else x[1] for x in env_data]
+
+    #arrange columns
+    cols = list(pep_stats.columns)
+    order_cols = ['contains_Cit', 'env_score', 'good_envelope']
+    if 'contains_Cit' in cols:
+        cit_index = cols.index('contains_Cit')
+        col_order = [cols[x] for x in range(cit_index) if cols[x] not in order_cols]
+        col_order += order_cols
+        col_order += [x for x in cols if x not in col_order]
+        pep_stats = pep_stats[col_order]
+
+    return pep_stats
 
 
 def main():
     args = parseArgs()
 
+    # Starting a new run would truncate the checkpoint of an interrupted run.
+    checkpoint_fname = '{}.checkpoint'.format(get_ofname(args.input_file, overwrite=args.overwrite))
+    if args.checkpoint_interval > 0 and not args.resume and os.path.exists(checkpoint_fname):
+        raise RuntimeError('Checkpoint file {} from an interrupted run already exists! '
+                           'Use --resume to finish the run, or remove the checkpoint file '
+                           'to start over.'.format(checkpoint_fname))
+
+    from tqdm import tqdm
+    start_time = time.perf_counter()
+    if args.profile_dump is not None:
+        args.profile = True
+        args.profile_dump = os.path.abspath(args.profile_dump)
+        _mkdir(args.profile_dump)
+    if args.profile:
+        src.PROFILER.enable()
+    main_profile = None
+    if args.profile_dump is not None:
+        main_profile = cProfile.Profile()
+        main_profile.enable()
+
     # calc nThread
     _nThread = args.nThread
     if args.parallel and args.nThread is None:
@@ -196,95 +1002,199 @@ def main():
     _show_bar = not(args.verbose and args.parallel == 0)
 
     #done once
-    pep_stats = read_pep_stats(args.input_file, args.formula_source)
-    pep_stats['good_envelope'] = False
+    if args.chunk_size is None:
+        pep_stats = read_pep_stats(args.input_file, args.formula_source)
+        pep_stats['good_envelope'] = False
+        parent_files = pep_stats['parent_file'].unique()
+        nRow = len(pep_stats.index)
+    else:
+        if args.chunk_size < 1:
+            raise RuntimeError('--chunk_size must be > 0!')
+        parent_files, nRow = read_parent_files(args.input_file, args.chunk_size)
+
+    requested_scans = dict()
+    if args.pre_scan_src == 'reference':
+        if args.chunk_size is None:
+            requested_scans = _unique_scans([pep_stats])
+        else:
+            requested_scans = read_scans(args.input_file, args.chunk_size)
 
     atom_table = src.AtomTable(args.atom_table)
     if not atom_table.read():
         sys.exit()
 
-    ms1_file_names = dict()
-    ms1_prefix = [os.path.dirname(os.path.abspath(args.input_file))] + args.ms1_prefix
+    env_cache = src.EnvelopeCache(maxsize=args.env_cache_size, track_new=args.env_cache is not None)
+    if args.env_cache is not None and os.path.isfile(args.env_cache):
+        if env_cache.read(args.env_cache):
+            sys.stdout.write('Read {} envelopes from {}\n'.format(len(env_cache), args.env_cache))
 
-    # Get ms1 file paths by checking canidate_paths.
-    for f in pep_stats['parent_file'].unique():
-        canidate_paths = ['{}/{}.{}'.format(x, os.path.splitext(f)[0], args.file_type) for x in ms1_prefix]
-        path_temp = None
-        for c in canidate_paths:
-            if os.path.isfile(c):
-                if args.verbose:
-                    sys.stdout.write('Found ms1 file for {}!\n\t{}\n'.format(f, c))
-                path_temp = c
-                break
-
-        if path_temp is None:
-            raise RuntimeError('Could not find parent ms1 file for {}!'.format(f))
-        else:
-            ms1_file_names[f] = path_temp
+    ms1_file_names = get_ms1_file_names(parent_files, args.input_file, args.ms1_prefix, args.file_type,
+                                        verbose=args.verbose)
 
     # Actually read files.
     sys.stdout.write('\nReading ms1 files using {} thread(s)...\n'.format(min(_nThread, len(ms1_file_names))))
     if _show_bar:
-        with Pool(processes=min(_nThread, len(ms1_file_names))) as pool:
-            ms1_files = list(tqdm(pool.imap(functools.partial(src.Ms1File, file_type=args.file_type,
-                                                              build_precursor_list=(args.pre_scan_src == 'ms1')),
-                                            ms1_file_names.values()),
+        pool = Pool(processes=min(_nThread, len(ms1_file_names)),
+                    initializer=_init_profiling, initargs=(args,))
+        try:
+            ms1_files = list(tqdm(pool.imap(functools.partial(_read_ms1_file, args=args),
+                                            [(v, requested_scans.get(k)) for k, v in ms1_file_names.items()]),
                                   total=len(ms1_file_names),
                                   miniters=1,
                                   file=sys.stdout))
-        ms1_files = dict(zip(ms1_file_names.keys(), ms1_files))
+        except BaseException:
+            pool.terminate()
+            raise
+        pool.close()
+        pool.join()
+        for _, report in ms1_files:
+            if report is not None:
+                src.PROFILER.merge(report)
+        ms1_files = dict(zip(ms1_file_names.keys(), [x[0] for x in ms1_files]))
     else:
         ms1_files = dict()
         for k, path in ms1_file_names.items():
             sys.stdout.write('\tReading {}...\n'.format(path))
-            ms1_files[k] = src.Ms1File(fname=path, file_type=args.file_type,
-                                       build_precursor_list=(args.pre_scan_src == 'ms1'))
+            ms1_files[k] = _open_ms1_file(path, args, requested_scans.get(k))
             sys.stdout.write('\tDone!\n')
 
+    plot_selection = None
+    sampler = None
     if args.plotEnv:
+        plot_selection = src.PlotSelection(envelopes=args.plot_select,
+                                           score_range=args.plot_score_range,
+                                           rows=None if args.plot_rows is None else src.PlotSelection.readRows(args.plot_rows))
+        if args.plot_sample is not None:
+            sampler = src.RecordSampler(args.plot_sample, seed=args.plot_seed)
         path_temp = '{}/envelopes'.format(os.getcwd())
         _mkdir(path_temp)
         if args.splitPlots:
             for s in ['good', 'bad']:
                 _mkdir('{}/{}'.format(path_temp, s))
 
-    nRow = len(pep_stats.index)
+    checkpoint = None
+    if args.checkpoint_interval > 0:
+        checkpoint = src.Checkpoint(checkpoint_fname, interval=args.checkpoint_interval)
+        if args.resume:
+            n_completed = checkpoint.read()
+            sys.stdout.write('\nFound {} completed rows in {}\n'.format(n_completed, checkpoint.fname))
+        checkpoint.open()
+    elif args.resume:
+        raise RuntimeError('--resume requires --checkpoint_interval > 0')
+    if args.neighbour_scans < 0:
+        raise RuntimeError('--neighbour_scans must be >= 0!')
+    if args.neighbour_rt is not None and args.neighbour_rt <= 0:
+        raise RuntimeError('--neighbour_rt must be > 0!')
+    if args.shared_spectra:
+        if args.schedule != 'scan':
+            raise RuntimeError('--shared_spectra requires --schedule scan')
+        if not src.SpectrumBlock.available():
+            raise RuntimeError('--shared_spectra requires python 3.8 or later')
+        src.SpectrumBlock.startTracker()
+
     sys.stdout.write('\nSearching for envelopes using {} thread(s)...\n'.format(min(_nThread, nRow)))
-    env_data = list()
+    pool = None
+    plot_pool = None
+    n_plot = 0
+    bar = None
     if _show_bar:
-        input_lst = [x[1] for x in pep_stats.iterrows()]
-        with Pool(processes=_nThread) as pool:
-            env_data = list(tqdm(pool.imap(functools.partial(_annotate_ms1,
-                                                             ms1_files=ms1_files,
-                                                             args=args,
-                                                             atom_table=atom_table),
-                                           input_lst),
-                                 total=nRow,
-                                 miniters=1,
-                                 file=sys.stdout))
-    else:
-        for i, row in pep_stats.iterrows():
-            sys.stdout.write('\tWorking on {} of {}\r'.format(i, nRow))
-            sys.stdout.flush()
-            env_data.append(_annotate_ms1(row, ms1_files, args, atom_table))
+        pool = Pool(processes=_nThread, initializer=_init_worker,
+                    initargs=(ms1_files, args, atom_table, env_cache, _task_columns(args), plot_selection))
+        bar = tqdm(total=nRow, miniters=1, file=sys.stdout)
+    try:
+        if args.chunk_size is None:
+            env_data = _search_envelopes(pep_stats, ms1_files, args, atom_table, env_cache,
+                                         pool=pool, nThread=_nThread, bar=bar, checkpoint=checkpoint,
+                                         plot_selection=plot_selection)
+            pep_stats = _add_env_columns(pep_stats, env_data)
+            if sampler is not None:
+                sampler.add(_get_records(env_data))
+            elif args.plotEnv:
+                records = _get_records(env_data)
+        else:
+            # Results are appended to a temporary file as each chunk is finished
+            # so the input file can also be the output file.
+            ofname = get_ofname(args.input_file, overwrite=args.overwrite)
+            tmp_ofname = '{}.tmp'.format(ofname)
+            row_offset = 0
+            for chunk in read_pep_stats(args.input_file, args.formula_source, chunksize=args.chunk_size):
+                env_data = _search_envelopes(chunk, ms1_files, args, atom_table, env_cache,
+                                             pool=pool, nThread=_nThread, bar=bar,
+                                             row_offset=row_offset, nRow_total=nRow,
+                                             checkpoint=checkpoint, plot_selection=plot_selection)
+                chunk = _add_env_columns(chunk, env_data)
+                if sampler is not None:
+                    sampler.add(_get_records(env_data))
+                elif args.plotEnv:
+                    # multi-page pdfs are written for each chunk so all records do not have to be kept in memory.
+                    plot_pool = _get_plot_pool(plot_pool, args, _nThread, _show_bar)
+                    n_plot += _render_plots(_get_records(env_data), args, pool=plot_pool, nThread=_nThread,
+                                            suffix='_{}'.format(row_offset // args.chunk_size + 1), show_bar=False)
+                chunk.to_csv(tmp_ofname, sep='\t', index=False,
+                             mode='w' if row_offset == 0 else 'a',
+                             header=(row_offset == 0))
+                row_offset += len(chunk.index)
+    except BaseException:
+        for p in (pool, plot_pool):
+            if p is not None:
+                p.terminate()
+        if checkpoint is not None:
+            checkpoint.close()
+        raise
+    for p in (pool, plot_pool):
+        if p is not None:
+            p.close()
+            p.join()
+    if bar is not None:
+        bar.close()
 
-    pep_stats['good_envelope'] = [x[0] for x in env_data]
-    pep_stats['env_score'] = ['NA' if isnan(x[1]) else x[1] for x in env_data]
+    # Plots are rendered after scoring is finished so the scoring workers are not kept alive.
+    if sampler is not None:
+        records = sampler.records()
+    if args.plotEnv and (args.chunk_size is None or sampler is not None):
+        plot_pool = _get_plot_pool(None, args, _nThread, _show_bar)
+        try:
+            n_plot += _render_plots(records, args, pool=plot_pool, nThread=_nThread)
+        except BaseException:
+            if plot_pool is not None:
+                plot_pool.terminate()
+            raise
+        if plot_pool is not None:
+            plot_pool.close()
+            plot_pool.join()
 
-    #arrange columns
-    cols = list(pep_stats.columns)
-    order_cols = ['contains_Cit', 'env_score', 'good_envelope']
-    if 'contains_Cit' in cols:
-        cit_index = cols.index('contains_Cit')
-        col_order = [cols[x] for x in range(cit_index) if cols[x] not in order_cols]
-        col_order += order_cols
-        col_order += [x for x in cols if x not in col_order]
-        pep_stats = pep_stats[col_order]
+    n_lookup = env_cache.hits + env_cache.misses
+    sys.stdout.write('\nEnvelope cache: {} hits, {} misses ({:.1f}% hit rate)\n'.format(env_cache.hits, env_cache.misses,
+                                                                                    0 if n_lookup == 0 else env_cache.hits / n_lookup * 100))
+    if args.env_cache is not None:
+        sys.stdout.write('Writing {} envelopes to {}\n'.format(len(env_cache), args.env_cache))
+        env_cache.write(args.env_cache)
 
     sys.stdout.write('\nDone!\n')
-    write_pep_stats(pep_stats, args.input_file, overwrite=args.overwrite)
+    if args.chunk_size is None:
+        write_pep_stats(pep_stats, args.input_file, overwrite=args.overwrite)
+    else:
+        sys.stdout.write('\nWriting {}\n'.format(ofname))
+        os.replace(tmp_ofname, ofname)
+
+    # The checkpoint is no longer needed once the output file is written.
+    if checkpoint is not None:
+        checkpoint.remove()
+
+    if main_profile is not None:
+        main_profile.disable()
+        main_profile.dump_stats(os.path.join(args.profile_dump, 'main_{}.prof'.format(os.getpid())))
+    if args.profile:
+        profile_fname = '{}.profile.json'.format(os.path.splitext(get_ofname(args.input_file, overwrite=args.overwrite))[0])
+        sys.stdout.write('Writing {}\n'.format(profile_fname))
+        src.PROFILER.write(profile_fname,
+                           wall_seconds=time.perf_counter() - start_time,
+                           nRow=nRow, nThread=_nThread, nPlot=n_plot,
+                           ms1_mb=sum(os.path.getsize(x) for x in ms1_file_names.values()) / 1024 ** 2,
+                           nMs1File=len(ms1_file_names), nCpu=os.cpu_count(),
+                           env_cache={'hits': env_cache.hits, 'misses': env_cache.misses},
+                           args=vars(args))
 
 
 if __name__ == "__main__":
     main()
-
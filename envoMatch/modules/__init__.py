@@ -1,6 +1,46 @@
 
-from .atom_table import AtomTable, getEnvelope
-from .ms1 import Ms1File
-from .consensusEnvelope import ConsensusEnvelope, DataPoint, Isotope
+import importlib
+
 from .parent_parser import PARENT_PARSER
+from .profiling import PROFILER
+
+# Everything else is imported on first use so importing envoMatch
+# (ie. for --help or run_envoMatch) does not load numpy, pandas, pyteomics or matplotlib.
+_LAZY_ATTRIBUTES = {'AtomTable': 'atom_table',
+                    'EnvelopeCache': 'atom_table',
+                    'getEnvelope': 'atom_table',
+                    'getAggregatedEnvelope': 'isotope_distribution',
+                    'Ms1File': 'ms1',
+                    'Ms1Store': 'ms1store',
+                    'SpectrumBlock': 'shared_spectra',
+                    'ConsensusEnvelope': 'consensusEnvelope',
+                    'DataPoint': 'consensusEnvelope',
+                    'Isotope': 'consensusEnvelope',
+                    'Spectrum': 'consensusEnvelope',
+                    'TheoreticalEnvelope': 'consensusEnvelope',
+                    'annotateArrays': 'consensusEnvelope',
+                    'matchPeaks': 'consensusEnvelope',
+                    'scoreEnvelopes': 'consensusEnvelope',
+                    'scoreMatched': 'consensusEnvelope',
+                    'Checkpoint': 'checkpoint',
+                    'makeMatchRecord': 'plotting',
+                    'PlotSelection': 'plotting',
+                    'RecordSampler': 'plotting'}
+
+_SUBMODULES = {'atom_table', 'isotope_distribution', 'ms1', 'ms1store', 'shared_spectra', 'consensusEnvelope',
+               'checkpoint', 'plotting', 'utils'}
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        value = getattr(importlib.import_module('.{}'.format(_LAZY_ATTRIBUTES[name]), __name__), name)
+    elif name in _SUBMODULES:
+        value = importlib.import_module('.{}'.format(name), __name__)
+    else:
+        raise AttributeError('module {} has no attribute {}'.format(__name__, name))
+    globals()[name] = value
+    return value
+
 
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES) | _SUBMODULES)
@@ -1,13 +1,20 @@
 
 import sys
+import os
+import pickle
 from typing import Dict
-from collections import Counter
+from collections import Counter, OrderedDict
+import numpy as np
 from sortedcontainers import SortedList
 
 from pyteomics.mass import Composition
 from pyteomics.mass.mass import isotopologues
 
 from .utils import inRange, find_nearest_index
+from .isotope_distribution import getAggregatedEnvelope
+from .profiling import PROFILER
+
+ENVELOPE_ENGINES = ('isotopologues', 'convolution')
 
 
 DEFAULT_COMPOSITIONS = {'A': Counter({'C': 3, 'H': 5, 'O': 1, 'N': 1}),
@@ -39,6 +46,7 @@ DEFAULT_COMPOSITIONS = {'A': Counter({'C': 3, 'H': 5, 'O': 1, 'N': 1}),
 class AtomTable:
     _nTermStr = 'N_term'
     _cTermStr = 'C_term'
+    _chargeStr = 'H+'
 
     _atom_masses = {"C": 12,
                     "H": 1.00783,
@@ -57,6 +65,14 @@ class AtomTable:
     def __init__(self, fname: str=None):
         self.fname = fname
         self.compositions = dict()
+        self._reset_compiled()
+
+    def _reset_compiled(self):
+        self.elements = None
+        self.residues = None
+        self.composition_matrix = None
+        self.element_masses = None
+        self._residue_lookup = None
 
     def _cleanLine(self, line):
         elems = [y for y in [x.strip() for x in line.split('\t')] if y and y[:1] != ';']
@@ -64,6 +80,7 @@ class AtomTable:
 
 
     def _read(self):
+        self._reset_compiled()
         if self.fname is None:
             self.compositions = DEFAULT_COMPOSITIONS
             return
@@ -106,6 +123,115 @@ class AtomTable:
         return True
 
 
+    def compile(self):
+        '''
+        Compile the atom table into arrays used to calculate compositions and masses
+        of many sequences at once.
+
+        Sets elements (element symbols in column order, with 'H+' last), residues
+        (single character residues in row order), composition_matrix (integer matrix of
+        element counts with a row for each residue and the N and C terminus) and
+        element_masses (monoisotopic mass of each element or nan if it is unknown).
+        '''
+
+        elements = list()
+        for comp in self.compositions.values():
+            for e in comp:
+                if e not in elements and e != AtomTable._chargeStr:
+                    elements.append(e)
+        elements.append(AtomTable._chargeStr)
+
+        self.residues = [k for k in self.compositions if len(k) == 1 and ord(k) < 256]
+        rows = self.residues + [AtomTable._nTermStr, AtomTable._cTermStr]
+        self.composition_matrix = np.zeros((len(rows), len(elements)), dtype=np.int64)
+        for i, k in enumerate(rows):
+            for e, count in self.compositions.get(k, dict()).items():
+                self.composition_matrix[i, elements.index(e)] = count
+        self.element_masses = np.array([self._atom_masses.get(e, np.nan) for e in elements])
+        self.elements = elements
+
+        self._residue_lookup = np.full(256, -1, dtype=np.intp)
+        for i, k in enumerate(self.residues):
+            self._residue_lookup[ord(k)] = i
+
+    def getCompositions(self, sequences, charges=0,
+                        nTerm=True, cTerm=True) -> np.ndarray:
+        '''
+        Calculate the compositions of many sequences at once.
+
+        The same as getComposition for each sequence, but the residues of all sequences
+        are counted together and multiplied by the compiled composition matrix.
+
+        :param sequences: List of peptide sequences.
+        :param charges: Charge of each sequence or a single charge for all sequences.
+        :param nTerm: Should the N terminus be added?
+        :param cTerm: Should the C terminus be added?
+        :return: Integer array of element counts with a row for each sequence and
+        a column for each element in self.elements.
+        :raises KeyError: If a sequence has a residue which is not in the atom table.
+        '''
+
+        if self.composition_matrix is None:
+            self.compile()
+
+        lengths = np.array([len(x) for x in sequences], dtype=np.intp)
+        try:
+            codes = np.frombuffer(''.join(sequences).encode('latin-1'), dtype=np.uint8)
+        except UnicodeEncodeError as e:
+            raise KeyError(e.object[e.start])
+        rows = self._residue_lookup[codes]
+        if (rows < 0).any():
+            raise KeyError(chr(codes[np.flatnonzero(rows < 0)[0]]))
+
+        nResidue = len(self.residues)
+        counts = np.bincount(np.repeat(np.arange(len(sequences)), lengths) * nResidue + rows,
+                             minlength=len(sequences) * nResidue).reshape(len(sequences), nResidue)
+        ret = counts @ self.composition_matrix[:nResidue]
+        if nTerm:
+            ret += self.composition_matrix[nResidue]
+        if cTerm:
+            ret += self.composition_matrix[nResidue + 1]
+
+        charges = np.broadcast_to(np.asarray(charges, dtype=np.int64), (len(sequences),))
+        ret[:, -1] = np.where(charges != 0, charges, ret[:, -1])
+        return ret
+
+    def getMasses(self, sequences=None, compositions: np.ndarray=None,
+                  charges=0, nTerm=True, cTerm=True) -> np.ndarray:
+        '''
+        Calculate the mass of many sequences or compositions at once.
+
+        Function accepts `sequences` xor `compositions`.
+
+        :param sequences: List of peptide sequences.
+        :param compositions: Array returned by getCompositions.
+        :param charges: Charge of each sequence or a single charge for all sequences.
+        If None, the 'H+' column of compositions is used, else specified charges are used.
+        :return: Array with the mass of each sequence.
+        '''
+
+        if sum([1 for x in [sequences, compositions] if x is not None]) != 1:
+            raise RuntimeError('Either sequences xor compositions must be specified')
+
+        if sequences is not None:
+            compositions = self.getCompositions(sequences, 0 if charges is None else charges, nTerm, cTerm)
+        elif charges is not None:
+            if self.composition_matrix is None:
+                self.compile()
+            compositions = np.array(compositions)
+            compositions[:, -1] = charges
+
+        used = (compositions != 0).any(axis=0)
+        if np.isnan(self.element_masses[used]).any():
+            raise KeyError(self.elements[np.flatnonzero(used & np.isnan(self.element_masses))[0]])
+        return compositions @ np.where(used, self.element_masses, 0)
+
+    def toComposition(self, counts) -> Composition:
+        '''
+        Convert a row of the array returned by getCompositions to a Composition.
+        '''
+        return Composition({e: int(n) for e, n in zip(self.elements, counts) if n != 0})
+
     def _getComposition(self, seq: str, charge=0,
                        nTerm=True, cTerm=True):
 
@@ -147,9 +273,9 @@ class AtomTable:
             raise RuntimeError('Either seq xor composition must be specified')
 
         if seq is not None:
-            _comp = self.getComposition(seq, nTerm, cTerm, 0 if charge is None else charge)
+            return float(self.getMasses([seq], charges=0 if charge is None else charge, nTerm=nTerm, cTerm=cTerm)[0])
         else:
-            _comp = composition
+            _comp = dict(composition)
             if charge is not None:
                 _comp['H+'] = charge
 
@@ -203,10 +329,174 @@ class AverageIsotope():
             return 0
 
 
+class EnvelopeCache():
+    '''
+    LRU cache of theoretical envelopes calculated by getEnvelope.
+
+    Envelopes are keyed on the canonical composition (which includes the charge as 'H+'),
+    threshold, mass_defect_match_range, combineDefects and the envelope engine.
+    '''
+
+    _FILE_VERSION = 4
+
+    # Fields of the keys returned by makeKey. Stored in cache files so entries
+    # with keys made by a different version of makeKey are not used.
+    _KEY_FORMAT = ('composition', 'threshold', 'mass_defect_match_range', 'combineDefects', 'engine')
+
+    def __init__(self, maxsize: int=100000, track_new: bool=False):
+        '''
+        :param maxsize: Maximum number of envelopes to keep.
+        :param track_new: Should envelopes added since the last call to drain be tracked?
+        This is used to send new envelopes from worker processes back to the main process.
+        '''
+        self.maxsize = maxsize
+        self.track_new = track_new
+        self.hits = 0
+        self.misses = 0
+        self._dat = OrderedDict()
+        self._new = dict()
+
+    @staticmethod
+    def makeKey(composition, threshold, mass_defect_match_range, combineDefects,
+                engine='isotopologues') -> tuple:
+        comp = tuple(sorted((k, v) for k, v in composition.items() if v != 0))
+        return (comp, threshold, mass_defect_match_range, combineDefects, engine)
+
+    def __len__(self):
+        return len(self._dat)
+
+    def get(self, key):
+        '''
+        Get envelope for key. Returns None if key is not in cache.
+        '''
+        try:
+            value = self._dat[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._dat.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._add(key, value)
+        if self.track_new:
+            self._new[key] = value
+
+    def _add(self, key, value):
+        self._dat[key] = value
+        self._dat.move_to_end(key)
+        while len(self._dat) > self.maxsize:
+            self._dat.popitem(last=False)
+
+    def drain(self) -> dict:
+        '''
+        Get hit and miss counts and new envelopes since the last call, then reset them.
+        '''
+        ret = {'hits': self.hits, 'misses': self.misses, 'new': self._new}
+        self.hits = 0
+        self.misses = 0
+        self._new = dict()
+        return ret
+
+    def merge(self, report: dict):
+        '''
+        Add counts and new envelopes from a report returned by drain.
+        '''
+        self.hits += report['hits']
+        self.misses += report['misses']
+        for k, v in report['new'].items():
+            self._add(k, v)
+
+    def read(self, fname: str) -> bool:
+        '''
+        Read cached envelopes from fname.
+
+        Files which can not be read, were written by a different version or
+        have keys in a different format are ignored with a warning.
+
+        :return: False if the file could not be read.
+        '''
+        try:
+            with open(fname, 'rb') as inF:
+                dat = pickle.load(inF)
+        except Exception as e:
+            sys.stderr.write('WARN: Could not read envelope cache {}\n\t{}: {}\n'.format(fname, type(e).__name__, e))
+            return False
+        if not isinstance(dat, dict) or dat.get('version') != EnvelopeCache._FILE_VERSION or \
+                tuple(dat.get('key_format', ())) != EnvelopeCache._KEY_FORMAT:
+            sys.stderr.write('WARN: Ignoring envelope cache {} written by a different version.\n'.format(fname))
+            return False
+
+        try:
+            envelopes = [(k, v) for k, v in dat['envelopes']
+                         if isinstance(k, tuple) and len(k) == len(EnvelopeCache._KEY_FORMAT)]
+        except (KeyError, TypeError, ValueError) as e:
+            sys.stderr.write('WARN: Could not read envelope cache {}\n\t{}: {}\n'.format(fname, type(e).__name__, e))
+            return False
+        for k, v in envelopes:
+            self._add(k, v)
+        return True
+
+    def write(self, fname: str):
+        '''
+        Write cached envelopes to fname.
+        '''
+        tmp_fname = '{}.{}.tmp'.format(fname, os.getpid())
+        with open(tmp_fname, 'wb') as outF:
+            pickle.dump({'version': EnvelopeCache._FILE_VERSION,
+                         'key_format': EnvelopeCache._KEY_FORMAT,
+                         'envelopes': list(self._dat.items())}, outF)
+        os.replace(tmp_fname, fname)
+
+
 def getEnvelope(composition: Composition,
                 threshold: float=1e-3,
                 mass_defect_match_range: float=0.05,
-                combineDefects=True) -> list:
+                combineDefects=True,
+                cache: EnvelopeCache=None,
+                engine: str='isotopologues') -> list:
+    '''
+    Calculate the theoretical isotopic envelope of composition.
+
+    :param composition: Composition with charge as 'H+'.
+    :param threshold: Minimum isotopologue abundance.
+    :param mass_defect_match_range: Isotopologues within this m/z range are averaged.
+    :param combineDefects: Should mass defects be combined?
+    :param cache: Optional envelope cache.
+    :param engine: 'isotopologues' enumerates individual isotopologues and combines mass defects.
+    'convolution' gives the same peaks with getAggregatedEnvelope, which groups isotopologues
+    by nominal mass (mass_defect_match_range and combineDefects are ignored).
+    :return: List of (mz, abundance) tuples.
+    '''
+
+    if engine == 'isotopologues':
+        def _calc():
+            return _getEnvelope(composition, threshold=threshold,
+                                mass_defect_match_range=mass_defect_match_range,
+                                combineDefects=combineDefects)
+    elif engine == 'convolution':
+        def _calc():
+            return getAggregatedEnvelope(composition, threshold=threshold)
+    else:
+        raise ValueError('{} is an invalid envelope engine!'.format(engine))
+
+    with PROFILER.stage('getEnvelope'):
+        if cache is not None:
+            key = EnvelopeCache.makeKey(composition, threshold, mass_defect_match_range, combineDefects, engine)
+            ret = cache.get(key)
+            if ret is None:
+                ret = tuple(_calc())
+                cache.put(key, ret)
+            return list(ret)
+
+        return _calc()
+
+
+def _getEnvelope(composition: Composition,
+                 threshold: float=1e-3,
+                 mass_defect_match_range: float=0.05,
+                 combineDefects=True) -> list:
 
     #get all isotopologues with reasonable abundance
     temp = list()
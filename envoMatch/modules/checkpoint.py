@@ -0,0 +1,132 @@
+
+import sys
+import os
+import csv
+from math import isnan
+
+_HEADERS = ['row', 'parent_file', 'scan', 'sequence', 'good_envelope', 'env_score']
+
+
+class Checkpoint(object):
+    '''
+    Record completed rows so an interrupted run can be resumed.
+
+    Each completed row is stored with its row index, parent_file, scan and sequence.
+    A stored result is only reused if all four match the input row.
+    '''
+
+    def __init__(self, fname, interval=1000):
+        '''
+        Parameters
+        ----------
+        fname: str
+            Path to checkpoint file.
+        interval: int
+            Number of completed rows to buffer before they are written to fname.
+        '''
+        self.fname = fname
+        self.interval = interval
+        self._completed = dict()
+        self._buffer = list()
+        self._outF = None
+        self._writer = None
+
+    @staticmethod
+    def _key(parent_file, scan, sequence):
+        return (str(parent_file), str(scan), str(sequence))
+
+    def read(self):
+        '''
+        Read completed rows from an existing checkpoint file.
+
+        Returns
+        -------
+        n_rows: int
+            Number of completed rows read.
+        '''
+        self._completed = dict()
+        if not os.path.isfile(self.fname):
+            return 0
+
+        with open(self.fname, 'r', newline='') as inF:
+            reader = csv.reader(inF, delimiter='\t')
+            headers = next(reader, None)
+            if headers != _HEADERS:
+                sys.stderr.write('WARN: Ignoring badly formed checkpoint file {}\n'.format(self.fname))
+                return 0
+            for line in reader:
+                # the last line can be incomplete if the process was killed while writing.
+                if len(line) != len(_HEADERS):
+                    continue
+                try:
+                    row = int(line[0])
+                    score = float('nan') if line[5] == 'NA' else float(line[5])
+                except ValueError:
+                    continue
+                good = {'True': True, 'False': False}.get(line[4], line[4])
+                self._completed[row] = (Checkpoint._key(*line[1:4]), (good, score))
+
+        return len(self._completed)
+
+    def get(self, row, parent_file, scan, sequence):
+        '''
+        Get the stored result for a row.
+
+        Returns
+        -------
+            Tuple of (good_envelope, env_score) or None if the row is not completed.
+        '''
+        try:
+            key, result = self._completed[row]
+        except KeyError:
+            return None
+        if key != Checkpoint._key(parent_file, scan, sequence):
+            return None
+        return result
+
+    def open(self):
+        '''
+        Open checkpoint file for writing.
+        Completed rows read from an existing file are written again.
+        '''
+        self._outF = open(self.fname, 'w', newline='')
+        self._writer = csv.writer(self._outF, delimiter='\t', lineterminator='\n')
+        self._writer.writerow(_HEADERS)
+        for row, (key, result) in sorted(self._completed.items()):
+            self._buffer.append([row] + list(key) + Checkpoint._format_result(result))
+        self.flush()
+
+    @staticmethod
+    def _format_result(result):
+        score = result[1]
+        return [str(result[0]), 'NA' if isnan(score) else repr(float(score))]
+
+    def add(self, row, parent_file, scan, sequence, result):
+        '''
+        Add a completed row.
+        '''
+        self._buffer.append([row, parent_file, scan, sequence] + Checkpoint._format_result(result))
+        if len(self._buffer) >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if self._outF is None:
+            return
+        self._writer.writerows(self._buffer)
+        self._buffer = list()
+        self._outF.flush()
+        os.fsync(self._outF.fileno())
+
+    def close(self):
+        self.flush()
+        if self._outF is not None:
+            self._outF.close()
+            self._outF = None
+
+    def remove(self):
+        '''
+        Close and delete the checkpoint file.
+        '''
+        self.close()
+        if os.path.isfile(self.fname):
+            os.remove(self.fname)
@@ -2,10 +2,9 @@
 from typing import List
 import sys
 import numpy as np
-import matplotlib.pyplot as plt
 import warnings
 
-from .utils import lower_bound, inRange
+from .profiling import PROFILER
 
 class Isotope(object):
     __slots__ = ['mz', 'int']
@@ -52,6 +51,84 @@ class DataPoint(object):
             out.write('\n')
 
 
+class Spectrum(object):
+    '''
+    Struct of arrays for the peaks of a spectrum.
+
+    Peaks are stored as one m/z and one intensity array instead of a DataPoint for each peak,
+    so a spectrum is a handful of arrays no matter how many peaks it has.
+    m/z values should be sorted.
+
+    The arrays are read only views of the input arrays, so one Spectrum can be shared
+    by any number of ConsensusEnvelope(s) without being copied or modified.
+    '''
+    __slots__ = ['mz', 'int']
+
+    def __init__(self, mz = (), intensity = ()):
+        self.mz = np.asarray(mz).view()
+        self.int = np.asarray(intensity).view()
+        self.mz.flags.writeable = False
+        self.int.flags.writeable = False
+        if len(self.mz) != len(self.int):
+            raise RuntimeError('mz and intensity arrays must be the same length!')
+
+    @classmethod
+    def fromDataPoints(cls, points):
+        '''
+        Build from a list of DataPoint(s).
+
+        :param points: List of DataPoint.
+        '''
+        return cls([x.point.mz for x in points], [x.point.int for x in points])
+
+    @classmethod
+    def fromPairs(cls, pairs):
+        '''
+        Build from a list of (mz, int) tuples, like the envelopes returned by getEnvelope.
+
+        :param pairs: List of (mz, int) tuples.
+        '''
+        pairs = np.asarray(pairs, dtype=float).reshape(-1, 2)
+        return cls(pairs[:, 0], pairs[:, 1])
+
+    def __len__(self):
+        return len(self.mz)
+
+    def __getitem__(self, i):
+        return Isotope(self.mz[i], self.int[i])
+
+    def take(self, indices):
+        '''
+        Get a new object with the peaks at indices.
+        '''
+        return type(self)(self.mz[indices], self.int[indices])
+
+
+class TheoreticalEnvelope(Spectrum):
+    '''
+    Struct of arrays for the peaks of a theoretical isotopic envelope.
+    '''
+    __slots__ = []
+
+    def findMono(self, mono_mz, getTolerance, sequence = None) -> int:
+        '''
+        Get the index of the monoisotopic peak. See findMonoIndex.
+        '''
+        return findMonoIndex(self.mz, mono_mz, getTolerance, sequence)
+
+
+def _asSpectrum(points, cls):
+    '''
+    Convert points to cls if they are not already a Spectrum.
+
+    :param points: Spectrum, list of DataPoint or None.
+    :param cls: Spectrum or TheoreticalEnvelope.
+    '''
+    if points is None or isinstance(points, Spectrum):
+        return points
+    return cls.fromDataPoints(points)
+
+
 def _getTolerance(toleranceType, _range):
     '''
     Get function to return m/z +- tolerance.
@@ -71,26 +148,297 @@ def _getTolerance(toleranceType, _range):
         raise ValueError('{} is a invalid argument for toleranceType'.format(toleranceType))
 
 
+def findMonoIndex(theoretical_mz, mono_mz, getTolerance, sequence=None) -> int:
+    '''
+    Get the index of the monoisotopic peak in a theoretical envelope.
+
+    :param theoretical_mz: Array of theoretical m/z values.
+    :param mono_mz: Monoisotopic m/z.
+    :param getTolerance: Function returned by _getTolerance.
+    :param sequence: Peptide sequence used in error message.
+    :raises RuntimeError: If there is not exactly one peak within tolerance of mono_mz.
+    '''
+
+    indices = np.flatnonzero(np.abs(np.asarray(theoretical_mz) - mono_mz) <= getTolerance(mono_mz))
+    if len(indices) != 1:
+        raise RuntimeError(f'Could not find mono_mz in theoretical env for sequence {sequence}!')
+    return int(indices[0])
+
+
+def matchPeaks(mz, intensity, theoretical_mz,
+               tolerance = 50, toleranceType = 'ppm',
+               best_match_tie = 'intensity'):
+    '''
+    Match each theoretical peak to the best peak in a spectrum.
+
+    Uses the same rules as ConsensusEnvelope.annotate. A spectrum peak is a candidate if it is
+    within the tolerance window of the theoretical peak. If there are multiple candidates,
+    the most intense (or highest m/z) is chosen with ties going to the first candidate.
+    Candidates with an intensity of 0 are not matched.
+
+    :param mz: Sorted array of spectrum m/z values.
+    :param intensity: Array of spectrum intensities.
+    :param theoretical_mz: Array of theoretical m/z values.
+    :param tolerance: Match tolerance.
+    :param toleranceType: Tolerance units, either ppm or th.
+    :param best_match_tie: How to choose between multiple matches. Either 'intensity' or 'mz'.
+    :return: Array with the index in `mz` of the peak matched to each theoretical peak or -1.
+    '''
+
+    getTolerance = _getTolerance(toleranceType, tolerance)
+    mz = np.asarray(mz)
+    intensity = np.asarray(intensity)
+    theoretical_mz = np.asarray(theoretical_mz, dtype=float)
+
+    links = np.full(len(theoretical_mz), -1, dtype=np.intp)
+    if len(mz) == 0 or len(theoretical_mz) == 0:
+        return links
+
+    tol = getTolerance(theoretical_mz)
+    lo = np.searchsorted(mz, theoretical_mz - tol, side='left')
+    hi = np.searchsorted(mz, theoretical_mz + tol, side='right')
+    width = int((hi - lo).max())
+    if width <= 0:
+        return links
+
+    # matrix of candidate indices for each theoretical peak
+    candidates = lo[:, None] + np.arange(width)[None, :]
+    valid = candidates < hi[:, None]
+    candidates = np.minimum(candidates, len(mz) - 1)
+    candidate_mz = mz[candidates]
+    valid &= np.abs(candidate_mz - theoretical_mz[:, None]) <= getTolerance(candidate_mz)
+
+    key = intensity[candidates] if best_match_tie == 'intensity' else candidate_mz
+    best = candidates[np.arange(len(candidates)), np.argmax(np.where(valid, key, -np.inf), axis=1)]
+    found = valid.any(axis=1) & (intensity[best] > 0)
+    links[found] = best[found]
+
+    return links
+
+
+def calcEnvScore(theoretical_int, intensity, links, normalize = True):
+    '''
+    Calculate the correlation between theoretical and matched spectrum intensities.
+
+    Normalization is the same as ConsensusEnvelope.annotate, but is not done in place.
+
+    :param theoretical_int: Array of theoretical intensities.
+    :param intensity: Array of spectrum intensities.
+    :param links: Array returned by matchPeaks.
+    :param normalize: Should intensities be normalized to 1 before the score is calculated?
+    :return: Pearson correlation coefficient.
+    '''
+
+    theoretical_int = np.asarray(theoretical_int, dtype=float)
+    intensity = np.asarray(intensity)
+    linked = links >= 0
+    matched = intensity[links[linked]]
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        if normalize:
+            if len(matched) > 0:
+                matched = matched / matched.max()
+            elif len(intensity) > 0:
+                matched = matched / intensity.max()
+            theoretical_int = theoretical_int / theoretical_int.max()
+
+        actual_int = np.zeros(len(theoretical_int))
+        actual_int[linked] = matched
+        return np.corrcoef(x = theoretical_int, y = actual_int)[0,1]
+
+
+def annotateArrays(mz, intensity, theoretical_mz, theoretical_int, mono_mz = None,
+                   tolerance = 50, toleranceType = 'ppm',
+                   best_match_tie = 'intensity', normalize = True,
+                   sequence = None):
+    '''
+    Array based equivalent of ConsensusEnvelope.set_mono and ConsensusEnvelope.annotate.
+
+    :param mz: Sorted array of spectrum m/z values.
+    :param intensity: Array of spectrum intensities.
+    :param theoretical_mz: Array of theoretical m/z values.
+    :param theoretical_int: Array of theoretical intensities.
+    :param mono_mz: Monoisotopic m/z. If not None, a RuntimeError is raised
+    if mono_mz is not found in the theoretical envelope.
+    :return: Tuple of (links, envScore). See matchPeaks.
+    '''
+
+    with PROFILER.stage('annotate'):
+        if mono_mz is not None:
+            findMonoIndex(theoretical_mz, mono_mz, _getTolerance(toleranceType, tolerance), sequence)
+
+        links = matchPeaks(mz, intensity, theoretical_mz, tolerance = tolerance,
+                           toleranceType = toleranceType, best_match_tie = best_match_tie)
+        return links, calcEnvScore(theoretical_int, intensity, links, normalize = normalize)
+
+
+def _concatEnvelopes(theoretical_mz, theoretical_int, offsets):
+    '''
+    Get flat theoretical arrays and offsets for a ragged batch of envelopes.
+    '''
+    if offsets is None:
+        lengths = [len(x) for x in theoretical_mz]
+        if len(lengths) == 0:
+            return np.zeros(0), np.zeros(0), np.zeros(1, dtype=np.intp)
+        offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.intp)
+        theoretical_mz = np.concatenate([np.asarray(x, dtype=float) for x in theoretical_mz])
+        theoretical_int = np.concatenate([np.asarray(x, dtype=float) for x in theoretical_int])
+    else:
+        offsets = np.asarray(offsets, dtype=np.intp)
+        theoretical_mz = np.asarray(theoretical_mz, dtype=float)
+        theoretical_int = np.asarray(theoretical_int, dtype=float)
+    if len(theoretical_mz) != len(theoretical_int) or offsets[-1] != len(theoretical_mz):
+        raise RuntimeError('Theoretical m/z and intensity arrays do not match offsets!')
+    return theoretical_mz, theoretical_int, offsets
+
+
+def _segmentReduce(ufunc, values, starts, nonempty, fill):
+    '''
+    Apply ufunc.reduceat to each segment of values. Empty segments are set to fill.
+    '''
+    ret = np.full(len(nonempty), fill, dtype=float)
+    if len(values) > 0:
+        ret[nonempty] = ufunc.reduceat(values, starts)
+    return ret
+
+
+def scoreEnvelopes(mz, intensity, theoretical_mz, theoretical_int, offsets = None,
+                   mono_mz = None, tolerance = 50, toleranceType = 'ppm',
+                   best_match_tie = 'intensity', normalize = True,
+                   sequences = None):
+    '''
+    Score a batch of theoretical envelopes against one spectrum.
+
+    Peaks are matched with the same tolerance and tie rules as matchPeaks
+    and each score is the same as calcEnvScore for that envelope. All envelopes
+    are matched and scored together, so the cost per envelope is a few array operations.
+
+    The batch is either a list of arrays for each envelope, or flat arrays of all
+    envelopes with `offsets`, where envelope i is theoretical_mz[offsets[i]:offsets[i + 1]].
+
+    :param mz: Sorted array of spectrum m/z values.
+    :param intensity: Array of spectrum intensities.
+    :param theoretical_mz: List of theoretical m/z arrays or flat array if offsets is given.
+    :param theoretical_int: List of theoretical intensity arrays or flat array if offsets is given.
+    :param offsets: Array with the start of each envelope in the flat arrays followed by their length.
+    :param mono_mz: Array with the monoisotopic m/z of each envelope. If not None,
+    a RuntimeError is raised if any mono_mz is not found in its envelope.
+    :param tolerance: Match tolerance.
+    :param toleranceType: Tolerance units, either ppm or th.
+    :param best_match_tie: How to choose between multiple matches. Either 'intensity' or 'mz'.
+    :param normalize: Should intensities be normalized to 1 before scores are calculated?
+    :param sequences: Sequence of each envelope used in error messages.
+    :return: Tuple of (scores, links). scores is an array with the score of each envelope.
+    links is a list with the array returned by matchPeaks for each envelope.
+    '''
+
+    with PROFILER.stage('annotate'):
+        theoretical_mz, theoretical_int, offsets = _concatEnvelopes(theoretical_mz, theoretical_int, offsets)
+        mz = np.asarray(mz)
+        intensity = np.asarray(intensity)
+        lengths = np.diff(offsets)
+        nonempty = lengths > 0
+        starts = offsets[:-1][nonempty]
+
+        if mono_mz is not None:
+            getTolerance = _getTolerance(toleranceType, tolerance)
+            mono = np.repeat(np.asarray(mono_mz, dtype=float), lengths)
+            nMono = _segmentReduce(np.add, (np.abs(theoretical_mz - mono) <= getTolerance(mono)).astype(float),
+                                   starts, nonempty, 0)
+            missing = np.flatnonzero(nMono != 1)
+            if len(missing) > 0:
+                raise RuntimeError('Could not find mono_mz in theoretical env for sequence {}!'.format(
+                                   None if sequences is None else sequences[missing[0]]))
+
+        links = matchPeaks(mz, intensity, theoretical_mz, tolerance = tolerance,
+                           toleranceType = toleranceType, best_match_tie = best_match_tie)
+        linked = links >= 0
+        matched_int = np.zeros(len(links), dtype=intensity.dtype)
+        matched_int[linked] = intensity[links[linked]]
+        scores = scoreMatched(theoretical_int, matched_int, offsets, normalize = normalize)
+
+        return scores, [links[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def scoreMatched(theoretical_int, matched_int, offsets, normalize = True):
+    '''
+    Score a batch of envelopes from the matched intensity of each theoretical peak.
+
+    This is the scoring step of scoreEnvelopes. It can also be used to score intensities
+    which were aggregated from several spectra, such as the sum of the intensity matched
+    to each theoretical peak in neighbouring scans.
+
+    :param theoretical_int: Flat array of theoretical intensities.
+    :param matched_int: Flat array with the intensity matched to each theoretical peak or 0 if it was not matched.
+    :param offsets: Array with the start of each envelope in the flat arrays followed by their length.
+    :param normalize: Should intensities be normalized to 1 before scores are calculated?
+    :return: Array with the score of each envelope.
+    '''
+
+    theoretical_int = np.asarray(theoretical_int, dtype=float)
+    matched_int = np.asarray(matched_int)
+    offsets = np.asarray(offsets, dtype=np.intp)
+    lengths = np.diff(offsets)
+    nonempty = lengths > 0
+    starts = offsets[:-1][nonempty]
+    segment = np.repeat(np.arange(len(lengths)), lengths)
+
+    linked = matched_int > 0
+    matched = matched_int[linked]
+    x = theoretical_int
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if normalize:
+            actual_max = np.full(len(matched_int), -np.inf)
+            actual_max[linked] = matched
+            actual_max = _segmentReduce(np.maximum, actual_max, starts, nonempty, -np.inf)
+            # matched intensities are divided in the dtype of the spectrum like calcEnvScore
+            matched = matched / actual_max[segment[linked]].astype(matched.dtype)
+            x = x / _segmentReduce(np.maximum, x, starts, nonempty, np.nan)[segment]
+        actual_int = np.zeros(len(theoretical_int))
+        actual_int[linked] = matched
+
+        # Pearson correlation of each segment, centered like np.corrcoef
+        n = lengths.astype(float)
+        x = x - (_segmentReduce(np.add, x, starts, nonempty, np.nan) / n)[segment]
+        y = actual_int - (_segmentReduce(np.add, actual_int, starts, nonempty, np.nan) / n)[segment]
+        sxy = _segmentReduce(np.add, x * y, starts, nonempty, np.nan)
+        sxx = _segmentReduce(np.add, x * x, starts, nonempty, np.nan)
+        syy = _segmentReduce(np.add, y * y, starts, nonempty, np.nan)
+        return np.clip(sxy / np.sqrt(sxx) / np.sqrt(syy), -1, 1)
+
+
 class ConsensusEnvelope(object):
+    '''
+    Annotate a Spectrum with a TheoreticalEnvelope.
 
-    H1_MASS = 1.00783,
+    Matches are stored in the links array which has the index of the actual peak
+    matched to each theoretical peak or -1.
 
-    @staticmethod
-    def _clearLinks(lst):
-        for i, _ in enumerate(lst):
-            lst[i].link = None
+    Actual and theoretical intensities are never modified. Normalization factors are
+    stored separately and applied when the score is calculated or the envelope is plotted,
+    so the same Spectrum can be annotated with the envelope of each variant and charge state.
+    '''
 
-    #@staticmethod
-    #def _iterate(iterable):
-    #    for i in
+    H1_MASS = 1.00783,
 
     def __init__(self, actual = None, theoretical = None,
                  tolerance = 50, toleranceType = 'ppm',
                  best_match_tie = 'intensity', envScoreCuttoff = 0.8,
                  sequence = None):
+        '''
+        :param actual: Spectrum. A list of DataPoint is also accepted and converted.
+        :param theoretical: TheoreticalEnvelope. A list of DataPoint is also accepted and converted.
+        '''
+        self._tolerance = tolerance
+        self._toleranceType = toleranceType
         self.getTolerance = _getTolerance(toleranceType, tolerance)
-        self._actual = actual
-        self._theoretical = theoretical
+        self._actual = _asSpectrum(actual, Spectrum)
+        self._theoretical = _asSpectrum(theoretical, TheoreticalEnvelope)
+        self.links = None
+        self.actual_norm = 1.0
+        self.theoretical_norm = 1.0
         self._mono_mz = None
         self._mono_index = None
         self._best_match_tie = best_match_tie
@@ -99,16 +447,54 @@ class ConsensusEnvelope(object):
         self.sequence = sequence
 
 
+    @classmethod
+    def fromArrays(cls, mz, intensity, theoretical_mz, theoretical_int, links,
+                   mono_mz = None, envScore = None, normalize = True, **kwargs):
+        '''
+        Build an annotated ConsensusEnvelope from the result of annotateArrays.
+
+        :param mz: Array of spectrum m/z values.
+        :param intensity: Array of spectrum intensities.
+        :param theoretical_mz: Array of theoretical m/z values.
+        :param theoretical_int: Array of theoretical intensities.
+        :param links: Array returned by matchPeaks.
+        :param mono_mz: Monoisotopic m/z.
+        :param envScore: Envelope score. If None, the score is calculated.
+        :param normalize: Should both theoretical and actual intensities be normalized to 1?
+        :param kwargs: Additional arguments passed to ConsensusEnvelope.
+        :return: ConsensusEnvelope
+        '''
+
+        ret = cls(Spectrum(mz, intensity), TheoreticalEnvelope(theoretical_mz, theoretical_int), **kwargs)
+        ret.links = np.asarray(links, dtype=np.intp)
+        if mono_mz is not None:
+            ret.set_mono(mono_mz = mono_mz)
+        if normalize:
+            ret._normalize(verbose = False)
+        if envScore is None:
+            ret.calcEnvScore()
+        else:
+            ret.envScore = envScore
+        ret.initialized = True
+        return ret
+
+
+    def _reset(self):
+        self.links = None
+        self.actual_norm = 1.0
+        self.theoretical_norm = 1.0
+
+
     def setActual(self, actual):
-        self._clearLinks(self._theoretical)
+        self._reset()
         self.initialized = False
-        self._actual = actual
+        self._actual = _asSpectrum(actual, Spectrum)
 
 
     def setTheoretical(self, theoretical):
-        self._clearLinks(self._actual)
+        self._reset()
         self.initialized = False
-        self._theoretical = theoretical
+        self._theoretical = _asSpectrum(theoretical, TheoreticalEnvelope)
 
 
     def set_mono(self, mono_mz = None,
@@ -121,23 +507,45 @@ class ConsensusEnvelope(object):
         else:
             raise RuntimeError('Either mono_mz or mono_mass and charge are required!')
 
-        #indices = [x for x in self._theoretical if self._inRange(x.point.mz, self._mono_mz)]
-        indices = list()
-        for i, x in enumerate(self._theoretical):
-            if inRange(x.point.mz, self._mono_mz, self.getTolerance(self._mono_mz)):
-                indices.append(i)
+        self._mono_index = self._theoretical.findMono(self._mono_mz, self.getTolerance, self.sequence)
+
+
+    @property
+    def actual(self):
+        return self._actual
+
+
+    @property
+    def theoretical(self):
+        return self._theoretical
 
-        if len(indices) != 1:
-            raise RuntimeError(f'Could not find mono_mz in theoretical env for sequence {self.sequence}!')
-        self._mono_index = indices[0]
+
+    def actualIntensity(self):
+        '''
+        Get actual intensities divided by the normalization factor.
+        '''
+        return self._actual.int / self.actual_norm
+
+
+    def theoreticalIntensity(self):
+        '''
+        Get theoretical intensities divided by the normalization factor.
+        '''
+        return self._theoretical.int / self.theoretical_norm
 
 
     def iterActual(self):
-        return enumerate(self._actual)
+        '''
+        Iterate over (index, (mz, int)) of actual peaks.
+        '''
+        return enumerate(zip(self._actual.mz, self._actual.int))
 
 
     def iterTheoretical(self):
-        return enumerate(self._theoretical)
+        '''
+        Iterate over (index, (mz, int)) of theoretical peaks.
+        '''
+        return enumerate(zip(self._theoretical.mz, self._theoretical.int))
 
 
     def annotate(self, remove_unlabeled, normalize=True, verbose=True):
@@ -150,81 +558,70 @@ class ConsensusEnvelope(object):
         :type normalize: bool
         :return:
         '''
+        with PROFILER.stage('annotate'):
+            self._annotate(remove_unlabeled, normalize=normalize, verbose=verbose)
 
-        self._clearLinks(self._theoretical)
-        self._clearLinks(self._actual)
-
-        for i, peak in enumerate(self._theoretical):
-
-            low_i = lower_bound(self._actual, peak,
-                                valueKey = lambda x: x.point.mz - self.getTolerance(x.point.mz),
-                                arrKey = lambda x: x.point.mz)
 
-            range_list = list()
-            #best_i = 0
-            for j in range(low_i, len(self._actual), 1):
-                if self._actual[j].point.mz > peak.point.mz + self.getTolerance(peak.point.mz):
-                    break
-                if inRange(self._actual[j].point.mz, peak.point.mz, self.getTolerance(self._actual[j].point.mz)):
-                    range_list.append(j)
-
-            if len(range_list) == 0:
-                continue
-            if len(range_list) == 1:
-                best_i = range_list[0]
-            else:
-                tempMax = range_list[0]
-                if self._best_match_tie == 'intensity':
-                    def _temp_compare(lhs, rhs):
-                        return lhs.point.int > rhs.point.int
-                else:
-                    def _temp_compare(lhs, rhs):
-                        return lhs.point.mz > rhs.point.mz
-
-                for j in range_list:
-                    if _temp_compare(self._actual[j], self._actual[tempMax]):
-                        tempMax = j
-                best_i = tempMax
-
-            if self._actual[best_i].point.int > 0:
-                self._actual[best_i].link = peak
-                self._theoretical[i].link = self._actual[best_i]
+    def _annotate(self, remove_unlabeled, normalize=True, verbose=True):
+        self._reset()
+        self.links = matchPeaks(self._actual.mz, self._actual.int, self._theoretical.mz,
+                                tolerance = self._tolerance, toleranceType = self._toleranceType,
+                                best_match_tie = self._best_match_tie)
 
         if remove_unlabeled:
-            self._actual = [x for x in self._actual if x.link is not None]
+            linked = self.links >= 0
+            self._actual = self._actual.take(self.links[linked])
+            self.links[linked] = np.arange(np.count_nonzero(linked))
 
         if normalize:
-            try:
-                max_int = max(x.point.int for x in self._actual if x.link is not None)
-            except ValueError:
-                if verbose:
-                    sys.stdout.write('No points in envelope found!\n')
-                if len(self._actual) == 0:
-                    max_int = max(self._theoretical, key = lambda x: x.point.int).point.int
-                else:
-                    max_int = max(self._actual, key = lambda x: x.point.int).point.int
-
-            for i in range(len(self._actual)):
-                self._actual[i].point.int /= max_int
-
-            max_int = max(self._theoretical, key = lambda x: x.point.int).point.int
-            for i in range(len(self._theoretical)):
-                self._theoretical[i].point.int /= max_int
+            self._normalize(verbose=verbose)
 
         self.calcEnvScore()
         self.initialized = True
 
 
+    def _linked(self):
+        '''
+        Boolean mask of actual peaks which are linked to a theoretical peak.
+        '''
+        mask = np.zeros(len(self._actual), dtype=bool)
+        if self.links is not None:
+            mask[self.links[self.links >= 0]] = True
+        return mask
+
+
+    def _normalize(self, verbose=True):
+        '''
+        Set the factors to normalize actual and theoretical intensities to 1.
+        '''
+        linked = self._linked()
+        if linked.any():
+            max_int = self._actual.int[linked].max()
+        else:
+            if verbose:
+                sys.stdout.write('No points in envelope found!\n')
+            if len(self._actual) == 0:
+                max_int = self._theoretical.int.max()
+            else:
+                max_int = self._actual.int.max()
+
+        self.actual_norm = max_int
+        self.theoretical_norm = self._theoretical.int.max()
+
+
     def calcEnvScore(self):
         with warnings.catch_warnings():
             warnings.simplefilter('ignore')
 
-            cor = np.corrcoef(x = [x.point.int for x in self._theoretical],
-                              y = [x.link.point.int if x.link is not None else 0 for x in self._theoretical])
+            linked = self.links >= 0
+            actual_int = np.zeros(len(self._theoretical))
+            actual_int[linked] = self._actual.int[self.links[linked]] / self.actual_norm
+            cor = np.corrcoef(x = self.theoreticalIntensity(), y = actual_int)
             self.envScore = cor[0,1]
 
 
     def plotEnv(self, ax, title = None, isBest = False):
+        import matplotlib.pyplot as plt
 
         #general properties of plot
         ax.margins(y = 0)
@@ -242,50 +639,26 @@ class ConsensusEnvelope(object):
                 {'fontweight' : plt.rcParams['axes.titleweight']}, 'center')
 
         #plot actual spectra
-        with warnings.catch_warnings():
-            warnings.simplefilter('ignore')
-            stemlines = list()
-            if len(self._actual) > 0:
-                _, stemlines, _ = ax.stem([x.point.mz for x in self._actual],
-                                          [x.point.int for x in self._actual],
-                                          basefmt = ' ', markerfmt = ' ',
-                                          use_line_collection = False)
-
-        for i in range(len(stemlines)):
-            if self._actual[i].link is None:
-                plt.setp(stemlines[i], color = 'black', alpha = 0.4)
-                #plt.setp(markerlines[i], 'Visible', False)
-            else:
-                plt.setp(stemlines[i], 'color', 'blue')
+        linked = self._linked()
+        actual_int = self.actualIntensity()
+        for mask, style in ((~linked, {'color': 'black', 'alpha': 0.4}), (linked, {'color': 'blue'})):
+            if mask.any():
+                ax.vlines(self._actual.mz[mask], 0, actual_int[mask], **style)
 
         #plot theoretical envelope
-        for i, it in enumerate(self._theoretical):
-            fill = 'white'
-            if self._mono_index is not None:
-                if i == self._mono_index:
-                    fill = 'green' if it.link is not None else 'red'
+        found = self.links >= 0
+        outline = np.where(found, 'green', 'red')
+        fill = np.full(len(found), 'white', dtype=outline.dtype)
+        if self._mono_index is not None:
+            fill[self._mono_index] = outline[self._mono_index]
 
-            outline = 'green' if it.link is not None else 'red'
+        for key in dict.fromkeys(zip(fill, outline)):
+            mask = (fill == key[0]) & (outline == key[1])
+            ax.plot(self._theoretical.mz[mask], np.zeros(np.count_nonzero(mask)), 'D', mfc = key[0], mec = key[1])
 
-            with warnings.catch_warnings():
-                warnings.simplefilter('ignore')
-                markerlines, _, _ = ax.stem([it.point.mz], [0], basefmt=' ',
-                                            linefmt=' ', markerfmt='D',
-                                            use_line_collection = False)
-            plt.setp(markerlines, mfc = fill, mec = outline)
-
-
-        ax.plot([x.point.mz for x in self._theoretical],
-                [x.point.int for x in self._theoretical],
+        ax.plot(self._theoretical.mz, self.theoreticalIntensity(),
                 'o--{}'.format('g' if self.envScore > self.envScoreCuttoff else 'r'),
                 alpha = 0.6)
 
         for spine in ['top', 'right']:
             ax.spines[spine].set_visible(False)
-
-
-
-
-
-
-
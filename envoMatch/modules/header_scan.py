@@ -0,0 +1,174 @@
+
+import re
+import mmap
+
+# Byte level scanner for spectrum headers in mzML and mzXML files.
+# Only the start tag and the elements before the binary arrays of each spectrum
+# are searched. Binary arrays are skipped without being parsed or decoded.
+
+_ATTR_RE = re.compile(rb'([A-Za-z_:][-\w:.]*)\s*=\s*"([^"]*)"')
+
+_MZML_SPECTRUM_RE = re.compile(rb'<spectrum\s([^>]*)>')
+_MZML_MS_LEVEL_RE = re.compile(rb'<cvParam\s[^>]*accession="MS:1000511"[^>]*>')
+_MZML_PRECURSOR_RE = re.compile(rb'<precursor\s([^>]*)>')
+_MZML_SCAN_START_RE = re.compile(rb'<cvParam\s[^>]*accession="MS:1000016"[^>]*>')
+
+# Units of scan start time per minute
+_MZML_TIME_UNITS = {'UO:0000010': 60, 'UO:0000031': 1, 'UO:0000032': 1 / 60}
+
+_MZXML_SCAN_RE = re.compile(rb'<scan\s([^>]*)>')
+_MZXML_PRECURSOR_RE = re.compile(rb'<precursorMz\s([^>]*)>')
+_DURATION_RE = re.compile(r'^-?PT(?:([0-9.]+)H)?(?:([0-9.]+)M)?(?:([0-9.]+)S)?$')
+
+
+def _attrs(tag):
+    return {k.decode(): v.decode() for k, v in _ATTR_RE.findall(tag)}
+
+
+def _duration_to_minutes(s):
+    '''
+    Convert xs:duration retention time (ie. PT718.19S) to minutes.
+    '''
+    match = _DURATION_RE.match(s)
+    if match is None:
+        return float(s)
+    hours, minutes, seconds = (float(x or 0) for x in match.groups())
+    return (-1 if s.startswith('-') else 1) * (hours * 60 + minutes + seconds / 60)
+
+
+def _header_end(buf, start, stop_tags, end_tag):
+    '''
+    Get the end of the header of the element starting at `start`
+    and the position to continue searching from.
+    '''
+    end = buf.find(end_tag, start)
+    end = len(buf) if end == -1 else end
+    header_end = end
+    for tag in stop_tags:
+        i = buf.find(tag, start, end)
+        if i != -1:
+            header_end = min(header_end, i)
+    return header_end, end
+
+
+def scanMzML(buf, pos=0):
+    '''
+    Iterate over the spectrum headers in an mzML file.
+
+    Parameters
+    ----------
+    buf: bytes-like
+        File contents.
+    pos: int
+        Byte offset to start from.
+
+    Yields
+    ------
+        Dict with the same id, index and 'ms level' keys as pyteomics.mzml,
+        the scan start time in minutes and the spectrumRef of the first precursor if there is one.
+    '''
+    while True:
+        match = _MZML_SPECTRUM_RE.search(buf, pos)
+        if match is None:
+            return
+        attrs = _attrs(match.group(1))
+        header_end, pos = _header_end(buf, match.end(), (b'<binaryDataArrayList',), b'</spectrum>')
+        header = buf[match.end():header_end]
+
+        spec = {'id': attrs['id'], 'index': int(attrs['index'])}
+        ms_level = _MZML_MS_LEVEL_RE.search(header)
+        if ms_level is not None:
+            spec['ms level'] = int(_attrs(ms_level.group(0))['value'])
+        start_time = _MZML_SCAN_START_RE.search(header)
+        if start_time is not None:
+            start_time = _attrs(start_time.group(0))
+            spec['scan start time'] = float(start_time['value']) / \
+                                      _MZML_TIME_UNITS.get(start_time.get('unitAccession'), 1)
+        precursor = _MZML_PRECURSOR_RE.search(header)
+        if precursor is not None:
+            ref = _attrs(precursor.group(1)).get('spectrumRef')
+            if ref is not None:
+                spec['spectrumRef'] = ref
+        yield spec
+
+
+def scanMzXML(buf, pos=0):
+    '''
+    Iterate over the scan headers in an mzXML file.
+
+    Parameters
+    ----------
+    buf: bytes-like
+        File contents.
+    pos: int
+        Byte offset to start from.
+
+    Yields
+    ------
+        Dict with the same num, msLevel and retentionTime (in minutes) keys as pyteomics.mzxml
+        and the precursorScanNum of the first precursor if there is one.
+    '''
+    while True:
+        match = _MZXML_SCAN_RE.search(buf, pos)
+        if match is None:
+            return
+        attrs = _attrs(match.group(1))
+        # Scans can be nested in mzXML, so the search continues after the peaks of this scan.
+        header_end, pos = _header_end(buf, match.end(), (b'<peaks',), b'</peaks>')
+        header = buf[match.end():header_end]
+
+        spec = {'num': attrs['num'], 'msLevel': int(attrs['msLevel'])}
+        if 'retentionTime' in attrs:
+            spec['retentionTime'] = _duration_to_minutes(attrs['retentionTime'])
+        precursor = _MZXML_PRECURSOR_RE.search(header)
+        if precursor is not None:
+            ref = _attrs(precursor.group(1)).get('precursorScanNum')
+            if ref is not None:
+                spec['precursorScanNum'] = int(ref)
+        yield spec
+
+
+_SCANNERS = {'mzML': scanMzML, 'mzXML': scanMzXML}
+
+
+def openBuffer(fname):
+    '''
+    Memory-map fname read only.
+    '''
+    with open(fname, 'rb') as inF:
+        return mmap.mmap(inF.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def iterHeaders(fname, file_type):
+    '''
+    Iterate over the spectrum headers in fname without parsing the xml tree.
+
+    Parameters
+    ----------
+    fname: str
+        Path to mzML or mzXML file.
+    file_type: str
+        One of (mzML, mzXML).
+    '''
+    with openBuffer(fname) as buf:
+        yield from _SCANNERS[file_type](buf)
+
+
+def headerAt(buf, offset, file_type):
+    '''
+    Get the header of the spectrum starting at byte offset.
+
+    Parameters
+    ----------
+    buf: bytes-like
+        File contents returned by openBuffer.
+    offset: int
+        Offset of the spectrum from the file index.
+    file_type: str
+        One of (mzML, mzXML).
+
+    Returns
+    -------
+        Header dict or None if there is no spectrum at offset.
+    '''
+    return next(_SCANNERS[file_type](buf, offset), None)
@@ -0,0 +1,124 @@
+
+import re
+from typing import Dict
+
+import numpy as np
+from pyteomics.mass import nist_mass
+
+_ELEMENT_RE = re.compile(r'^([A-Z][a-z]*\+?)(?:\[(\d+)\])?$')
+_CHARGE_CARRIER = 'H+'
+
+
+def _elementIsotopes(element: str, isotope_threshold: float) -> tuple:
+    '''
+    Get the isotopes of element.
+
+    :param element: Element symbol. Isotope labeled elements (ie. 'C[13]') are
+    treated as a single isotope with abundance 1.
+    :param isotope_threshold: Isotopes with an abundance less than this value are ignored.
+    :return: (mass number, mass, abundance) arrays sorted by mass number.
+    '''
+
+    match = _ELEMENT_RE.match(element)
+    if match is None or match.group(1) not in nist_mass:
+        raise RuntimeError('{} is an invalid element!'.format(element))
+
+    if match.group(2) is not None:
+        number = int(match.group(2))
+        return np.array([number]), np.array([nist_mass[match.group(1)][number][0]]), np.array([1.0])
+
+    isotopes = sorted((k, v) for k, v in nist_mass[match.group(1)].items()
+                      if k != 0 and v[1] > 0 and v[1] >= isotope_threshold)
+    if not isotopes:
+        isotopes = [(0, nist_mass[match.group(1)][0])]
+
+    return (np.array([k for k, _ in isotopes]),
+            np.array([v[0] for _, v in isotopes]),
+            np.array([v[1] for _, v in isotopes]))
+
+
+def _elementIsotopologues(element: str, count: int,
+                          threshold: float, isotope_threshold: float) -> tuple:
+    '''
+    Get the isotopologues of `count` atoms of element with an abundance of at least threshold.
+
+    The number of atoms of each isotope has a binomial distribution, and the abundance of an
+    isotopologue can not be greater than the probability of any of its isotope counts. So only
+    isotope counts with a binomial probability of at least threshold are combined.
+
+    :return: (abundance, mass, nominal mass shift) arrays.
+    '''
+
+    numbers, masses, abundances = _elementIsotopes(element, isotope_threshold)
+    log_fact = np.concatenate(([0.0], np.cumsum(np.log(np.arange(1, count + 1)))))
+    log_abundances = np.log(abundances)
+
+    # candidate counts of each isotope heavier than the first
+    k = np.arange(count + 1)
+    candidates = list()
+    for p in abundances[1:]:
+        log_pmf = log_fact[count] - log_fact - log_fact[::-1] + k * np.log(p) + (count - k) * np.log1p(-p)
+        candidates.append(k[log_pmf >= np.log(threshold)])
+
+    heavy = np.array(np.meshgrid(*candidates, indexing='ij')).reshape(len(candidates), -1).T \
+        if candidates else np.zeros((1, 0), dtype=int)
+    heavy = heavy[heavy.sum(axis=1) <= count]
+    counts = np.column_stack((count - heavy.sum(axis=1), heavy))
+
+    log_prob = log_fact[count] - log_fact[counts].sum(axis=1) + counts @ log_abundances
+    keep = log_prob >= np.log(threshold)
+    counts = counts[keep]
+    return np.exp(log_prob[keep]), counts @ masses, counts @ (numbers - numbers[0])
+
+
+def getAggregatedEnvelope(composition: Dict,
+                          threshold: float=1e-3,
+                          isotope_threshold: float=5e-3) -> list:
+    '''
+    Calculate the aggregated isotopic envelope of composition by sparse convolution
+    of per element isotopologue distributions.
+
+    Peaks are the same as the isotopologue engine of getEnvelope. Only isotopologues with an
+    abundance of at least threshold are used, and each peak contains the isotopologues
+    with the same nominal mass. The m/z of each peak is the average of its isotopologues
+    and the abundance is their sum. Isotopologues below threshold are dropped while each
+    element is added, so the distributions stay small for large peptides.
+
+    :param composition: Composition with charge as 'H+'.
+    :param threshold: Minimum isotopologue abundance.
+    :param isotope_threshold: Isotopes with an abundance less than this value are ignored.
+    The default is the same value used by getEnvelope.
+    :return: List of (mz, abundance) tuples.
+    '''
+
+    charge = 0
+    prob, mass, shift = np.array([1.0]), np.array([0.0]), np.array([0])
+    for element, count in composition.items():
+        if element == _CHARGE_CARRIER:
+            charge = count
+            continue
+        if count == 0:
+            continue
+        if count < 0:
+            raise RuntimeError('Negative count for {} in composition!'.format(element))
+
+        e_prob, e_mass, e_shift = _elementIsotopologues(element, count, threshold, isotope_threshold)
+        prob = np.multiply.outer(prob, e_prob).ravel()
+        keep = prob >= threshold
+        prob = prob[keep]
+        mass = np.add.outer(mass, e_mass).ravel()[keep]
+        shift = np.add.outer(shift, e_shift).ravel()[keep]
+
+    # The charge is added the same way as pyteomics Composition.mass(charge_carrier='H+')
+    # used by getEnvelope and the monoisotopic m/z calculation, which add the mass of a hydrogen atom.
+    mz = mass if charge == 0 else (mass + charge * nist_mass['H'][1][0]) / charge
+
+    # combine isotopologues with the same nominal mass
+    shifts, peak = np.unique(shift, return_inverse=True)
+    n_isotopologues = np.bincount(peak, minlength=len(shifts))
+    peak_mz = np.bincount(peak, weights=mz, minlength=len(shifts)) / n_isotopologues
+    peak_abundance = np.bincount(peak, weights=prob, minlength=len(shifts))
+    if charge < 0:
+        peak_mz, peak_abundance = peak_mz[::-1], peak_abundance[::-1]
+
+    return list(zip(peak_mz.tolist(), peak_abundance.tolist()))
@@ -1,11 +1,52 @@
 
 import sys
+import os
 import re
+import json
+from itertools import chain
+from contextlib import closing
+from collections import OrderedDict
+import numpy as np
 from pyteomics import ms1, mzml, mzxml
 
+from .profiling import PROFILER
+from .ms1store import Ms1Store, STORE_EXT
+from . import header_scan
+
 _MZ_KEY = 'mz'
 _INT_KEY = 'int'
 
+INDEX_CACHE_EXT = '.envoMatch_index.json'
+_INDEX_CACHE_VERSION = 2
+
+_SCAN_PATTERN = re.compile(r'scan=([0-9]+)')
+
+# ms level key in the headers of each file type
+_MS_LEVEL_KEYS = {'mzML': 'ms level', 'mzXML': 'msLevel'}
+
+
+class _IncompleteHeaderError(RuntimeError):
+    '''
+    Raised when a spectrum header found by the byte level scan does not have an ms level.
+    '''
+
+
+def _header_rt(header):
+    '''
+    Get the retention time in minutes from a spectrum header
+    returned by pyteomics or header_scan. Returns None if there is no retention time.
+    '''
+    if 'retentionTime' in header:
+        return float(header['retentionTime'])
+    if 'scan start time' in header:
+        return header['scan start time']
+    try:
+        rt = header['scanList']['scan'][0]['scan start time']
+    except (KeyError, IndexError):
+        return None
+    return float(rt) / 60 if getattr(rt, 'unit_info', None) == 'second' else float(rt)
+
+
 class Ms1File(object):
 
     @staticmethod
@@ -39,57 +80,361 @@ class Ms1File(object):
         fname: str
             Path to file to read. If None, no file is read.
         file_type: str
-            Input file type. One of (mzXML, mzML, ms1)
+            Input file type. One of (mzXML, mzML, ms1, ms1store)
         **kwargs
             Additional arguments passes to self.read
         '''
 
+        self._dat = None
         self.file_type = file_type
         self.precursors = None
+        self.fast_headers = True
         self._scan_map = None
+        self._scan_levels = None
+        self._precursor_refs = False
+        self._buf = None
+        self._ms1_scans = None
+        self._retention_times = None
+        self.spectrum_cache_size = 0
+        self._spectrum_cache = OrderedDict()
         if fname is None:
             self.fname = str()
         else: self.read(fname, file_type, **kwargs)
 
-    def _build_precursor_list(self):
+    def _iter_headers(self, fast_headers=None):
+        '''
+        Iterate over the spectra in self.fname without decoding the binary arrays.
+
+        If fast_headers is True, spectrum headers are found with a byte level
+        scan of the file and binary arrays are skipped without being parsed.
+        Otherwise every spectrum is parsed by pyteomics.
+
+        Parameters
+        ----------
+        fast_headers: bool
+            Default is self.fast_headers.
+
+        Raises
+        ------
+        _IncompleteHeaderError
+            If a header found by the byte level scan does not have an ms level.
+            (ie. it is set with a referenceableParamGroupRef)
+        '''
+        if self.fast_headers if fast_headers is None else fast_headers:
+            with closing(header_scan.iterHeaders(self.fname, self.file_type)) as headers:
+                first = next(headers, None)
+                if first is not None:
+                    level_key = _MS_LEVEL_KEYS[self.file_type]
+                    for header in chain([first], headers):
+                        if level_key not in header:
+                            raise _IncompleteHeaderError('No ms level found for spectrum {} in byte level scan of {}.'.format(
+                                header.get('id', header.get('num')), self.fname))
+                        yield header
+                    return
+            sys.stderr.write('WARN: No spectra found in byte level scan of {}.\n\tParsing file instead.\n'.format(self.fname))
+        _read = Ms1File.getReadFxn(self.file_type)
+        with _read(self.fname, decode_binary=False) as reader:
+            yield from reader
+
+    def _build_scan_index(self):
+        '''
+        Populate self._scan_levels, self._retention_times and (for mzML files) self._scan_map
+        by walking the spectrum headers.
+
+        If the byte level scan misses the ms level of any spectrum, the headers are parsed instead.
+        '''
+        try:
+            with closing(self._iter_headers()) as headers:
+                self._index_headers(headers)
+        except _IncompleteHeaderError as e:
+            sys.stderr.write('WARN: {}\n\tParsing file instead.\n'.format(e))
+            with closing(self._iter_headers(fast_headers=False)) as headers:
+                self._index_headers(headers)
+
+    def _index_headers(self, headers):
+        '''
+        Populate the scan index from an iterator over spectrum headers.
+        '''
+        self._retention_times = dict()
         if self.file_type == 'mzXML':
-            _scans = {int(x['num']):x['msLevel'] for x in self.dat}
+            self._scan_levels = dict()
+            for x in headers:
+                self._scan_levels[int(x['num'])] = x['msLevel']
+                if x['msLevel'] == 1:
+                    self._retention_times[int(x['num'])] = _header_rt(x)
         elif self.file_type == 'mzML':
-            scanPattern = re.compile(r'scan=([0-9]+)')
+            self._scan_map = dict()
+            self._scan_levels = dict()
+            first = next(headers, None)
+            if first is None:
+                return
 
             # test scan pattern on the first scan
-            match = scanPattern.search(self.dat[0]['id'])
+            match = _SCAN_PATTERN.search(first['id'])
             if match:
                 use_index = False
             else:
                 use_index = True
-                sys.stderr.write('WARN: Failed to match scan for file {}.\n\tUsing index instead.\n')
+                sys.stderr.write('WARN: Failed to match scan for file {}.\n\tUsing index instead.\n'.format(self.fname))
 
-            self._scan_map = dict()
-            _scans = dict()
-            for i, s in enumerate(self.dat):
+            for i, s in enumerate(chain([first], headers)):
+                # Only ms1 scans are read from the file, so only they are added to the scan map.
                 if use_index:
-                    _scans[s['index'] + 1] = s['ms level']
-                    self._scan_map[s['index']] = i
+                    self._scan_levels[s['index'] + 1] = s['ms level']
+                    if s['ms level'] == 1:
+                        self._scan_map[s['index']] = i
+                        self._retention_times[s['index']] = _header_rt(s)
                 else:
-                    match = scanPattern.search(s['id'])
+                    match = _SCAN_PATTERN.search(s['id'])
                     if match:
                         _scan = int(match.group(1))
-                        _scans[_scan] = s['ms level']
-                        self._scan_map[_scan] = i
+                        self._scan_levels[_scan] = s['ms level']
+                        if s['ms level'] == 1:
+                            self._scan_map[_scan] = i
+                            self._retention_times[_scan] = _header_rt(s)
                     else:
                         raise RuntimeError('Failed to find scan number for line {} in file {}'.format(s['id'], self.fname))
         else:
             assert(False)
 
+    def _build_precursor_list(self):
+        if self._scan_levels is None:
+            self._build_scan_index()
+
         self.precursors = dict()
-        for scan in sorted(_scans.keys()):
-            if _scans[scan] == 1:
+        for scan in sorted(self._scan_levels.keys()):
+            if self._scan_levels[scan] == 1:
                 pre_scan = scan
-            elif _scans[scan] == 2:
+            elif self._scan_levels[scan] == 2:
                 self.precursors[scan] = pre_scan
 
-    def read(self, fname, file_type='mzXML', build_precursor_list=False):
+    def _build_ms1_index(self):
+        '''
+        Populate self._retention_times with the retention time of each ms1 scan.
+        '''
+        if self.file_type == 'ms1':
+            self._retention_times = dict()
+            for spec in ms1.read(self.fname):
+                rt = spec['params'].get('RTime')
+                self._retention_times[int(spec['params']['scan'][0])] = None if rt is None else float(rt)
+            return
+
+        # The scan map of files read with precursor_refs has every scan, which is still needed
+        # to read precursor references.
+        scan_map = self._scan_map
+        self._build_scan_index()
+        if self._precursor_refs:
+            self._scan_map = scan_map
+
+    def ms1_scans(self):
+        '''
+        Get the ms1 scan numbers in the file.
+
+        Returns
+        -------
+            Sorted int array.
+        '''
+        if self._ms1_scans is None:
+            with PROFILER.stage('ms1_index'):
+                if self.file_type == STORE_EXT:
+                    scans = self.dat.scans
+                elif self.file_type == 'ms1':
+                    scans = sorted(int(x) for x in self.dat.index)
+                else:
+                    if self._retention_times is None:
+                        self._build_ms1_index()
+                    scans = sorted(self._retention_times.keys())
+                self._ms1_scans = np.asarray(scans, dtype=np.int64)
+        return self._ms1_scans
+
+    def retention_times(self):
+        '''
+        Get the retention time of each ms1 scan.
+
+        Returns
+        -------
+            Array of retention times in minutes in the same order as self.ms1_scans().
+
+        Raises
+        ------
+        RuntimeError
+            If any ms1 scan does not have a retention time.
+        '''
+        scans = self.ms1_scans()
+        if self.file_type == STORE_EXT:
+            if self.dat.rts is None:
+                raise RuntimeError('{} does not have retention times! '
+                                   'Convert it again with convert_envoMatch.'.format(self.fname))
+            return self.dat.rts
+
+        if self._retention_times is None:
+            with PROFILER.stage('ms1_index'):
+                self._build_ms1_index()
+        rts = np.array([self._retention_times.get(x) for x in scans.tolist()], dtype=float)
+        if np.isnan(rts).any():
+            raise RuntimeError('Retention time not found for scan {} in {}!'.format(
+                               scans[np.flatnonzero(np.isnan(rts))[0]], self.fname))
+        return rts
+
+    def get_neighbour_scans(self, scan, n_scans=0, rt_window=None):
+        '''
+        Get the ms1 scans around `scan`.
+
+        Parameters
+        ----------
+        scan: int
+            ms1 scan at the center of the window.
+        n_scans: int
+            Number of ms1 scans before and after `scan` to include.
+        rt_window: float
+            If not None, include the ms1 scans with a retention time within
+            this many minutes of `scan` instead of n_scans.
+
+        Returns
+        -------
+            Sorted list of ms1 scans which includes `scan`.
+            If `scan` is not an ms1 scan, only `scan` is returned.
+        '''
+        scans = self.ms1_scans()
+        i = int(np.searchsorted(scans, scan))
+        if i >= len(scans) or scans[i] != scan:
+            return [scan]
+        if rt_window is None:
+            return scans[max(0, i - n_scans):i + n_scans + 1].tolist()
+        rts = self.retention_times()
+        return scans[np.searchsorted(rts, rts[i] - rt_window, side='left'):
+                     np.searchsorted(rts, rts[i] + rt_window, side='right')].tolist()
+
+    def _spectrum_offsets(self):
+        '''
+        Get the byte offset of each spectrum id from the file index.
+        '''
+        return self.dat.index['spectrum' if self.file_type == 'mzML' else 'scan']
+
+    def _init_precursor_refs(self):
+        '''
+        Resolve precursors lazily from the precursor reference of each requested ms2 scan.
+
+        The scan map of mzML files is built from the spectrum ids in the file index,
+        so no spectrum headers are read until a precursor is requested.
+
+        Returns
+        -------
+        success: bool
+            False if the file type does not have precursor references or
+            scan numbers are not in the spectrum ids.
+        '''
+        if self.file_type not in ('mzML', 'mzXML'):
+            return False
+        if self.file_type == 'mzML':
+            scan_map = dict()
+            for i, _id in enumerate(self._spectrum_offsets().keys()):
+                match = _SCAN_PATTERN.search(_id)
+                if match is None:
+                    return False
+                scan_map[int(match.group(1))] = i
+            self._scan_map = scan_map
+        self.precursors = dict()
+        self._precursor_refs = True
+        return True
+
+    def _read_precursor_ref(self, scan):
+        '''
+        Read the precursor reference in the header of `scan`.
+
+        Only the header is read, using the offset of `scan` in the file index.
+
+        Returns
+        -------
+            Precursor scan or None if `scan` does not have a precursor reference.
+
+        Raises
+        ------
+        KeyError
+            If `scan` does not exist in ms file.
+        '''
+        offsets = self._spectrum_offsets()
+        if self.file_type == 'mzML':
+            key = offsets.from_index(self._scan_map[scan])
+        else:
+            key = str(scan)
+        offset = offsets[key]
+
+        if self._buf is None:
+            self._buf = header_scan.openBuffer(self.fname)
+        header = header_scan.headerAt(self._buf, offset, self.file_type)
+        if header is None or header['id' if self.file_type == 'mzML' else 'num'] != key:
+            raise RuntimeError('Index of {} does not match spectrum {}!'.format(self.fname, key))
+
+        if self.file_type == 'mzXML':
+            return header.get('precursorScanNum')
+        match = _SCAN_PATTERN.search(header.get('spectrumRef', ''))
+        return None if match is None else int(match.group(1))
+
+    def _index_cache_path(self):
+        return '{}{}'.format(self.fname, INDEX_CACHE_EXT)
+
+    def _file_signature(self):
+        '''
+        Get (path, size, mtime) used to check whether the index cache is stale.
+        '''
+        st = os.stat(self.fname)
+        return os.path.abspath(self.fname), st.st_size, st.st_mtime
+
+    def _read_index_cache(self):
+        '''
+        Read scan map, ms levels and precursor map from the index cache.
+
+        Returns
+        -------
+        success: bool
+            False if the cache does not exist or does not match self.fname.
+        '''
+        path = self._index_cache_path()
+        if not os.path.isfile(path):
+            return False
+        try:
+            with open(path, 'r') as inF:
+                cache = json.load(inF)
+        except (IOError, ValueError) as e:
+            sys.stderr.write('WARN: Could not read index cache {}\n\t{}\n'.format(path, e))
+            return False
+
+        fname, size, mtime = self._file_signature()
+        if cache.get('version') != _INDEX_CACHE_VERSION or cache.get('file_type') != self.file_type or \
+                cache.get('fname') != fname or cache.get('size') != size or cache.get('mtime') != mtime:
+            return False
+
+        def _int_keys(d):
+            return None if d is None else {int(k): v for k, v in d.items()}
+
+        self._scan_map = _int_keys(cache['scan_map'])
+        self._scan_levels = _int_keys(cache['ms_levels'])
+        self._retention_times = _int_keys(cache['retention_times'])
+        self.precursors = _int_keys(cache['precursors'])
+        return True
+
+    def _write_index_cache(self):
+        '''
+        Write the scan map, ms levels and precursor map to the index cache.
+        '''
+        path = self._index_cache_path()
+        fname, size, mtime = self._file_signature()
+        cache = {'version': _INDEX_CACHE_VERSION, 'file_type': self.file_type,
+                 'fname': fname, 'size': size, 'mtime': mtime,
+                 'scan_map': self._scan_map, 'ms_levels': self._scan_levels,
+                 'retention_times': self._retention_times,
+                 'precursors': self.precursors}
+        try:
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp_path, 'w') as outF:
+                json.dump(cache, outF)
+            os.replace(tmp_path, path)
+        except (IOError, OSError) as e:
+            sys.stderr.write('WARN: Could not write index cache {}\n\t{}\n'.format(path, e))
+
+    def read(self, fname, file_type='mzXML', build_precursor_list=False, index_cache=False, fast_headers=True,
+             precursor_refs=False):
         '''
         Read ms1 file.
 
@@ -98,21 +443,108 @@ class Ms1File(object):
         fname: str
             Name of file to read.
         file_type: str
-            File type. One of (mzXML, mzML, ms1)
+            File type. One of (mzXML, mzML, ms1, ms1store)
         build_precursor_list: bool
             Should self.precursors be populated?
+        index_cache: bool
+            Should the scan index and precursor map be read from (or written to)
+            a cache file next to `fname`? The cache is rebuilt if the size or
+            modification time of `fname` changes.
+        fast_headers: bool
+            Should spectrum headers be found with a byte level scan of `fname`
+            instead of parsing every spectrum? Binary arrays of ms2 scans are never decoded
+            either way, but the scan skips them without parsing the xml.
+        precursor_refs: bool
+            Should precursors be read from the precursor reference of each ms2 scan
+            (spectrumRef in mzML, precursorScanNum in mzXML) when they are requested?
+            Precursors are only inferred from scan order if a requested scan has no reference.
+            Overrides build_precursor_list and index_cache.
         '''
 
+        self.fast_headers = fast_headers
+        with PROFILER.stage('ms1_index'):
+            self._read(fname, file_type, build_precursor_list, index_cache, precursor_refs)
+
+    def _read(self, fname, file_type, build_precursor_list, index_cache, precursor_refs):
         self.fname = fname
-        _read = Ms1File.getReadFxn(file_type)
+        self.file_type = file_type
+        self.reopen()
+
+        # The precursor map is part of the store.
+        if self.file_type == STORE_EXT:
+            self.precursors = self.dat.precursors
+            return
+        if precursor_refs and self._init_precursor_refs():
+            return
+        if not (build_precursor_list or self.file_type == 'mzML'):
+            return
+        if index_cache and self._read_index_cache():
+            return
+
+        # mzML files always need a scan map to look up scans by number.
+        self._build_scan_index()
+        self._build_precursor_list()
+        if index_cache:
+            self._write_index_cache()
+
+    @property
+    def dat(self):
+        '''
+        Indexed reader for self.fname.
+        The reader is opened the first time it is used, so processes which
+        never read spectra from the file do not open it.
+        '''
+        if self._dat is None and self.fname:
+            self.reopen()
+        return self._dat
+
+    @dat.setter
+    def dat(self, value):
+        self._dat = value
+
+    def reopen(self):
+        '''
+        Open a new indexed reader for self.fname.
+        '''
+        if self.file_type == STORE_EXT:
+            self.dat = Ms1Store(self.fname)
+            return
+        _read = Ms1File.getReadFxn(self.file_type)
         self.dat = _read(self.fname, use_index=True)
-        if build_precursor_list:
-            self._build_precursor_list()
+
+    def detach(self):
+        '''
+        Drop the reader, buffer and spectrum cache.
+
+        Reader objects hold an open file handle, so worker processes which inherit
+        the parent's Ms1File should call this instead of sharing the parent's reader.
+        The file is reopened the first time it is read.
+        '''
+        self._dat = None
+        self._buf = None
+        self._spectrum_cache = OrderedDict()
+
+    def __getstate__(self):
+        # Only the scan and precursor maps are sent between processes.
+        # The reader is opened on the other side when it is first used.
+        state = self.__dict__.copy()
+        state.pop('_dat', None)
+        state.pop('_buf', None)
+        state.pop('_spectrum_cache', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.detach()
 
     def get_precursor_scan(self, scan):
         '''
         Get precursor scan for `scan`.
 
+        If the file was read with precursor_refs, the precursor reference of `scan`
+        is read the first time it is requested. If `scan` has no reference,
+        the precursors of all scans are inferred from scan order.
+
         Raises
         ------
         KeyError
@@ -121,7 +553,77 @@ class Ms1File(object):
         try:
             return self.precursors[scan]
         except KeyError as e:
-            raise KeyError('Scan: {} does not exist in ms0 file: {}'.format(scan, self.fname))
+            if not self._precursor_refs:
+                raise KeyError('Scan: {} does not exist in ms0 file: {}'.format(scan, self.fname))
+
+        with PROFILER.stage('ms1_index'):
+            try:
+                pre_scan = self._read_precursor_ref(scan)
+            except KeyError as e:
+                raise KeyError('Scan: {} does not exist in ms0 file: {}'.format(scan, self.fname))
+            if pre_scan is None:
+                self._precursor_refs = False
+                self._build_precursor_list()
+                return self.get_precursor_scan(scan)
+        self.precursors[scan] = pre_scan
+        return pre_scan
+
+    def _get_arrays(self, scan):
+        '''
+        Get sorted m/z and intensity arrays for scan.
+
+        If self.spectrum_cache_size > 0, up to that many of the most recently
+        decoded scans are kept so scans used by overlapping neighbour windows are only decoded once.
+
+        Returns
+        -------
+            Tuple of (mz, int) arrays or None if the scan is not found.
+        '''
+        if scan in self._spectrum_cache:
+            self._spectrum_cache.move_to_end(scan)
+            return self._spectrum_cache[scan]
+        try:
+            with PROFILER.stage('get_spectra'):
+                if self.file_type == STORE_EXT:
+                    # Scans in the store are already sorted.
+                    return self.dat.get_arrays(scan)
+                spec = self._get_scan(scan)
+        except KeyError as e:
+            sys.stderr.write('Scan ID: {} not found!\n'.format(scan))
+            return None
+
+        mz = spec['m/z array']
+        intensity = spec['intensity array']
+        if len(mz) > 1 and not np.all(mz[1:] >= mz[:-1]):
+            order = np.argsort(mz, kind='stable')
+            mz = mz[order]
+            intensity = intensity[order]
+        if self.spectrum_cache_size > 0:
+            self._spectrum_cache[scan] = (mz, intensity)
+            while len(self._spectrum_cache) > self.spectrum_cache_size:
+                self._spectrum_cache.popitem(last=False)
+        return mz, intensity
+
+    def iter_ms1_arrays(self):
+        '''
+        Iterate over the ms1 scans in ascending scan order.
+
+        Yields
+        ------
+            Tuple of (scan, (mz, int)) with sorted m/z and intensity arrays.
+        '''
+        for scan in self.ms1_scans().tolist():
+            arrays = self._get_arrays(scan)
+            if arrays is not None:
+                yield scan, arrays
+
+    @staticmethod
+    def _window(mz, mz_range):
+        '''
+        Get slice of sorted array `mz` with mz_range[0] <= mz <= mz_range[1].
+        '''
+        return slice(np.searchsorted(mz, mz_range[0], side='left'),
+                     np.searchsorted(mz, mz_range[1], side='right'))
 
     def get_spectra(self, scan, mz_range):
         '''
@@ -136,22 +638,56 @@ class Ms1File(object):
 
         Returns
         -------
-            Dict with arrays for mz and int
+            Dict with arrays for mz and int. The arrays are views of the
+            decoded scan (or of the mapped store for ms1store files), not copies.
         '''
 
-        vals = {'m/z array': _MZ_KEY, 'intensity array': _INT_KEY}
-        try:
-            spec = self._get_scan(scan)
-        except KeyError as e:
-            sys.stderr.write('Scan ID: {} not found!\n'.format(scan))
+        arrays = self._get_arrays(scan)
+        if arrays is None:
             return None
 
+        mz, intensity = arrays
         if mz_range is None:
-            selection = [True for _ in spec['m/z array']]
-        else:
-            selection = list(map(lambda x, y: x and y,
-                                 spec['m/z array'] >= mz_range[0],
-                                 spec['m/z array'] <= mz_range[1]))
+            return {_MZ_KEY: mz, _INT_KEY: intensity}
+
+        selection = Ms1File._window(mz, mz_range)
+        return {_MZ_KEY: mz[selection], _INT_KEY: intensity[selection]}
+
+    def get_spectra_windows(self, scan, mz_ranges):
+        '''
+        Return multiple mz windows from the same scan.
 
-        return {v: spec[k][selection] for k, v in vals.items()}
+        The scan is only read and decoded once.
 
+        Parameters
+        ----------
+        scan: int
+            Scan number to fetch
+        mz_ranges: list
+            List of (min, max) mz ranges.
+
+        Returns
+        -------
+            List with a dict of mz and int arrays for each range or None if
+            the scan is not found. The arrays are views of the decoded scan.
+        '''
+
+        arrays = self._get_arrays(scan)
+        if arrays is None:
+            return None
+        return Ms1File.windows(*arrays, mz_ranges)
+
+    @staticmethod
+    def windows(mz, intensity, mz_ranges):
+        '''
+        Get mz windows from sorted scan arrays.
+
+        Returns
+        -------
+            List with a dict of views of the mz and int arrays for each range.
+        '''
+        ret = list()
+        for mz_range in mz_ranges:
+            selection = Ms1File._window(mz, mz_range)
+            ret.append({_MZ_KEY: mz[selection], _INT_KEY: intensity[selection]})
+        return ret
@@ -0,0 +1,243 @@
+
+import os
+import json
+import mmap
+import struct
+import tempfile
+import numpy as np
+
+STORE_EXT = 'ms1store'
+_MAGIC = b'ENVOMS1\0'
+_STORE_VERSION = 1
+
+# The footer is followed by its length and _MAGIC.
+_TRAILER = struct.Struct('<Q8s')
+
+# Columns are aligned so they can be viewed without copying.
+_ALIGNMENT = 64
+
+# Number of values copied at once from temporary column files.
+_COPY_BLOCK = 1 << 20
+
+
+class Ms1Store(object):
+    '''
+    Read only, memory-mapped columnar store of the ms1 scans in a raw file.
+
+    The store is a single file with:
+        * One contiguous array of m/z values for all scans.
+        * One contiguous array of intensities for all scans.
+        * The scan numbers in ascending order and the offset of each scan in the peak arrays.
+        * The retention time of each scan, if the source file has retention times.
+        * A json footer with the array locations, the precursor map and the source file signature.
+
+    Peaks in each scan are sorted by m/z when the store is written.
+    Arrays returned by get_arrays are read only views of the mapped file, so
+    processes reading the same store share the OS page cache.
+    '''
+
+    def __init__(self, fname):
+        '''
+        Open store.
+
+        Parameters
+        ----------
+        fname: str
+            Path to store written by writeStore.
+        '''
+
+        self.fname = fname
+        with open(fname, 'rb') as inF:
+            self._mmap = mmap.mmap(inF.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._mmap) < len(_MAGIC) + _TRAILER.size or self._mmap[:len(_MAGIC)] != _MAGIC:
+            raise RuntimeError('{} is not a valid ms1 store!'.format(fname))
+        footer_len, magic = _TRAILER.unpack_from(self._mmap, len(self._mmap) - _TRAILER.size)
+        if magic != _MAGIC:
+            raise RuntimeError('{} is truncated!'.format(fname))
+        footer_start = len(self._mmap) - _TRAILER.size - footer_len
+        self.footer = json.loads(self._mmap[footer_start:footer_start + footer_len].decode('utf-8'))
+        if self.footer.get('version') != _STORE_VERSION:
+            raise RuntimeError('{} was written by an unsupported version of envoMatch!'.format(fname))
+
+        self.scans = self._column('scans')
+        self.offsets = self._column('offsets')
+        self.mz = self._column('mz')
+        self.int = self._column('int')
+        self.rts = self._column('rt') if 'rt' in self.footer['columns'] else None
+        self.precursors = {int(k): v for k, v in self.footer['precursors'].items()}
+
+    def _column(self, name):
+        col = self.footer['columns'][name]
+        return np.frombuffer(self._mmap, dtype=np.dtype(col['dtype']), count=col['count'], offset=col['offset'])
+
+    def __len__(self):
+        return len(self.scans)
+
+    def __contains__(self, scan):
+        i = np.searchsorted(self.scans, scan)
+        return i < len(self.scans) and self.scans[i] == scan
+
+    def get_arrays(self, scan):
+        '''
+        Get m/z and intensity arrays for scan.
+
+        Returns
+        -------
+            Tuple of (mz, int) views.
+
+        Raises
+        ------
+        KeyError
+            If scan is not in the store.
+        '''
+        try:
+            i = np.searchsorted(self.scans, int(scan))
+        except (TypeError, ValueError):
+            raise KeyError(scan)
+        if i >= len(self.scans) or self.scans[i] != scan:
+            raise KeyError(scan)
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.mz[start:end], self.int[start:end]
+
+
+def isCurrent(fname, source_fname):
+    '''
+    Was the store at fname written from the current version of source_fname?
+    '''
+    try:
+        source = Ms1Store(fname).footer['source']
+    except (IOError, OSError, RuntimeError, ValueError):
+        return False
+    st = os.stat(source_fname)
+    return source['size'] == st.st_size and source['mtime'] == st.st_mtime
+
+
+def _pad(outF):
+    n = -outF.tell() % _ALIGNMENT
+    outF.write(b'\0' * n)
+
+
+def _write_column(outF, arrays, dtype):
+    '''
+    Write arrays as one contiguous column and return its location.
+    '''
+    _pad(outF)
+    offset = outF.tell()
+    count = 0
+    for a in arrays:
+        outF.write(np.ascontiguousarray(a, dtype=dtype).tobytes())
+        count += len(a)
+    return {'dtype': np.dtype(dtype).str, 'count': count, 'offset': offset}
+
+
+class _ColumnWriter(object):
+    '''
+    Stream arrays to a temporary file so they can be written as one column
+    after all arrays are known. The column dtype is the promoted dtype of all arrays.
+    '''
+
+    def __init__(self, dir=None):
+        self._tmp = tempfile.TemporaryFile(dir=dir)
+        self.dtype = None
+        # (dtype, count) of each run of arrays with the same dtype
+        self._segments = list()
+
+    def append(self, a):
+        a = np.ascontiguousarray(a)
+        self.dtype = a.dtype if self.dtype is None else np.promote_types(self.dtype, a.dtype)
+        if self._segments and self._segments[-1][0] == a.dtype:
+            self._segments[-1][1] += len(a)
+        else:
+            self._segments.append([a.dtype, len(a)])
+        self._tmp.write(a.tobytes())
+
+    def write(self, outF, min_dtype):
+        '''
+        Copy arrays to outF as one column and return its location.
+        '''
+        dtype = np.dtype(min_dtype) if self.dtype is None else np.promote_types(min_dtype, self.dtype)
+        _pad(outF)
+        offset = outF.tell()
+        count = 0
+        self._tmp.seek(0)
+        for seg_dtype, n in self._segments:
+            count += n
+            while n > 0:
+                block = min(n, _COPY_BLOCK)
+                a = np.frombuffer(self._tmp.read(block * seg_dtype.itemsize), dtype=seg_dtype)
+                outF.write(a.astype(dtype, copy=False).tobytes())
+                n -= block
+        return {'dtype': dtype.str, 'count': count, 'offset': offset}
+
+    def close(self):
+        self._tmp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def writeStore(ms1_file, ofname):
+    '''
+    Write the ms1 scans in an Ms1File to a store.
+
+    Each scan is decoded once. m/z and intensity arrays are written
+    with the dtypes they were decoded as, so no precision is lost.
+    Peaks are streamed to temporary files next to ofname while scans are decoded,
+    so only one scan is held in memory at a time.
+
+    Parameters
+    ----------
+    ms1_file: Ms1File
+        File to convert. The precursor list is built if it has not been already.
+    ofname: str
+        Path to write store to.
+
+    Returns
+    -------
+    nScan: int
+        Number of ms1 scans written.
+    '''
+
+    if ms1_file.precursors is None and ms1_file.file_type != 'ms1':
+        ms1_file._build_precursor_list()
+
+    try:
+        rt_map = dict(zip(ms1_file.ms1_scans().tolist(), ms1_file.retention_times()))
+    except RuntimeError:
+        rt_map = None
+
+    scans = list()
+    offsets = [0]
+    tmp_dir = os.path.dirname(os.path.abspath(ofname))
+    tmp_ofname = '{}.{}.tmp'.format(ofname, os.getpid())
+    with _ColumnWriter(tmp_dir) as mz_column, _ColumnWriter(tmp_dir) as int_column:
+        for scan, (mz, intensity) in ms1_file.iter_ms1_arrays():
+            scans.append(scan)
+            mz_column.append(mz)
+            int_column.append(intensity)
+            offsets.append(offsets[-1] + len(mz))
+
+        st = os.stat(ms1_file.fname)
+        with open(tmp_ofname, 'wb') as outF:
+            outF.write(_MAGIC)
+            columns = {'scans': _write_column(outF, [scans], np.int64),
+                       'offsets': _write_column(outF, [offsets], np.int64),
+                       'mz': mz_column.write(outF, np.float32),
+                       'int': int_column.write(outF, np.float32)}
+            if rt_map is not None:
+                columns['rt'] = _write_column(outF, [[rt_map[x] for x in scans]], np.float64)
+            footer = {'version': _STORE_VERSION,
+                      'source': {'fname': os.path.abspath(ms1_file.fname), 'file_type': ms1_file.file_type,
+                                 'size': st.st_size, 'mtime': st.st_mtime},
+                      'columns': columns,
+                      'precursors': ms1_file.precursors or dict()}
+            footer = json.dumps(footer).encode('utf-8')
+            outF.write(footer)
+            outF.write(_TRAILER.pack(len(footer), _MAGIC))
+    os.replace(tmp_ofname, ofname)
+
+    return len(scans)
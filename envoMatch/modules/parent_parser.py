@@ -10,8 +10,9 @@ PARENT_PARSER.add_argument('--env_co', default=0.8, type=float,
 PARENT_PARSER.add_argument('--mz_step_margin', default=2, type=int,
                            help='Margin above and below envelope in plot.')
 
-PARENT_PARSER.add_argument('-t', '--file_type', choices=['ms1', 'mzXML', 'mzML'], default='mzML',
-                           help='MS-1 input file type. Default is mzML.')
+PARENT_PARSER.add_argument('-t', '--file_type', choices=['ms1', 'mzXML', 'mzML', 'ms1store'], default='mzML',
+                           help='MS-1 input file type. "ms1store" files are written by convert_envoMatch. '
+                                'Default is mzML.')
 
 PARENT_PARSER.add_argument('--ms1_prefix', action='append',
                            help='Append directory to search path for ms1 files. '
@@ -21,20 +22,81 @@ PARENT_PARSER.add_argument('--ms1_prefix', action='append',
 PARENT_PARSER.add_argument('-f', '--formula_source', choices=['input', 'calculate'], default='input',
                            help='Where should peptide formulas come from? Default is input.')
 
-PARENT_PARSER.add_argument('-s', '--pre_scan_src', choices=['input', 'ms1'], default='ms1',
+PARENT_PARSER.add_argument('-s', '--pre_scan_src', choices=['input', 'ms1', 'reference'], default='ms1',
                            help='Where should precursor scans come from. '
-                           'Chose either the "precursor_scan" column (input) or build precursor list '
-                           'from input MS-1 files (ms1). Default is ms1.')
+                           'Chose either the "precursor_scan" column (input), build precursor list '
+                           'from input MS-1 files (ms1), or read the precursor reference of each input scan '
+                           'from the MS-1 file (reference). "reference" only reads the headers of the input scans '
+                           'and falls back to "ms1" for files without precursor references. Default is ms1.')
+
+PARENT_PARSER.add_argument('--index_cache', choices=[0, 1], type=int, default=1,
+                           help='Should the scan index and precursor list of each ms1 file be cached in a file '
+                                'next to the ms1 file? The cache is rebuilt if the ms1 file changes. 1 is the default.')
+
+PARENT_PARSER.add_argument('--fast_headers', choices=[0, 1], type=int, default=1,
+                           help='Should spectrum headers be found by scanning the bytes of each mzML or mzXML file '
+                                'instead of parsing every spectrum? Binary arrays of ms2 scans are skipped without '
+                                'being parsed. 1 is the default.')
 
 PARENT_PARSER.add_argument('-a', '--atom_table', default=None,
                            help='Path to atom table to use in calculating envelopes.')
 
+PARENT_PARSER.add_argument('--env_engine', choices=['isotopologues', 'convolution'], default='isotopologues',
+                           help='How should theoretical envelopes be calculated? '
+                                '"isotopologues" enumerates individual isotopologues and combines their mass defects. '
+                                '"convolution" gives the same peaks by convolving the isotopologues of each element '
+                                'and dropping isotopologues below the abundance threshold as it goes, '
+                                'which is much faster for large peptides. Default is isotopologues.')
+
+PARENT_PARSER.add_argument('--env_cache', default=None,
+                           help='Path to a file used to store calculated theoretical envelopes between runs. '
+                                'If the file exists, envelopes are read from it before searching and '
+                                'new envelopes are written to it at the end of the run.')
+
+PARENT_PARSER.add_argument('--env_cache_size', default=100000, type=int,
+                           help='Maximum number of theoretical envelopes to keep in memory. Default is 100000.')
+
 PARENT_PARSER.add_argument('--plotEnv', action='store_true', default=False,
                            help='Should plot of envelopes be saved?')
 
 PARENT_PARSER.add_argument('--splitPlots', action='store_true', default=False,
                            help='Split "good" and "bad" envelope plots in separate directories.')
 
+PARENT_PARSER.add_argument('--plot_format', choices=['pdf', 'png', 'multipdf'], default='pdf',
+                           help='Format of envelope plots. pdf and png write one file per row. '
+                                'multipdf writes one multi-page pdf per parent file. Default is pdf.')
+
+PARENT_PARSER.add_argument('--plot_select', choices=['all', 'good', 'bad'], default='all',
+                           help='Only plot good or bad envelopes. Default is all.')
+
+PARENT_PARSER.add_argument('--plot_score_range', type=float, nargs=2, default=None, metavar=('MIN', 'MAX'),
+                           help='Only plot envelopes with an env_score between MIN and MAX.')
+
+PARENT_PARSER.add_argument('--plot_sample', type=int, default=None, metavar='N',
+                           help='Plot a random sample of up to N selected envelopes for each parent file.')
+
+PARENT_PARSER.add_argument('--plot_seed', type=int, default=1,
+                           help='Random seed for --plot_sample. Default is 1.')
+
+PARENT_PARSER.add_argument('--plot_rows', default=None,
+                           help='Only plot rows listed in this tsv file. The file must have parent_file and scan '
+                                'columns. If it also has a sequence column, rows are matched by sequence too.')
+
+PARENT_PARSER.add_argument('--neighbour_scans', type=int, default=0, metavar='N',
+                           help='Also score envelopes in the N ms1 scans before and after the precursor scan. '
+                                'Each spectrum is decoded once and shared by all rows whose windows overlap. '
+                                'Default is 0.')
+
+PARENT_PARSER.add_argument('--neighbour_rt', type=float, default=None, metavar='MINUTES',
+                           help='Score envelopes in the ms1 scans with a retention time within this many minutes '
+                                'of the precursor scan instead of --neighbour_scans.')
+
+PARENT_PARSER.add_argument('--neighbour_score', choices=['best', 'sum'], default='best',
+                           help='How should scores from neighbouring scans be combined? '
+                                '"best" uses the best score of each variant in any scan. '
+                                '"sum" sums the intensity matched to each isotope over all scans '
+                                'and scores the summed intensities. Default is best.')
+
 PARENT_PARSER.add_argument('--parallel', choices=[0, 1], type=int, default=1,
                            help='Chose whether envelope matching should be performed in parallel.'
                                 ' Parallel processing is performed on up to the number of logical cores on your system. '
@@ -44,9 +106,44 @@ PARENT_PARSER.add_argument('--nThread', type=int, default=None,
                            help='Chose how many threads to use for parallel processing. '
                                 'This option overrides the --parallel option.')
 
+PARENT_PARSER.add_argument('--schedule', choices=['row', 'scan'], default='row',
+                           help='How should rows be split between workers? '
+                                '"row" processes each row separately. '
+                                '"scan" groups rows by parent file and precursor scan so each precursor '
+                                'spectrum is only read once. Output order is the same. Default is row.')
+
+PARENT_PARSER.add_argument('--shared_spectra', action='store_true', default=False,
+                           help='Decode each precursor spectrum once in the main process into shared memory '
+                                'which search workers read without copying, instead of each worker decoding '
+                                'its own spectra. Requires --schedule scan and python 3.8 or later. '
+                                'All precursor spectra for the input (or each chunk) are held in shared memory.')
+
+PARENT_PARSER.add_argument('--chunk_size', type=int, default=None,
+                           help='Read and process the input file in chunks of this many rows. '
+                                'Results are appended to the output file as each chunk is finished, '
+                                'so memory use does not grow with the size of the input. '
+                                'By default the whole input file is read at once.')
+
+PARENT_PARSER.add_argument('--checkpoint_interval', type=int, default=1000,
+                           help='Write completed rows to <output_file>.checkpoint after this many rows are finished. '
+                                'The checkpoint is removed when the run is finished. If a checkpoint from an '
+                                'interrupted run exists, envoMatch does not start unless --resume is given. '
+                                'Set to 0 to disable checkpoints. Default is 1000.')
+
+PARENT_PARSER.add_argument('--resume', action='store_true', default=False,
+                           help='Resume an interrupted run. Rows in the checkpoint file '
+                                'with the same row index, parent_file, scan and sequence are skipped.')
+
 PARENT_PARSER.add_argument('--overwrite', type=int, choices=[0, 1], default=0,
                            help='Should ionFinder_output be overwritten?')
 
+PARENT_PARSER.add_argument('--profile', action='store_true', default=False,
+                           help='Collect wall time and call counts for each pipeline stage and peak memory '
+                                'use of each process. A summary is written to <output_file_base>.profile.json')
+
+PARENT_PARSER.add_argument('--profile_dump', default=None,
+                           help='Directory to write a cProfile dump for each process to. Implies --profile.')
+
 PARENT_PARSER.add_argument('-v', '--verbose', action='store_true', default=False,
                            help='Print verbose output?')
 
@@ -0,0 +1,273 @@
+
+import random
+import numpy as np
+
+from .consensusEnvelope import ConsensusEnvelope
+from .profiling import PROFILER
+
+# matplotlib and pandas are only imported when they are needed,
+# so scoring workers do not load them.
+
+PLOT_FORMATS = ('pdf', 'png', 'multipdf')
+
+
+def makeMatchRecord(row, mz, intensity, sequences, envs, mono_mzs, links, scores,
+                    best_index, good_envelope, env_score, mz_step_margin=2):
+    '''
+    Make a compact record of the envelope matches for a single row.
+
+    Only the spectrum peaks inside the plotted m/z range are kept, so records are
+    small enough to send from scoring workers to the plotting pool.
+
+    Parameters
+    ----------
+    row: dict
+        Input row with parent_file, scan, sequence and charge.
+    mz: array
+        Spectrum m/z values.
+    intensity: array
+        Spectrum intensities.
+    sequences: list
+        Variant sequences.
+    envs: dict
+        Theoretical envelope ([(mz, int), ...]) of each sequence.
+    mono_mzs: dict
+        Monoisotopic m/z of each sequence.
+    links: dict
+        Array returned by matchPeaks for each sequence.
+    scores: dict
+        Envelope score of each sequence.
+    best_index: int
+        Index of the best scoring variant in `sequences`.
+    good_envelope: bool
+    env_score: float
+        Envelope score of the input sequence.
+    mz_step_margin: float
+        Margin of the plotted m/z range.
+
+    Returns
+    -------
+    record: dict
+    '''
+
+    charge = row['charge']
+    min_mz = min(envs[s][0][0] for s in sequences) - (mz_step_margin / charge) * mz_step_margin
+    max_mz = max(envs[s][-1][0] for s in sequences) + (mz_step_margin / charge) * mz_step_margin
+    mz = np.asarray(mz)
+    lo = int(np.searchsorted(mz, min_mz, side='left'))
+    hi = int(np.searchsorted(mz, max_mz, side='right'))
+
+    variants = list()
+    for s in sequences:
+        theoretical_mz, theoretical_int = zip(*envs[s])
+        variant_links = np.array(links[s])
+        variant_links[variant_links >= 0] -= lo
+        variants.append({'sequence': s,
+                         'theoretical_mz': np.array(theoretical_mz),
+                         'theoretical_int': np.array(theoretical_int),
+                         'links': variant_links,
+                         'mono_mz': mono_mzs[s],
+                         'env_score': scores[s]})
+
+    return {'parent_file': row['parent_file'],
+            'scan': row['scan'],
+            'sequence': row['sequence'],
+            'charge': charge,
+            'good_envelope': good_envelope,
+            'env_score': env_score,
+            'best_index': best_index,
+            'min_mz': min_mz,
+            'max_mz': max_mz,
+            'mz': np.array(mz[lo:hi]),
+            'int': np.array(np.asarray(intensity)[lo:hi]),
+            'variants': variants}
+
+
+def plotRecord(record):
+    '''
+    Plot the envelope of each variant in a record on a single figure.
+
+    Returns
+    -------
+    fig: matplotlib.figure.Figure
+    '''
+
+    import matplotlib.pyplot as plt
+
+    variants = record['variants']
+    fig, ax = plt.subplots(len(variants), 1, sharex=True, squeeze=False)
+    fig.set_size_inches(6.4, 2.4 * len(variants))
+    for k, v in enumerate(variants):
+        consensus = ConsensusEnvelope.fromArrays(record['mz'], record['int'],
+                                                 v['theoretical_mz'], v['theoretical_int'], v['links'],
+                                                 mono_mz=v['mono_mz'], envScore=v['env_score'],
+                                                 sequence=v['sequence'])
+        consensus.plotEnv(ax[k, 0], isBest=(k == record['best_index']))
+
+    ax[-1, 0].set_xlabel('m/z')
+    ax[-1, 0].set_xlim(record['min_mz'], record['max_mz'])
+    return fig
+
+
+def renderRecord(task):
+    '''
+    Render a single record to its own file.
+    The file format is determined by the extension of the file name.
+
+    Parameters
+    ----------
+    task: tuple
+        Tuple of (record, ofname).
+
+    Returns
+    -------
+    ofname: str
+    '''
+
+    import matplotlib.pyplot as plt
+
+    record, ofname = task
+    with PROFILER.stage('plotting'):
+        fig = plotRecord(record)
+        fig.savefig(ofname)
+        plt.close(fig)
+    return ofname
+
+
+def renderMultipage(task):
+    '''
+    Render records to a multi-page pdf with one page per record.
+
+    Parameters
+    ----------
+    task: tuple
+        Tuple of (records, ofname).
+
+    Returns
+    -------
+    ofname: str
+    '''
+
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_pdf import PdfPages
+
+    records, ofname = task
+    with PROFILER.stage('plotting'):
+        with PdfPages(ofname) as pdf:
+            for record in records:
+                fig = plotRecord(record)
+                fig.suptitle('Scan {}, charge {}'.format(record['scan'], record['charge']))
+                pdf.savefig(fig)
+                plt.close(fig)
+    return ofname
+
+
+class PlotSelection(object):
+    '''
+    Select which match records are plotted.
+
+    Filters on good_envelope, env_score and listed rows are applied to each row as soon as it is scored,
+    so records which will not be plotted are never made.
+    Random sampling is done with RecordSampler after scoring.
+    '''
+
+    def __init__(self, envelopes='all', score_range=None, rows=None):
+        '''
+        Parameters
+        ----------
+        envelopes: str
+            One of 'all', 'good' or 'bad'.
+        score_range: tuple
+            (min, max) env_score range. Envelopes with an env_score of NaN are not in any range.
+        rows: set
+            Set of (parent_file, scan) or (parent_file, scan, sequence) tuples returned by readRows.
+        '''
+        if envelopes not in ('all', 'good', 'bad'):
+            raise ValueError('{} is a invalid argument for envelopes'.format(envelopes))
+        self.envelopes = envelopes
+        self.score_range = score_range
+        self.rows = rows
+        self._row_key_len = None if rows is None else len(next(iter(rows), (None, None)))
+
+    @staticmethod
+    def readRows(fname):
+        '''
+        Read rows to plot from a tsv file with parent_file and scan columns.
+        If the file also has a sequence column, rows are matched by sequence too.
+
+        Returns
+        -------
+        rows: set
+        '''
+        import pandas as pd
+        dat = pd.read_csv(fname, sep='\t')
+        cols = [x for x in ('parent_file', 'scan', 'sequence') if x in dat.columns]
+        if cols[:2] != ['parent_file', 'scan']:
+            raise RuntimeError('parent_file and scan columns are required in {}!'.format(fname))
+        return set(PlotSelection._key(*x) for x in dat[cols].itertuples(index=False, name=None))
+
+    @staticmethod
+    def _key(parent_file, scan, sequence=None):
+        if sequence is None:
+            return (str(parent_file), int(scan))
+        return (str(parent_file), int(scan), str(sequence))
+
+    def selected(self, row, good_envelope, env_score):
+        '''
+        Should the match for `row` be plotted?
+
+        Parameters
+        ----------
+        row: dict
+            Input row with parent_file, scan and sequence.
+        good_envelope: bool
+        env_score: float
+        '''
+        if self.envelopes == 'good' and not good_envelope:
+            return False
+        if self.envelopes == 'bad' and good_envelope:
+            return False
+        if self.score_range is not None:
+            if not (self.score_range[0] <= env_score <= self.score_range[1]):
+                return False
+        if self.rows is not None:
+            key = (row['parent_file'], row['scan'], row['sequence'])[:self._row_key_len]
+            if PlotSelection._key(*key) not in self.rows:
+                return False
+        return True
+
+
+class RecordSampler(object):
+    '''
+    Keep a uniform random sample of up to n records for each parent file.
+
+    Records can be added in chunks. Only the sampled records are kept in memory.
+    '''
+
+    def __init__(self, n, seed=None):
+        self.n = n
+        self._random = random.Random(seed)
+        self._seen = dict()
+        self._samples = dict()
+        self._count = 0
+
+    def add(self, records):
+        for record in records:
+            parent_file = record['parent_file']
+            seen = self._seen.get(parent_file, 0)
+            sample = self._samples.setdefault(parent_file, list())
+            if seen < self.n:
+                sample.append((self._count, record))
+            else:
+                i = self._random.randint(0, seen)
+                if i < self.n:
+                    sample[i] = (self._count, record)
+            self._seen[parent_file] = seen + 1
+            self._count += 1
+
+    def records(self):
+        '''
+        Get sampled records in the order they were added.
+        '''
+        return [x[1] for x in sorted((x for sample in self._samples.values() for x in sample),
+                                     key=lambda x: x[0])]
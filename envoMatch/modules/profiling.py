@@ -0,0 +1,155 @@
+
+import os
+import sys
+import json
+import time
+from collections import defaultdict
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+
+def max_rss_mb():
+    '''
+    Get the peak resident set size of this process in MB.
+    Returns None if it can not be determined.
+    '''
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kB on Linux
+    return rss / 1024 ** 2 if sys.platform == 'darwin' else rss / 1024
+
+
+class _Stage(object):
+    __slots__ = ['_profiler', '_name', '_start']
+
+    def __init__(self, profiler, name):
+        self._profiler = profiler
+        self._name = name
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self._profiler.add(self._name, time.perf_counter() - self._start)
+        return False
+
+
+class _NullStage(object):
+    __slots__ = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class StageProfiler(object):
+    '''
+    Collect wall time and call counts for named pipeline stages.
+
+    Profiling is disabled by default. When disabled, stage() returns a shared
+    no-op context manager so instrumented code has almost no overhead.
+
+    Stage timings from worker processes are sent to the main process with drain()
+    and combined with merge().
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self._times = defaultdict(float)
+        self._counts = defaultdict(int)
+        self._rss = dict()
+
+    def enable(self):
+        self.enabled = True
+
+    def reset(self):
+        '''
+        Discard stage timings.
+        '''
+        self._times = defaultdict(float)
+        self._counts = defaultdict(int)
+        self._rss = dict()
+
+    def stage(self, name):
+        '''
+        Get context manager to time a stage.
+
+        Usage
+        -----
+            with PROFILER.stage('getEnvelope'):
+                ...
+        '''
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def add(self, name, seconds, count=1):
+        self._times[name] += seconds
+        self._counts[name] += count
+
+    def drain(self):
+        '''
+        Get stage timings since the last call and reset them.
+
+        Returns
+        -------
+            Dict with pid, peak RSS and stage timings.
+        '''
+        ret = {'pid': os.getpid(), 'max_rss_mb': max_rss_mb(),
+               'stages': {k: (self._times[k], self._counts[k]) for k in self._times}}
+        self._times = defaultdict(float)
+        self._counts = defaultdict(int)
+        return ret
+
+    def merge(self, report):
+        '''
+        Add stage timings from a report returned by drain.
+        '''
+        for k, (seconds, count) in report['stages'].items():
+            self.add(k, seconds, count)
+        if report['max_rss_mb'] is not None:
+            self._rss[report['pid']] = max(self._rss.get(report['pid'], 0), report['max_rss_mb'])
+
+    def summary(self):
+        '''
+        Get summary of all stages and processes.
+        '''
+        rss = dict(self._rss)
+        main_rss = max_rss_mb()
+        if main_rss is not None:
+            rss[os.getpid()] = main_rss
+        return {'stages': {k: {'seconds': self._times[k], 'calls': self._counts[k],
+                               'seconds_per_call': self._times[k] / self._counts[k] if self._counts[k] else 0}
+                           for k in sorted(self._times)},
+                'main_pid': os.getpid(),
+                'max_rss_mb': rss,
+                'peak_rss_mb': max(rss.values()) if rss else None,
+                'total_peak_rss_mb': sum(rss.values()) if rss else None}
+
+    def write(self, fname, **kwargs):
+        '''
+        Write summary as json to fname.
+
+        Parameters
+        ----------
+        **kwargs
+            Additional values to add to the summary.
+        '''
+        summary = self.summary()
+        summary.update(kwargs)
+        with open(fname, 'w') as outF:
+            json.dump(summary, outF, indent=2, sort_keys=True)
+
+
+PROFILER = StageProfiler()
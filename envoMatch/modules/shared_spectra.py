@@ -0,0 +1,147 @@
+
+from functools import reduce
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # python < 3.8
+    shared_memory = None
+
+
+def _align(n, alignment=8):
+    return n + (-n % alignment)
+
+
+class SpectrumBlock(object):
+    '''
+    Decoded spectra in a single multiprocessing.shared_memory block.
+
+    The block has the offset of each spectrum followed by one m/z and one intensity
+    column for all spectra. The process which creates the block owns it and should
+    unlink it when it is no longer needed. Other processes attach to it by name
+    with the descriptor and get spectra as read only views of the shared memory.
+    '''
+
+    def __init__(self, shm, nSpec, nPeak, mz_dtype, int_dtype):
+        self.shm = shm
+        self.nSpec = nSpec
+        self.nPeak = nPeak
+        self.mz_dtype = np.dtype(mz_dtype)
+        self.int_dtype = np.dtype(int_dtype)
+
+        offset = 0
+        self.offsets = np.ndarray((nSpec + 1,), dtype=np.int64, buffer=shm.buf, offset=offset)
+        offset = _align(offset + self.offsets.nbytes)
+        self.mz = np.ndarray((nPeak,), dtype=self.mz_dtype, buffer=shm.buf, offset=offset)
+        offset = _align(offset + self.mz.nbytes)
+        self.int = np.ndarray((nPeak,), dtype=self.int_dtype, buffer=shm.buf, offset=offset)
+
+    @staticmethod
+    def available():
+        return shared_memory is not None
+
+    @staticmethod
+    def startTracker():
+        '''
+        Start the shared memory resource tracker.
+
+        Should be called before worker processes are started, so they use the tracker of
+        this process. Otherwise each worker starts its own tracker, which reports the blocks
+        the worker attached to as leaked when it exits.
+        '''
+        from multiprocessing import resource_tracker
+        resource_tracker.ensure_running()
+
+    @staticmethod
+    def _size(nSpec, nPeak, mz_dtype, int_dtype):
+        return _align((nSpec + 1) * 8) + _align(nPeak * np.dtype(mz_dtype).itemsize) + \
+               nPeak * np.dtype(int_dtype).itemsize
+
+    @classmethod
+    def create(cls, spectra):
+        '''
+        Copy spectra into a new shared memory block.
+
+        Parameters
+        ----------
+        spectra: list
+            List of (mz, int) array tuples.
+
+        Returns
+        -------
+        block: SpectrumBlock
+        '''
+        if shared_memory is None:
+            raise RuntimeError('Shared memory requires python 3.8 or later!')
+
+        # dtypes are promoted pairwise because np.result_type takes at most 32 arguments in NumPy 1.x
+        mz_dtype = reduce(np.promote_types, {x[0].dtype for x in spectra}, np.dtype(np.float32))
+        int_dtype = reduce(np.promote_types, {x[1].dtype for x in spectra}, np.dtype(np.float32))
+        nPeak = sum(len(x[0]) for x in spectra)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, cls._size(len(spectra), nPeak, mz_dtype, int_dtype)))
+        block = cls(shm, len(spectra), nPeak, mz_dtype, int_dtype)
+
+        block.offsets[0] = 0
+        for i, (mz, intensity) in enumerate(spectra):
+            start = block.offsets[i]
+            block.offsets[i + 1] = start + len(mz)
+            block.mz[start:start + len(mz)] = mz
+            block.int[start:start + len(mz)] = intensity
+        return block
+
+    @classmethod
+    def attach(cls, descriptor):
+        '''
+        Attach to an existing block.
+
+        Parameters
+        ----------
+        descriptor: tuple
+            SpectrumBlock.descriptor of the block.
+        '''
+        name, nSpec, nPeak, mz_dtype, int_dtype = descriptor
+        return cls(shared_memory.SharedMemory(name=name), nSpec, nPeak, mz_dtype, int_dtype)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def descriptor(self):
+        '''
+        Small picklable tuple used to attach to the block in another process.
+        '''
+        return self.shm.name, self.nSpec, self.nPeak, self.mz_dtype.str, self.int_dtype.str
+
+    def get_arrays(self, i):
+        '''
+        Get the m/z and intensity arrays of spectrum i.
+
+        Returns
+        -------
+            Tuple of (mz, int) views.
+        '''
+        start, end = self.offsets[i], self.offsets[i + 1]
+        mz = self.mz[start:end]
+        intensity = self.int[start:end]
+        mz.flags.writeable = False
+        intensity.flags.writeable = False
+        return mz, intensity
+
+    def close(self):
+        '''
+        Detach from the block.
+        If views of the block are still in use, it is detached when they are garbage collected.
+        '''
+        self.offsets = self.mz = self.int = None
+        try:
+            self.shm.close()
+        except BufferError:
+            pass
+
+    def unlink(self):
+        '''
+        Free the block. Should only be called by the process which created it.
+        '''
+        self.shm.unlink()
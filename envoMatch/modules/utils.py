@@ -1,6 +1,6 @@
 
-from pandas import isnull
 import re
+from math import isnan
 
 _ATOM_RE = r'(\(\d+\))?([A-Z][a-z]?)(\d+)?'
 
@@ -126,7 +126,8 @@ def formula_to_pyteomics_formula(formula: str, charge: int=0):
     :return: pyteomics format formula.
     '''
 
-    if isnull(formula) or formula == '':
+    # missing values in a DataFrame are NaN
+    if formula is None or (isinstance(formula, float) and isnan(formula)) or formula == '':
         raise RuntimeError('Found empty formula! '
                            'Use "--formula_source calculate" if you want '
                            'to calculate peptide formulas in place.')
@@ -10,10 +10,39 @@ from math import ceil
 from .modules import parent_parser
 
 ENV_FINDER_EXE = 'envoMatch'
+MERGE_EXE = 'merge_envoMatch'
+
+# Used for --mem, --ppn and --walltime when they are not given or estimated.
+DEFAULT_RESOURCES = {'mem': 8, 'ppn': 8, 'walltime': '12:00:00'}
+
+
+def _format_flags(args):
+    ret = list()
+    for k, v in args.items():
+        if v is None or v is False or k == 'input_file':
+            continue
+        # store_true options
+        if v is True:
+            ret.append('--{}'.format(k))
+            continue
+        # options which can be given more than once
+        for value in (v if isinstance(v, list) else [v]):
+            ret.append('--{} {}'.format(k, value))
+    return ' '.join(ret)
+
+
+def _lsf_walltime(walltime):
+    # parse walltime for lsf to hh:mm format
+    match=re.search(r'^(\d+):(\d{1,2}):(\d{1,2})$', walltime)
+    if match:
+        return '{}:{}'.format(match.group(1), match.group(2))
+    else:
+        raise RuntimeError('Could not parse walltime: "{}"'.format(walltime))
+
 
 def makePBS(mem, ppn, walltime, wd, args, shell='tcsh'):
     pbsName = '{}/{}.pbs'.format(wd, ENV_FINDER_EXE)
-    _flags = ' '.join(['--{} {}'.format(k,v) for k, v in args.items() if v is not None and k != 'input_file'])
+    _flags = _format_flags(args)
 
     sys.stdout.write('Writing {}...'.format(pbsName))
     with open(pbsName, 'w') as outF:
@@ -27,15 +56,10 @@ def makePBS(mem, ppn, walltime, wd, args, shell='tcsh'):
 
 
 def makeLSF(mem, ppn, walltime, wd, args, shell='bash'):
-    # parse walltime for lsf to hh:mm format
-    match=re.search(r'^(\d+):(\d{1,2}):(\d{1,2})$', walltime)
-    if match:
-        _walltime='{}:{}'.format(match.group(1), match.group(2))
-    else:
-        raise RuntimeError('Could not parse walltime: "{}"'.format(walltime))    
+    _walltime = _lsf_walltime(walltime)
 
     lsfName = '{}/{}.lsf'.format(wd, ENV_FINDER_EXE)
-    _flags = ' '.join(['--{} {}'.format(k,v) for k, v in args.items() if v is not None and k != 'input_file'])
+    _flags = _format_flags(args)
 
     sys.stdout.write('Writing {}...'.format(lsfName))
     with open(lsfName, 'w') as outF:
@@ -49,28 +73,156 @@ def makeLSF(mem, ppn, walltime, wd, args, shell='bash'):
     return lsfName
 
 
-JOB_TYPES = {'pbs': {'makeJob': makePBS, 'qsub': 'qsub'},
-             'lsf': {'makeJob': makeLSF, 'qsub': 'bsub <'}}
+def makePBSArray(mem, ppn, walltime, wd, args, shard_dir, n_shards, jobName, shell='tcsh'):
+    pbsName = '{}/{}_array.pbs'.format(wd, ENV_FINDER_EXE)
+    _flags = _format_flags(args)
+
+    sys.stdout.write('Writing {}...'.format(pbsName))
+    with open(pbsName, 'w') as outF:
+        outF.write("#!/usr/bin/env {}\n".format(shell))
+        outF.write('#PBS -l mem={}gb,nodes=1:ppn={},walltime={}\n'.format(mem, ppn, walltime))
+        outF.write('#PBS -t 1-{} -N {}\n\n'.format(n_shards, jobName))
+        outF.write('cd {}\n'.format(wd))
+        outF.write('{0} {1} {2}/shard_${{PBS_ARRAYID}}.tsv > {2}/stdout_${{PBS_ARRAYID}}.txt\n'.format(ENV_FINDER_EXE, _flags, shard_dir))
+
+    sys.stdout.write('Done!\n')
+    return pbsName
+
+
+def makePBSMerge(wd, manifest, jobName, shell='tcsh'):
+    pbsName = '{}/{}_merge.pbs'.format(wd, ENV_FINDER_EXE)
+
+    sys.stdout.write('Writing {}...'.format(pbsName))
+    with open(pbsName, 'w') as outF:
+        outF.write("#!/usr/bin/env {}\n".format(shell))
+        outF.write('#PBS -l mem=1gb,nodes=1:ppn=1,walltime=01:00:00\n')
+        outF.write('#PBS -N {}_merge\n\n'.format(jobName))
+        outF.write('cd {}\n'.format(wd))
+        outF.write('{} {} > merge_stdout.txt\n'.format(MERGE_EXE, manifest))
+
+    sys.stdout.write('Done!\n')
+    return pbsName
+
+
+def makeLSFArray(mem, ppn, walltime, wd, args, shard_dir, n_shards, jobName, shell='bash'):
+    _walltime = _lsf_walltime(walltime)
+
+    lsfName = '{}/{}_array.lsf'.format(wd, ENV_FINDER_EXE)
+    _flags = _format_flags(args)
+
+    sys.stdout.write('Writing {}...'.format(lsfName))
+    with open(lsfName, 'w') as outF:
+        outF.write("#!/usr/bin/env {}\n".format(shell))
+        outF.write('#BSUB -W {} -n {} -R "rusage[mem={}]" -R span[hosts=1] -q short -J "{}[1-{}]"\n'.format(_walltime, ppn, mem * 1024, jobName, n_shards))
+        outF.write('#BSUB -o stdout.%J.%I -e stderr.%J.%I\n\n')
+        outF.write('cd {}\n'.format(wd))
+        outF.write('{0} {1} {2}/shard_${{LSB_JOBINDEX}}.tsv > {2}/stdout_${{LSB_JOBINDEX}}.txt\n'.format(ENV_FINDER_EXE, _flags, shard_dir))
+    sys.stdout.write('Done!\n')
+
+    return lsfName
+
+
+def makeLSFMerge(wd, manifest, jobName, shell='bash'):
+    lsfName = '{}/{}_merge.lsf'.format(wd, ENV_FINDER_EXE)
+
+    sys.stdout.write('Writing {}...'.format(lsfName))
+    with open(lsfName, 'w') as outF:
+        outF.write("#!/usr/bin/env {}\n".format(shell))
+        outF.write('#BSUB -W 1:00 -n 1 -R "rusage[mem=1024]" -q short -J {0}_merge -w "done({0})"\n'.format(jobName))
+        outF.write('#BSUB -o stdout.%J -e stderr.%J\n\n')
+        outF.write('cd {}\n'.format(wd))
+        outF.write('{} {} > merge_stdout.txt\n'.format(MERGE_EXE, manifest))
+    sys.stdout.write('Done!\n')
+
+    return lsfName
+
+
+def _submitPBSArray(array_file, merge_file, wd):
+    array_id = subprocess.run(['qsub', array_file], cwd=wd, check=True,
+                              stdout=subprocess.PIPE).stdout.decode().strip()
+    sys.stdout.write('Submitted job array {}\n'.format(array_id))
+    subprocess.run(['qsub', '-W', 'depend=afterokarray:{}'.format(array_id), merge_file], cwd=wd, check=True)
+
+
+def _submitLSFArray(array_file, merge_file, wd):
+    # The dependency on the array is in the merge job file.
+    for f in (array_file, merge_file):
+        with open(f, 'r') as inF:
+            subprocess.run(['bsub'], cwd=wd, stdin=inF, check=True)
+
+
+JOB_TYPES = {'pbs': {'makeJob': makePBS, 'qsub': 'qsub',
+                     'makeArray': makePBSArray, 'makeMerge': makePBSMerge, 'submitArray': _submitPBSArray},
+             'lsf': {'makeJob': makeLSF, 'qsub': 'bsub <',
+                     'makeArray': makeLSFArray, 'makeMerge': makeLSFMerge, 'submitArray': _submitLSFArray}}
+
+
+def _get_envoMatch_args(args, parent_args):
+    '''
+    Get the options passed to envoMatch in job files.
+
+    Parameters
+    ----------
+    args: argparse.Namespace
+        Parsed qsubmit arguments.
+    parent_args: argparse.Namespace
+        Arguments parsed with PARENT_PARSER. Only these options are passed to envoMatch.
+
+    Returns
+    -------
+        Dict of option names and values for _format_flags.
+    '''
+    ret = {arg: getattr(args, arg) for arg in vars(parent_args)}
+    if args.plot_score_range is not None:
+        ret['plot_score_range'] = ' '.join(str(x) for x in args.plot_score_range)
+    return ret
 
 
 def main():
     parser = argparse.ArgumentParser(prog='qsub_envoMatch', parents=[parent_parser.PARENT_PARSER],
                                      description='Submit {} job to the queue.'.format(ENV_FINDER_EXE))
 
-    parser.add_argument('-m', '--mem', default=8, type=int,
-                        help='Amount of memory to allocate per job in gb. Default is 4.')
+    parser.add_argument('-m', '--mem', default=None, type=int,
+                        help='Amount of memory to allocate per job in gb. Default is 8.')
 
-    parser.add_argument('-p', '--ppn', default=8, type=int,
-                        help='Number of processors to allocate per job. Default is 8.')
+    parser.add_argument('-p', '--ppn', default=None, type=int,
+                        help='Number of processors to allocate per job. Default is 8. '
+                             'With --resources, this is the maximum number of processors.')
 
     parser.add_argument('--jobType', choices=['pbs', 'lsf'], default='pbs',
                         help='Job type. Default is "pbs"')
 
     parser.add_argument('--shell', default='tcsh', help='The shell to use in job files')
 
-    parser.add_argument('-w', '--walltime', default='12:00:00',
+    parser.add_argument('-w', '--walltime', default=None,
                         help='Walltime per job in the format hh:mm:ss. Default is 12:00:00.')
 
+    parser.add_argument('--resources', choices=['fixed', 'suggest', 'auto'], default='fixed',
+                        help='How should --mem, --ppn and --walltime be chosen? '
+                             '"fixed" uses the values given or their defaults. '
+                             '"suggest" prints an estimate based on the number of input rows, the size of the '
+                             'ms1 files and the envoMatch options, but uses the values given or their defaults. '
+                             '"auto" uses the estimate for values which are not given. Default is "fixed".')
+
+    parser.add_argument('--calibration', default=None, nargs='+', metavar='PROFILE_JSON',
+                        help='Calibrate resource estimates with summaries written by envoMatch --profile '
+                             'on this cluster. By default, costs measured on the example data are used.')
+
+    parser.add_argument('--shards', default=None, type=int,
+                        help='Split the input file into this many shards and submit a job array with one task '
+                             'per shard followed by a job to merge the output in the original row order. '
+                             '--mem, --ppn and --walltime are per shard. By default a single job is submitted.')
+
+    parser.add_argument('--shard_by', choices=['parent_file', 'row'], default='parent_file',
+                        help='How should the input be split into shards? "parent_file" keeps all rows for each '
+                             'parent file in the same shard so each ms1 file is only read by one job. '
+                             'The number of shards is at most the number of parent files. '
+                             '"row" splits the input into blocks of rows. Default is parent_file.')
+
+    parser.add_argument('--local', action='store_true', default=False,
+                        help='Run the job array and merge job on this machine with a fake scheduler '
+                             'instead of submitting them. Only used with --shards.')
+
     parser.add_argument('-g', '--go', action='store_true', default=False,
                         help='Should job be submitted? If this flag is not supplied, program will be a dry run. '
                              'job file will written but job will not be submitted.')
@@ -78,15 +230,6 @@ def main():
     args = parser.parse_args()
     parent_args = parent_parser.PARENT_PARSER.parse_known_args()[0]
 
-    # calc nThread
-    if args.parallel and args.nThread is None:
-        _nThread = args.ppn * 2
-    elif not args.parallel and args.nThread is None:
-        _nThread=1
-    else:
-        _nThread = args.nThread
-        args.ppn = ceil(args.nThread / 2) * 2
-
     # Manually check args
     n_arg_errors = 0
     error_message = '\nThere were errors in the options you specified...'
@@ -94,20 +237,35 @@ def main():
         error_message += '\n\tSpecified input file: {} does not exist on path:\n\t\t{}\n'.format(args.input_file,
                                                                                                  os.path.abspath(args.input_file))
         n_arg_errors += 1
+    if args.shards is not None and args.shards < 1:
+        error_message += '\n\t--shards must be > 0\n'
+        n_arg_errors += 1
+    if args.shards is not None and args.shard_by == 'row' and args.plotEnv and args.plot_format == 'multipdf':
+        error_message += '\n\t--plot_format multipdf can not be used with --shard_by row\n'
+        n_arg_errors += 1
+    if args.calibration is not None:
+        for fname in args.calibration:
+            if not os.path.isfile(fname):
+                error_message += '\n\tCalibration file: {} does not exist\n'.format(fname)
+                n_arg_errors += 1
     if n_arg_errors > 0:
         sys.stderr.write(error_message)
         return -1
 
-    sys.stdout.write('\nRequested job with {} processor(s) and {}gb of memory...\n'.format(args.ppn, args.mem))
     #get wd
     wd = os.path.dirname(os.path.abspath(args.input_file))
 
-    envoMatch_args = {arg: getattr(args, arg) for arg in vars(parent_args)}
-    _nThread = args.nThread
-    envoMatch_args['nThread'] = _nThread
-    envoMatch_args['plotEnv'] = '' if args.plotEnv else None
-    envoMatch_args['splitPlots'] = '' if args.splitPlots else None
-    envoMatch_args['verbose'] = '' if args.verbose else None
+    envoMatch_args = _get_envoMatch_args(args, parent_args)
+
+    if args.shards is not None:
+        return _submit_shards(args, envoMatch_args, wd)
+
+    if args.resources == 'fixed':
+        _set_resources(args)
+    else:
+        from . import resources
+        _set_resources(args, *resources.count_rows(args.input_file))
+    envoMatch_args['nThread'] = args.nThread
 
     jobName = JOB_TYPES[args.jobType]['makeJob'](args.mem, args.ppn, args.walltime, wd, envoMatch_args, shell=args.shell)
     command = '{} {}'.format(JOB_TYPES[args.jobType]['qsub'], jobName)
@@ -117,6 +275,81 @@ def main():
         proc = subprocess.Popen([command], cwd=wd, shell=True)
         proc.wait()
 
+
+def _set_resources(args, nRow=None, parent_files=None):
+    '''
+    Set --mem, --ppn and --walltime in args.
+
+    With --resources suggest or auto, resources are estimated for a job
+    with nRow input rows from parent_files.
+    '''
+
+    # Hyperthreads are not counted as processors.
+    if args.nThread is not None:
+        args.ppn = ceil(args.nThread / 2) * 2
+
+    if args.resources != 'fixed':
+        from . import resources
+        costs = None if args.calibration is None else resources.calibrate(args.calibration)
+        ms1_mb = resources.get_ms1_mb(parent_files, args.input_file, args)
+        estimate = resources.estimate(nRow, ms1_mb, len(parent_files), args,
+                                      DEFAULT_RESOURCES['ppn'] if args.ppn is None else args.ppn,
+                                      costs=costs)
+        sys.stdout.write('\nEstimated {}gb of memory, {} processor(s) and a walltime of {} for {} rows '
+                         '({:.0f} seconds and {:.0f}mb without safety margins)\n'.format(estimate['mem'], estimate['ppn'],
+                                                                                         estimate['walltime'], nRow,
+                                                                                         estimate['seconds'], estimate['mb']))
+        if args.resources == 'auto':
+            for key in ('mem', 'ppn', 'walltime'):
+                if getattr(args, key) is None:
+                    setattr(args, key, estimate[key])
+            # envoMatch would otherwise use every cpu on the node.
+            if args.parallel and args.nThread is None:
+                args.nThread = estimate['nThread']
+
+    for key, value in DEFAULT_RESOURCES.items():
+        if getattr(args, key) is None:
+            setattr(args, key, value)
+
+    sys.stdout.write('\nRequested job with {} processor(s), {}gb of memory and a walltime of {}...\n'.format(args.ppn, args.mem,
+                                                                                                          args.walltime))
+
+
+def _submit_shards(args, envoMatch_args, wd):
+    from . import shard
+
+    sys.stdout.write('Splitting {} into shards by {}...'.format(args.input_file, args.shard_by))
+    manifest_fname = shard.split_input(args.input_file, args.shards, by=args.shard_by,
+                                       overwrite=bool(args.overwrite))
+    manifest = shard.read_manifest(manifest_fname)
+    shard_dir = os.path.dirname(manifest_fname)
+    n_shards = len(manifest['shards'])
+    sys.stdout.write('Done!\n')
+    for i, s in enumerate(manifest['shards']):
+        sys.stdout.write('\tShard {}: {} rows from {} parent file(s)\n'.format(i + 1, s['nRow'], len(s['parent_files'])))
+
+    # Resources are per shard, so they are estimated for the largest shard.
+    largest = max(manifest['shards'], key=lambda x: x['nRow'])
+    _set_resources(args, largest['nRow'], largest['parent_files'])
+    envoMatch_args['nThread'] = args.nThread
+
+    # Shards are not in the same directory as the ms1 files.
+    envoMatch_args['ms1_prefix'] = [wd] + [os.path.abspath(x) for x in (args.ms1_prefix or [])]
+
+    jobName = '{}_{}'.format(ENV_FINDER_EXE, os.path.splitext(os.path.basename(args.input_file))[0])
+    job_type = JOB_TYPES[args.jobType]
+    array_file = job_type['makeArray'](args.mem, args.ppn, args.walltime, wd, envoMatch_args,
+                                       shard_dir, n_shards, jobName, shell=args.shell)
+    merge_file = job_type['makeMerge'](wd, manifest_fname, jobName, shell=args.shell)
+
+    if args.local:
+        if not shard.run_local(args.jobType, array_file, merge_file, n_shards, shell=args.shell, wd=wd):
+            return -1
+        sys.stdout.write('Wrote {}\n'.format(manifest['output_file']))
+    elif args.go:
+        job_type['submitArray'](array_file, merge_file, wd)
+    return 0
+
+
 if __name__ == '__main__':
     main()
-
@@ -0,0 +1,211 @@
+
+import sys
+import os
+import csv
+import json
+from math import ceil
+
+from .main import get_ms1_file_names
+
+# Costs measured with --profile on the example data (3 mzML files, 221 rows).
+# Thread seconds are the seconds one processor spends on each row or plot.
+DEFAULT_COSTS = {'startup_seconds': 2.0,
+                 'seconds_per_ms1_mb': 0.3,
+                 'thread_seconds_per_row': {'isotopologues': 0.32, 'convolution': 0.025},
+                 'thread_seconds_per_plot': 0.2,
+                 'process_mb': 150.0,
+                 'mb_per_ms1_mb': 0.02,
+                 'mb_per_envelope': 0.002,
+                 'mb_per_row': 0.002,
+                 'mb_per_plot': 0.02}
+
+# Margins added to estimates.
+WALLTIME_SAFETY = 1.5
+MIN_WALLTIME_SECONDS = 10 * 60
+MEM_SAFETY = 1.5
+
+# Fewer processors are requested if there are fewer rows than this per processor.
+MIN_ROWS_PER_PROCESSOR = 250
+
+
+def count_rows(fname):
+    '''
+    Count rows and get unique parent files in an envoMatch input file.
+
+    Returns
+    -------
+    nRow: int
+    parent_files: list
+    '''
+    parent_files = dict()
+    nRow = 0
+    with open(fname, 'r', newline='') as inF:
+        reader = csv.reader(inF, delimiter='\t')
+        headers = next(reader)
+        if 'parent_file' not in headers:
+            raise RuntimeError('Required column: parent_file, not found in {}!'.format(fname))
+        parent_file_i = headers.index('parent_file')
+        for line in reader:
+            parent_files[line[parent_file_i]] = None
+            nRow += 1
+    return nRow, list(parent_files.keys())
+
+
+def get_ms1_mb(parent_files, input_file, args):
+    '''
+    Get the total size of the ms1 files for parent_files in MB.
+    Returns None if any of the files can not be found.
+    '''
+    try:
+        ms1_file_names = get_ms1_file_names(parent_files, input_file, args.ms1_prefix, args.file_type)
+    except RuntimeError as e:
+        sys.stderr.write('WARN: {}\n'.format(e))
+        return None
+    return sum(os.path.getsize(x) for x in ms1_file_names.values()) / 1024 ** 2
+
+
+def calibrate(profile_fnames, costs=None):
+    '''
+    Calibrate costs from summaries written by envoMatch --profile.
+
+    Each cost measured in the profiles is replaced by its mean across profiles.
+    Costs which are not measured are taken from `costs`.
+
+    Parameters
+    ----------
+    profile_fnames: list
+        Paths to <output_file_base>.profile.json files.
+    costs: dict
+        Costs to start from. Default is DEFAULT_COSTS.
+
+    Returns
+    -------
+    costs: dict
+    '''
+
+    costs = json.loads(json.dumps(DEFAULT_COSTS if costs is None else costs))
+    measured = dict()
+
+    def _add(key, value):
+        measured.setdefault(key, list()).append(value)
+
+    for fname in profile_fnames:
+        with open(fname, 'r') as inF:
+            profile = json.load(inF)
+        if 'nCpu' not in profile:
+            raise RuntimeError('{} was written by an older version of envoMatch and can not be used!'.format(fname))
+
+        stages = profile['stages']
+        nThread = profile['nThread']
+        # Stage times are wall times in each process, so they are longer than
+        # the cpu time when there are more threads than cpus.
+        nWorker = min(nThread, profile['nCpu'] or nThread)
+        nRow = profile['nRow']
+        nPlot = profile['nPlot']
+        ms1_mb = profile['ms1_mb']
+        engine = profile['args']['env_engine']
+
+        wall = profile['wall_seconds'] - costs['startup_seconds']
+        if 'ms1_index' in stages and ms1_mb > 0:
+            nIndex = max(1, min(nThread, profile['nMs1File']))
+            index_seconds = stages['ms1_index']['seconds'] * min(nWorker, nIndex) / nIndex
+            _add('seconds_per_ms1_mb', index_seconds / ms1_mb)
+            wall -= index_seconds / min(nWorker, nIndex)
+        if 'plotting' in stages and nPlot > 0:
+            plot_seconds = stages['plotting']['seconds'] * nWorker / nThread
+            _add('thread_seconds_per_plot', plot_seconds / nPlot)
+            wall -= plot_seconds / nWorker
+        if nRow > 0:
+            _add(('thread_seconds_per_row', engine), max(wall, 0) * nWorker / nRow)
+
+        # Rss of the main process includes the input rows. Workers only hold ms1 indices.
+        worker_rss = [v for k, v in profile['max_rss_mb'].items() if int(k) != profile['main_pid']]
+        if worker_rss:
+            process_mb = max(worker_rss)
+            _add('process_mb', process_mb)
+            main_rss = profile['max_rss_mb'].get(str(profile['main_pid']))
+            if main_rss is not None and main_rss > process_mb and nRow > 0:
+                _add('mb_per_row', (main_rss - process_mb) / nRow)
+
+    for key, values in measured.items():
+        value = sum(values) / len(values)
+        if isinstance(key, tuple):
+            costs[key[0]][key[1]] = value
+        else:
+            costs[key] = value
+
+    return costs
+
+
+def _format_walltime(seconds):
+    # round up to 15 minutes
+    minutes = int(ceil(seconds / 60 / 15) * 15)
+    return '{}:{:02d}:00'.format(minutes // 60, minutes % 60)
+
+
+def estimate(nRow, ms1_mb, nMs1File, args, ppn, costs=None):
+    '''
+    Estimate the resources needed to run envoMatch.
+
+    Parameters
+    ----------
+    nRow: int
+        Number of input rows.
+    ms1_mb: float
+        Total size of ms1 files in MB. If None, ms1 files are ignored.
+    nMs1File: int
+        Number of ms1 files.
+    args: argparse.Namespace
+        envoMatch options.
+    ppn: int
+        Maximum number of processors.
+    costs: dict
+        Costs returned by calibrate. Default is DEFAULT_COSTS.
+
+    Returns
+    -------
+    estimate: dict
+        Dict with mem (gb), ppn, walltime (hh:mm:ss) and the estimated
+        seconds and mb before safety margins are added.
+    '''
+
+    costs = DEFAULT_COSTS if costs is None else costs
+    ms1_mb = 0 if ms1_mb is None else ms1_mb
+
+    ppn = max(1, min(ppn, int(ceil(nRow / MIN_ROWS_PER_PROCESSOR))))
+    nThread = ppn * 2 if args.nThread is None else args.nThread
+    if not args.parallel and args.nThread is None:
+        nThread = 1
+    # Hyperthreads are not counted as extra processors.
+    nWorker = min(nThread, ppn)
+
+    nPlot = 0
+    if args.plotEnv:
+        nPlot = nRow
+        if args.plot_sample is not None:
+            nPlot = min(nRow, args.plot_sample * max(nMs1File, 1))
+
+    seconds = costs['startup_seconds']
+    seconds += ms1_mb * costs['seconds_per_ms1_mb'] / max(1, min(nWorker, nMs1File))
+    seconds += nRow * costs['thread_seconds_per_row'][args.env_engine] / nWorker
+    seconds += nPlot * costs['thread_seconds_per_plot'] / nWorker
+
+    # Each worker has an index of each ms1 file and its own envelope cache.
+    # With --chunk_size, only one chunk is in memory and plot workers run at the same time as search workers.
+    nProcess = nThread + 1
+    nRow_in_memory = nRow
+    if args.chunk_size is not None:
+        nRow_in_memory = min(nRow, args.chunk_size)
+        if args.plotEnv:
+            nProcess += nThread
+    nEnvelope = min(nRow * 2, args.env_cache_size)
+    mb = nProcess * (costs['process_mb'] + ms1_mb * costs['mb_per_ms1_mb'] + nEnvelope * costs['mb_per_envelope'])
+    mb += nRow_in_memory * costs['mb_per_row']
+    mb += (nPlot if args.plot_sample is not None else min(nPlot, nRow_in_memory)) * costs['mb_per_plot']
+
+    return {'mem': max(1, int(ceil(mb * MEM_SAFETY / 1024))),
+            'ppn': ppn,
+            'walltime': _format_walltime(max(MIN_WALLTIME_SECONDS, seconds * WALLTIME_SAFETY)),
+            'nThread': nThread,
+            'seconds': seconds,
+            'mb': mb}
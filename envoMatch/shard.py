@@ -0,0 +1,272 @@
+
+import sys
+import os
+import csv
+import json
+import heapq
+import argparse
+import subprocess
+
+from .main import get_ofname
+
+ROW_INDEX_COLUMN = '_envoMatch_row'
+MANIFEST_VERSION = 1
+
+# Environment variable with the array index of each task for each job type.
+ARRAY_INDEX_VARIABLES = {'pbs': 'PBS_ARRAYID', 'lsf': 'LSB_JOBINDEX'}
+
+
+def _open_tsv(fname, mode):
+    return open(fname, mode, newline='')
+
+
+def _writer(outF):
+    # Same dialect as DataFrame.to_csv so merged output is identical to a single run.
+    return csv.writer(outF, delimiter='\t', lineterminator='\n')
+
+
+def _assign_parent_files(counts, n_shards):
+    '''
+    Assign parent files to shards so the number of rows in each shard is similar.
+    Files are added from largest to smallest to the shard with the fewest rows.
+
+    Parameters
+    ----------
+    counts: dict
+        Number of rows for each parent file.
+    n_shards: int
+
+    Returns
+    -------
+    assignments: dict
+        Shard index for each parent file.
+    '''
+    heap = [(0, i) for i in range(n_shards)]
+    assignments = dict()
+    for parent_file, count in sorted(counts.items(), key=lambda x: (-x[1], x[0])):
+        nRow, i = heapq.heappop(heap)
+        assignments[parent_file] = i
+        heapq.heappush(heap, (nRow + count, i))
+    return assignments
+
+
+def split_input(input_file, n_shards, by='parent_file', overwrite=False, shard_dir=None):
+    '''
+    Split an envoMatch input file into shards.
+
+    The index of each row in input_file is added to each shard in the column ROW_INDEX_COLUMN,
+    so merge_shards can write the output in the original row order.
+
+    Parameters
+    ----------
+    input_file: str
+        Path to input file.
+    n_shards: int
+        Maximum number of shards. If `by` is 'parent_file', the number of shards
+        is at most the number of parent files.
+    by: str
+        Either 'parent_file' or 'row'. 'parent_file' puts all the rows for each
+        parent file in the same shard, so each ms1 file is only read by one job.
+        'row' splits the input into contiguous blocks of rows.
+    overwrite: bool
+        Value of --overwrite used to process the shards.
+    shard_dir: str
+        Directory to write shards to. The default is <input_file_base>_shards.
+
+    Returns
+    -------
+    manifest_fname: str
+        Path to the shard manifest. Shards are named shard_<n>.tsv with n starting from 1.
+    '''
+
+    if n_shards < 1:
+        raise RuntimeError('Number of shards must be > 0!')
+    if by not in ('parent_file', 'row'):
+        raise ValueError('{} is a invalid argument for by'.format(by))
+
+    input_file = os.path.abspath(input_file)
+    if shard_dir is None:
+        shard_dir = '{}_shards'.format(os.path.splitext(input_file)[0])
+    shard_dir = os.path.abspath(shard_dir)
+    os.makedirs(shard_dir, exist_ok=True)
+
+    # first pass to count rows
+    with _open_tsv(input_file, 'r') as inF:
+        reader = csv.reader(inF, delimiter='\t')
+        headers = next(reader)
+        if ROW_INDEX_COLUMN in headers:
+            raise RuntimeError('{} already has a {} column!'.format(input_file, ROW_INDEX_COLUMN))
+        if 'parent_file' not in headers:
+            raise RuntimeError('Required column: parent_file, not found in {}!'.format(input_file))
+        parent_file_i = headers.index('parent_file')
+        counts = dict()
+        nRow = 0
+        for line in reader:
+            counts[line[parent_file_i]] = counts.get(line[parent_file_i], 0) + 1
+            nRow += 1
+
+    if nRow == 0:
+        raise RuntimeError('No rows found in {}!'.format(input_file))
+
+    if by == 'parent_file':
+        n_shards = min(n_shards, len(counts))
+        assignments = _assign_parent_files(counts, n_shards)
+        get_shard = lambda i, line: assignments[line[parent_file_i]]
+    else:
+        n_shards = max(1, min(n_shards, nRow))
+        rows_per_shard = -(-nRow // n_shards)
+        get_shard = lambda i, line: i // rows_per_shard
+
+    shards = [{'input': os.path.join(shard_dir, 'shard_{}.tsv'.format(i + 1)),
+               'nRow': 0, 'parent_files': list()} for i in range(n_shards)]
+
+    # second pass to write shards
+    outFs = [_open_tsv(x['input'], 'w') for x in shards]
+    try:
+        writers = [_writer(x) for x in outFs]
+        for w in writers:
+            w.writerow(headers + [ROW_INDEX_COLUMN])
+        with _open_tsv(input_file, 'r') as inF:
+            reader = csv.reader(inF, delimiter='\t')
+            next(reader)
+            for i, line in enumerate(reader):
+                shard_i = get_shard(i, line)
+                writers[shard_i].writerow(line + [str(i)])
+                shards[shard_i]['nRow'] += 1
+                if line[parent_file_i] not in shards[shard_i]['parent_files']:
+                    shards[shard_i]['parent_files'].append(line[parent_file_i])
+    finally:
+        for f in outFs:
+            f.close()
+
+    for s in shards:
+        s['output'] = get_ofname(s['input'], overwrite=overwrite)
+
+    manifest = {'version': MANIFEST_VERSION,
+                'input_file': input_file,
+                'output_file': get_ofname(input_file, overwrite=overwrite),
+                'nRow': nRow,
+                'by': by,
+                'shards': shards}
+    manifest_fname = os.path.join(shard_dir, 'manifest.json')
+    with open(manifest_fname, 'w') as outF:
+        json.dump(manifest, outF, indent=2)
+
+    return manifest_fname
+
+
+def read_manifest(fname):
+    with open(fname, 'r') as inF:
+        manifest = json.load(inF)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise RuntimeError('{} is not a supported shard manifest!'.format(fname))
+    return manifest
+
+
+def _iter_shard_rows(fname, headers, index_i):
+    with _open_tsv(fname, 'r') as inF:
+        reader = csv.reader(inF, delimiter='\t')
+        if next(reader) != headers:
+            raise RuntimeError('Columns in {} do not match the other shards!'.format(fname))
+        for line in reader:
+            yield int(line[index_i]), line
+
+
+def merge_shards(manifest_fname):
+    '''
+    Merge the envoMatch output of each shard into a single file in the original row order.
+
+    Rows in each shard output are already in order, so shards are merged
+    without reading them into memory.
+
+    Returns
+    -------
+    ofname: str
+        Path to merged output file.
+    '''
+
+    manifest = read_manifest(manifest_fname)
+    missing = [s['output'] for s in manifest['shards'] if not os.path.isfile(s['output'])]
+    if missing:
+        raise RuntimeError('Output for {} shard(s) not found:\n\t{}'.format(len(missing), '\n\t'.join(missing)))
+
+    with _open_tsv(manifest['shards'][0]['output'], 'r') as inF:
+        headers = next(csv.reader(inF, delimiter='\t'))
+    index_i = headers.index(ROW_INDEX_COLUMN)
+
+    ofname = manifest['output_file']
+    tmp_ofname = '{}.tmp'.format(ofname)
+    nRow = 0
+    with _open_tsv(tmp_ofname, 'w') as outF:
+        writer = _writer(outF)
+        writer.writerow(headers[:index_i] + headers[index_i + 1:])
+        for i, line in heapq.merge(*[_iter_shard_rows(s['output'], headers, index_i) for s in manifest['shards']],
+                                   key=lambda x: x[0]):
+            if i != nRow:
+                raise RuntimeError('Row {} is missing from the shard output!'.format(nRow))
+            writer.writerow(line[:index_i] + line[index_i + 1:])
+            nRow += 1
+
+    if nRow != manifest['nRow']:
+        os.remove(tmp_ofname)
+        raise RuntimeError('Merged output has {} rows but {} has {} rows!'.format(nRow, manifest['input_file'],
+                                                                                  manifest['nRow']))
+    os.replace(tmp_ofname, ofname)
+    return ofname
+
+
+def run_local(job_type, array_file, merge_file, n_tasks, shell='bash', wd=None):
+    '''
+    Fake scheduler which runs a job array and its merge job locally.
+
+    Each array task is run in order with the array index environment variable of job_type set,
+    then the merge job is run if all the tasks were successful.
+
+    Parameters
+    ----------
+    job_type: str
+        Either 'pbs' or 'lsf'.
+    array_file: str
+        Path to job array file.
+    merge_file: str
+        Path to merge job file.
+    n_tasks: int
+        Number of tasks in the array.
+    shell: str
+        Shell used to run the job files.
+    wd: str
+        Working directory to run jobs in.
+
+    Returns
+    -------
+    success: bool
+    '''
+
+    for i in range(1, n_tasks + 1):
+        sys.stdout.write('Running array task {} of {}...\n'.format(i, n_tasks))
+        env = dict(os.environ)
+        env[ARRAY_INDEX_VARIABLES[job_type]] = str(i)
+        if subprocess.run([shell, array_file], cwd=wd, env=env).returncode != 0:
+            sys.stderr.write('ERROR: Array task {} failed!\n'.format(i))
+            return False
+
+    sys.stdout.write('Running merge job...\n')
+    if subprocess.run([shell, merge_file], cwd=wd).returncode != 0:
+        sys.stderr.write('ERROR: Merge job failed!\n')
+        return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='merge_envoMatch',
+                                     description='Merge the output of sharded envoMatch jobs '
+                                                 'into a single file in the original row order.')
+    parser.add_argument('manifest', help='Path to shard manifest written by run_envoMatch --shards.')
+    args = parser.parse_args()
+
+    ofname = merge_shards(args.manifest)
+    sys.stdout.write('Wrote {}\n'.format(ofname))
+
+
+if __name__ == '__main__':
+    main()
@@ -10,15 +10,15 @@ setup(name='envoMatch',
         'Intended Audience :: SCIENCE/RESEARCH',
         'Topic :: Software Development :: Build Tools',
         'License :: OSI Approved :: MIT License',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: 3.8',
         ],
       packages=find_packages(),
       package_dir={'envoMatch':'envoMatch'},
-      python_requires='>=3.6.*',
+      python_requires='>=3.7',
       install_requires=['pyteomics>=4.4', 'lxml>=4.4', 'tqdm', 'sortedcontainers>=2.3', 'pandas>=1.0', 'matplotlib>=3.3'],
-      entry_points={'console_scripts': ['envoMatch=envoMatch:main', 'run_envoMatch=envoMatch:qsubmit']},
+      entry_points={'console_scripts': ['envoMatch=envoMatch:main', 'run_envoMatch=envoMatch:qsubmit',
+                                          'merge_envoMatch=envoMatch:merge', 'convert_envoMatch=envoMatch:convert']},
 )
 
 
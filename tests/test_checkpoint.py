@@ -0,0 +1,22 @@
+
+import sys
+import importlib
+
+import pytest
+
+# envoMatch.main is the entry point function, not the module
+envoMatch_main = importlib.import_module('envoMatch.main')
+
+
+def test_existing_checkpoint_requires_resume(tmp_path, monkeypatch):
+    (tmp_path / 'input.tsv').write_text('parent_file\tscan\tsequence\tformula\tcharge\n')
+    checkpoint = tmp_path / 'input_env.tsv.checkpoint'
+    checkpoint.write_text('row\tparent_file\tscan\tsequence\tgood_envelope\tenv_score\n0\ta.mzML\t1\tPEPTIDE\tTrue\t0.9\n')
+    contents = checkpoint.read_text()
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'argv', ['envoMatch', 'input.tsv'])
+    with pytest.raises(RuntimeError, match='--resume'):
+        envoMatch_main.main()
+    assert checkpoint.read_text() == contents
+
@@ -0,0 +1,42 @@
+
+import pickle
+
+import pytest
+
+from envoMatch.modules.atom_table import EnvelopeCache
+
+_KEY = ((('C', 10), ('H', 20), ('H+', 2)), 0.01, 0.05, True, 'isotopologues')
+_ENVELOPE = ((100.5, 1.0), (101.0, 0.5))
+
+
+def test_read_written_cache(tmp_path):
+    fname = str(tmp_path / 'cache.pkl')
+    cache = EnvelopeCache()
+    cache.put(_KEY, _ENVELOPE)
+    cache.write(fname)
+
+    cache = EnvelopeCache()
+    assert cache.read(fname)
+    assert cache.get(_KEY) == _ENVELOPE
+
+
+@pytest.mark.parametrize('contents', [
+    b'',                                      # EOFError
+    b'\x80\x04\x95',                          # truncated
+    b'cnot_a_module\nThing\n.',               # ImportError
+    b'cos\nnot_a_function\n.',                # AttributeError
+    b'garbage',                               # UnpicklingError
+    pickle.dumps([1, 2, 3]),
+    pickle.dumps({'version': 2, 'envelopes': [(_KEY, _ENVELOPE)]}),
+    pickle.dumps({'version': EnvelopeCache._FILE_VERSION, 'key_format': ('composition',),
+                  'envelopes': [(_KEY, _ENVELOPE)]}),
+    pickle.dumps({'version': EnvelopeCache._FILE_VERSION, 'key_format': EnvelopeCache._KEY_FORMAT,
+                  'envelopes': 1}),
+])
+def test_bad_cache_is_ignored(tmp_path, capsys, contents):
+    fname = tmp_path / 'cache.pkl'
+    fname.write_bytes(contents)
+    cache = EnvelopeCache()
+    assert not cache.read(str(fname))
+    assert len(cache) == 0
+    assert 'WARN' in capsys.readouterr().err
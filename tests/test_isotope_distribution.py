@@ -0,0 +1,37 @@
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from pyteomics.mass import Composition
+
+from envoMatch.modules import utils
+from envoMatch.modules.atom_table import getEnvelope
+
+EXAMPLE_INPUT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'examples', 'input.tsv')
+
+# Peaks from the two engines only differ by floating point rounding.
+MZ_TOLERANCE = 1e-9
+ABUNDANCE_TOLERANCE = 1e-12
+
+
+def _example_compositions():
+    dat = pd.read_csv(EXAMPLE_INPUT, sep='\t').iloc[::20]
+    ret = [Composition(formula=utils.formula_to_pyteomics_formula(f, charge=c))
+           for f, c in zip(dat['formula'], dat['charge'])]
+    ret += [Composition({'C': 60, 'H': 95, 'N': 16, 'O': 20, 'S': 3, 'Se': 1, 'H+': 2}),
+            Composition({'C': 40, 'H': 70, 'N': 10, 'O': 12, 'Se': 2, 'H+': 1}),
+            Composition({'C': 12, 'H': 20, 'N': 3, 'O': 4, 'H+': 1})]
+    return ret
+
+
+@pytest.mark.parametrize('composition', _example_compositions(), ids=lambda x: x.__repr__())
+@pytest.mark.parametrize('threshold', [0.01, 1e-3])
+def test_engines_give_same_peaks(composition, threshold):
+    isotopologues = np.array(getEnvelope(Composition(composition), threshold=threshold, engine='isotopologues'))
+    convolution = np.array(getEnvelope(Composition(composition), threshold=threshold, engine='convolution'))
+
+    assert isotopologues.shape == convolution.shape
+    assert np.abs(isotopologues[:, 0] - convolution[:, 0]).max() <= MZ_TOLERANCE
+    assert np.abs(isotopologues[:, 1] - convolution[:, 1]).max() <= ABUNDANCE_TOLERANCE
@@ -0,0 +1,28 @@
+
+import os
+import pickle
+
+from envoMatch import modules as src
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def test_ms_level_in_param_group(capsys):
+    fname = os.path.join(DATA_DIR, 'param_group.mzML')
+    parsed = src.Ms1File(fname, 'mzML', build_precursor_list=True, fast_headers=False)
+    scanned = src.Ms1File(fname, 'mzML', build_precursor_list=True, fast_headers=True)
+    assert 'Parsing file instead' in capsys.readouterr().err
+
+    for ms1_file in (parsed, scanned):
+        assert ms1_file.precursors == {2: 1, 3: 1, 5: 4}
+        assert ms1_file.ms1_scans().tolist() == [1, 4]
+        assert ms1_file.retention_times().tolist() == [0.5, 0.8]
+        assert ms1_file.get_spectra(4, (0, 1000))['int'].tolist() == [40, 80]
+
+
+def test_reader_opened_on_first_read():
+    ms1_file = src.Ms1File(os.path.join(DATA_DIR, 'param_group.mzML'), 'mzML', fast_headers=False)
+    copy = pickle.loads(pickle.dumps(ms1_file))
+    assert copy._dat is None
+    assert copy.get_spectra(1, (0, 1000))['mz'].tolist() == [101, 201]
+    assert copy._dat is not None
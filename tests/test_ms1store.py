@@ -0,0 +1,49 @@
+
+import numpy as np
+
+from envoMatch.modules import ms1store
+
+
+class _FakeMs1File(object):
+    '''
+    Minimal Ms1File with arrays of different dtypes in each scan.
+    '''
+
+    def __init__(self, fname, nScan):
+        self.fname = fname
+        self.file_type = 'mzML'
+        self.precursors = dict()
+        rng = np.random.default_rng(1)
+        self.arrays = list()
+        for i in range(nScan):
+            n = int(rng.integers(0, 20))
+            mz = np.sort(rng.uniform(100, 2000, n)).astype(np.float64 if i % 3 == 0 else np.float32)
+            intensity = rng.integers(0, 1e6, n).astype(np.int32 if i % 2 else np.float32)
+            self.arrays.append((i + 1, (mz, intensity)))
+
+    def ms1_scans(self):
+        return np.array([x[0] for x in self.arrays])
+
+    def retention_times(self):
+        return [x[0] / 10 for x in self.arrays]
+
+    def iter_ms1_arrays(self):
+        return iter(self.arrays)
+
+
+def test_write_store_many_scans(tmp_path):
+    source = tmp_path / 'source.mzML'
+    source.write_bytes(b'')
+    ms1_file = _FakeMs1File(str(source), 100)
+    ofname = str(tmp_path / 'source.ms1store')
+
+    assert ms1store.writeStore(ms1_file, ofname) == 100
+    assert sorted(x.name for x in tmp_path.iterdir()) == ['source.ms1store', 'source.mzML']
+
+    store = ms1store.Ms1Store(ofname)
+    assert store.mz.dtype == np.float64 and store.int.dtype == np.float64
+    assert np.array_equal(store.rts, ms1_file.retention_times())
+    for scan, (mz, intensity) in ms1_file.arrays:
+        store_mz, store_int = store.get_arrays(scan)
+        assert np.array_equal(store_mz, mz)
+        assert np.array_equal(store_int, intensity)
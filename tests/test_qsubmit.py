@@ -0,0 +1,59 @@
+
+import shlex
+import argparse
+import importlib
+
+from envoMatch.modules import parent_parser
+
+# envoMatch.qsubmit is the entry point function, not the module
+qsubmit = importlib.import_module('envoMatch.qsubmit')
+
+
+def _parse_job_command(fname):
+    '''
+    Parse the envoMatch command in a job file with PARENT_PARSER.
+    '''
+    with open(fname, 'r') as inF:
+        line = [x for x in inF if x.startswith(qsubmit.ENV_FINDER_EXE + ' ')][0]
+    tokens = shlex.split(line)
+    return parent_parser.PARENT_PARSER.parse_args(tokens[1:tokens.index('>')])
+
+
+def _envoMatch_args(argv):
+    parser = argparse.ArgumentParser(parents=[parent_parser.PARENT_PARSER])
+    args = parser.parse_args(argv)
+    parent_args = parent_parser.PARENT_PARSER.parse_known_args(argv)[0]
+    return qsubmit._get_envoMatch_args(args, parent_args)
+
+
+def test_job_file_defaults(tmp_path):
+    envoMatch_args = _envoMatch_args(['input.tsv'])
+    fname = qsubmit.makePBS(8, 8, '12:00:00', str(tmp_path), envoMatch_args)
+    args = _parse_job_command(fname)
+    assert args.input_file == 'input.tsv'
+    assert not args.shared_spectra and not args.plotEnv and not args.resume
+
+
+def test_job_file_store_true_flags(tmp_path):
+    flags = [a.dest for a in parent_parser.PARENT_PARSER._actions
+             if isinstance(a, argparse._StoreTrueAction)]
+    envoMatch_args = _envoMatch_args(['--{}'.format(x) for x in flags] +
+                                     ['--plot_score_range', '0.5', '0.9', '--ms1_prefix', 'a',
+                                      '--ms1_prefix', 'b', 'input.tsv'])
+    for make_job in (qsubmit.makePBS, qsubmit.makeLSF):
+        args = _parse_job_command(make_job(8, 8, '12:00:00', str(tmp_path), envoMatch_args))
+        for x in flags:
+            assert getattr(args, x) is True, x
+        assert args.plot_score_range == [0.5, 0.9]
+        assert args.ms1_prefix == ['a', 'b']
+
+
+def test_array_file_flags(tmp_path):
+    envoMatch_args = _envoMatch_args(['--shared_spectra', '--schedule', 'scan', 'input.tsv'])
+    fname = qsubmit.makePBSArray(8, 8, '12:00:00', str(tmp_path), envoMatch_args,
+                                 str(tmp_path / 'shards'), 2, 'job')
+    with open(fname, 'r') as inF:
+        line = [x for x in inF if x.startswith(qsubmit.ENV_FINDER_EXE + ' ')][0]
+    tokens = shlex.split(line.replace('${PBS_ARRAYID}', '1'))
+    args = parent_parser.PARENT_PARSER.parse_args(tokens[1:tokens.index('>')])
+    assert args.shared_spectra and args.schedule == 'scan'
@@ -0,0 +1,30 @@
+
+import numpy as np
+import pytest
+
+from envoMatch.modules.shared_spectra import SpectrumBlock
+
+
+@pytest.mark.skipif(not SpectrumBlock.available(), reason='Shared memory requires python 3.8 or later')
+def test_create_many_mixed_dtype_spectra():
+    rng = np.random.default_rng(1)
+    spectra = list()
+    for i in range(50):
+        n = int(rng.integers(0, 20))
+        mz = np.sort(rng.uniform(100, 2000, n)).astype(np.float64 if i % 3 == 0 else np.float32)
+        intensity = rng.uniform(0, 1e6, n).astype(np.float32 if i % 2 else np.float64)
+        spectra.append((mz, intensity))
+
+    block = SpectrumBlock.create(spectra)
+    try:
+        assert block.mz_dtype == np.float64 and block.int_dtype == np.float64
+        attached = SpectrumBlock.attach(block.descriptor)
+        for i, (mz, intensity) in enumerate(spectra):
+            block_mz, block_int = attached.get_arrays(i)
+            assert np.array_equal(block_mz, mz)
+            assert np.array_equal(block_int, intensity)
+            del block_mz, block_int
+        attached.close()
+    finally:
+        block.close()
+        block.unlink()